@@ -1,5 +1,8 @@
 #define NON_PID 0
 #define LOG_SERVER 1
+// So mau encoder gui trong mot frame encoder_batch (1 = moi mau mot dong "1:..;2:..;3:..")
+// raw_server (SERVER_PORT) tach frame thanh tung mau trong log encoder, bulk_import nap log vao DB
+#define ENCODER_BATCH_SAMPLES 1
 
 // #define WIFI_SSID "CEEC_Tenda"
 // #define WIFI_PASS "1denmuoi1"
@@ -9,6 +9,7 @@
 
 #include "driver/pulse_cnt.h"
 #include "esp_log.h"
+#include "esp_timer.h"
 #include "lwip/sockets.h"
 #include "sys_config.h"
 
@@ -120,6 +121,14 @@ void task_send_encoder(void *pvParameters)
     char message[64];
     TickType_t last_wake_time = xTaskGetTickCount();
 
+#if ENCODER_BATCH_SAMPLES > 1
+    // {"type":"encoder_batch","samples":[[t,rpm1,rpm2,rpm3],...]}, t = giay tinh tu mau dau cua frame
+    static char frame[64 + ENCODER_BATCH_SAMPLES * 48];
+    float samples[ENCODER_BATCH_SAMPLES][4];
+    int64_t first_us = 0;
+    int count = 0;
+#endif
+
     int encoder_count[3] = {0};
     while (1)
     {
@@ -127,6 +136,35 @@ void task_send_encoder(void *pvParameters)
 #if NON_PID == 1
         read_rpm(TIME_INTERVAL);
         // read_encoders(encoder_count);
+#endif
+#if ENCODER_BATCH_SAMPLES > 1
+        if (count == 0)
+        {
+            first_us = esp_timer_get_time();
+        }
+        samples[count][0] = (esp_timer_get_time() - first_us) / 1e6f;
+        samples[count][1] = encoder_rpm[0];
+        samples[count][2] = encoder_rpm[1];
+        samples[count][3] = encoder_rpm[2];
+        if (++count < ENCODER_BATCH_SAMPLES)
+        {
+            vTaskDelayUntil(&last_wake_time, pdMS_TO_TICKS(TIME_INTERVAL));
+            continue;
+        }
+        int len = snprintf(frame, sizeof(frame), "{\"type\":\"encoder_batch\",\"samples\":[");
+        for (int i = 0; i < count; i++)
+        {
+            len += snprintf(frame + len, sizeof(frame) - len, "%s[%.3f,%.2f,%.2f,%.2f]", i ? "," : "",
+                            samples[i][0], samples[i][1], samples[i][2], samples[i][3]);
+        }
+        len += snprintf(frame + len, sizeof(frame) - len, "]}\n");
+        count = 0;
+        if (send(sock, frame, len, 0) < 0)
+        {
+            ESP_LOGE(TAG, "Failed to send encoder batch");
+        }
+        vTaskDelayUntil(&last_wake_time, pdMS_TO_TICKS(TIME_INTERVAL));
+        continue;
 #endif
         snprintf(message, sizeof(message), "1:%.2f;2:%.2f;3:%.2f\n", encoder_rpm[0], encoder_rpm[1], encoder_rpm[2]);
         // snprintf(message, sizeof(message), "1:%d;2:%d;3:%d\n", encoder_count[0], encoder_count[1], encoder_count[2]);
@@ -1,6 +1,12 @@
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
+# Dùng chung mô hình động học với backend (back/kinematics.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "back"))
+from kinematics import RobotGeometry, for_geometry
+
 # Thông số robot
 wheel_radius = 0.03
 robot_radius = 0.153
@@ -9,30 +15,11 @@ dt = 0.05
 # Load dữ liệu
 data = np.loadtxt("encoder_data.txt")
 rpm_data = np.array(data)
-omega_wheel = rpm_data * (2 * np.pi / 60)
-
-# Khởi tạo vị trí
-x, y, theta = 0, 0, 0
-x_hist, y_hist = [x], [y]
-
-# Hàm động học
-def compute_velocity(theta, omega):
-    H = np.array([
-        [-np.sin(theta), np.cos(theta), robot_radius],
-        [-np.sin(np.pi / 3 - theta), -np.cos(np.pi / 3 - theta), robot_radius],
-        [np.sin(np.pi / 3 + theta), -np.cos(np.pi / 3 + theta), robot_radius]
-    ])
-    omega_scaled = omega * wheel_radius
-    velocities = np.linalg.solve(H, omega_scaled)
-    return velocities[0], velocities[1], velocities[3]
-
-# Tính toán vị trí
-for omega in omega_wheel:
-    v_x, v_y, _ = compute_velocity(theta, omega)
-    x += v_x * dt
-    y += v_y * dt
-    x_hist.append(x)
-    y_hist.append(y)
+
+# Tính toán vị trí (tích phân trên toàn bộ chuỗi RPM)
+kin = for_geometry(RobotGeometry(wheel_radius, robot_radius, dt))
+trajectory = kin.integrate(rpm_data, dt)
+x_hist, y_hist = trajectory['x'], trajectory['y']
 
 # Đổi từ mét sang cm để dễ nhìn
 x_hist_cm = np.array(x_hist) * 100
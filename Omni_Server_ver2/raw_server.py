@@ -1,9 +1,11 @@
 import os
+import sys
 import json
 import socket
 import threading
 import re
 import time
+import datetime
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
 from raw_control import ControlGUI
@@ -11,6 +13,11 @@ from raw_control import ControlGUI
 from rpm_plot import update_rpm_plot
 from rpm_plot import rpm_plotter
 
+# Dùng chung bộ tách dòng với backend (back/line_framer.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "back"))
+from line_framer import LineFramer
+import sample_batch
+
 
 class Server:
     def __init__(self, gui):
@@ -31,10 +38,10 @@ class Server:
                 # Khởi tạo dictionary để quản lý file log
         self.log_files = {}
         self.start_times = {}
-        self.supported_types = ["encoder", "bno055", "log"]
+        self.supported_types = ["encoder", "bno055", "log", *sample_batch.BATCH_TYPES]
     
         # Tạo file log mới cho loại dữ liệu
-    def setup_log_file(self, data_type):
+    def setup_log_file(self, data_type, start=None):
         if not self.log_data or data_type in self.log_files:
             return
             
@@ -52,7 +59,7 @@ class Server:
         elif data_type == "log":
             self.log_files[data_type].write("Time Message\n")
             
-        self.start_times[data_type] = time.time()
+        self.start_times[data_type] = time.time() if start is None else start
         self.gui.update_monitor(f"Started logging {data_type} data to {log_filename}")
     
     # Đóng tất cả file log
@@ -247,7 +254,8 @@ class Server:
             self.gui.disable_buttons()
 
         # Hàm xử lý dữ liệu encoder
-    def process_encoder_data(self, encoder_data):
+    def process_encoder_data(self, encoder_data, at=None):
+        """at: thời điểm của mẫu (epoch giây), mặc định là lúc nhận"""
         if not isinstance(encoder_data, list) or len(encoder_data) < 3:
             self.gui.update_monitor(f"Invalid encoder data format: {encoder_data}")
             return
@@ -264,7 +272,7 @@ class Server:
         # Ghi log nếu được bật
         self.setup_log_file("encoder")
         if self.log_data and "encoder" in self.log_files:
-            timestamp = time.time() - self.start_times["encoder"]
+            timestamp = (time.time() if at is None else at) - self.start_times["encoder"]
             self.log_files["encoder"].write(f"{timestamp:.3f} {' '.join([str(e) for e in self.encoders])}\n")
             self.log_files["encoder"].flush()
 
@@ -326,6 +334,24 @@ class Server:
                 
         except Exception as e:
             self.gui.update_monitor(f"Error processing BNO055 data: {e}")
+    # Hàm xử lý frame nhiều mẫu (encoder_batch, imu_batch - back/sample_batch.py)
+    def process_sample_batch(self, frame):
+        """Tách frame thành từng mẫu và ghi như các tin encoder/bno055 đơn lẻ, giữ thời điểm của mẫu"""
+        timestamps, columns = sample_batch.unpack(frame, time.time())
+        times = [t.replace(tzinfo=datetime.timezone.utc).timestamp() for t in timestamps]
+        if not times:
+            return
+        data_type = "encoder" if frame["type"] == "encoder_batch" else "bno055"
+        # Mẫu đầu có thể trước lúc nhận: file log mở từ frame này bắt đầu tại mẫu đầu
+        self.setup_log_file(data_type, times[0])
+        for at, values in zip(times, zip(*columns)):
+            if data_type == "encoder":
+                self.process_encoder_data(list(values), at)
+            else:
+                roll, pitch, yaw = values[:3]
+                self.process_bno055_data({"time": at - self.start_times.get("bno055", at), "euler": [yaw, pitch, roll],
+                                          "lin_accel": [0, 0, 0], "gravity": [0, 0, 0]})
+
     # Hàm xử lý thông điệp log từ thiết bị
     def process_log_message(self, log_message):
         # Hiển thị log lên UI
@@ -340,20 +366,17 @@ class Server:
 
 
     def receive_client_data(self, sock):
-        buffer = ""  # Lưu dữ liệu bị phân mảnh
+        framer = LineFramer()  # Lưu dữ liệu bị phân mảnh
         
         try:
             while self.control_active:
                 try:
-                    data = sock.recv(1024).decode()
+                    data = sock.recv(1024)
                     if not data:
                         self.gui.update_monitor("Control client disconnected")
                         break
 
-                    buffer += data  # Thêm dữ liệu mới vào buffer
-                    
-                    while "\n" in buffer:  # Kiểm tra nếu có dòng kết thúc
-                        line, buffer = buffer.split("\n", 1)  # Lấy một dòng hoàn chỉnh
+                    for line in framer.lines(data):  # Mọi dòng hoàn chỉnh trong lần đọc này
                         line = line.strip()  # Loại bỏ ký tự trắng thừa
 
                         # Phân tích dữ liệu JSON
@@ -373,6 +396,9 @@ class Server:
                                 elif message_type == "log" and "message" in json_data:
                                     self.process_log_message(json_data["message"])
                                     
+                                elif sample_batch.is_batch(json_data):
+                                    self.process_sample_batch(json_data)
+                                    
                                 else:
                                     self.gui.update_monitor(f"Unknown message type or missing data: {json_data}")
                             
@@ -388,7 +414,7 @@ class Server:
                     
         except Exception as e:
             self.gui.update_monitor(f"Data reception error: {e}")
-            print(f"Buffer at error: {buffer}")
+            print(f"Buffer at error: {bytes(framer.buffer)!r}")
         finally:
             # Đóng socket khi client ngắt kết nối
             try:
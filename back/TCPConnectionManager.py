@@ -6,82 +6,122 @@ from sqlalchemy.orm import Session
 from database import SessionLocal, EncoderData, IMUData, JSONDataHandler
 import re
 import asyncio
+import logging
+from telemetry_journal import TelemetryJournal, JournalDrainer
+from line_framer import LineFramer
+
+logger = logging.getLogger("TCPConnectionManager")
 
 class TCPConnectionManager:
-    def __init__(self, host="0.0.0.0", port=5005):
+    def __init__(self, host="0.0.0.0", port=5005, loop=None):
         self.server_host = host
         self.server_port = port
         self.robot_connections = {}  # {robot_id: socket}
         self.lock = threading.Lock()
         self.running = True
+        # Event loop của ứng dụng (FastAPI); các thread của manager không có loop riêng
+        self.loop = loop
+        
+        # Dữ liệu được ghi vào journal trước, drainer lưu vào DB ở nền
+        self.journal = TelemetryJournal()
+        self.drainer = JournalDrainer(self.journal, sink=self.store_journal_batch)
         
     def save_to_database(self, robot_id, data_str):
-        """Lưu dữ liệu từ ESP32 vào database"""
-        try:
-            db = SessionLocal()
+        """Ghi dữ liệu từ ESP32 vào journal, drainer sẽ lưu vào database"""
+        self.journal.append(robot_id, data_str)
+    
+    def _parse_entry(self, data_str):
+        """Chuyển một dòng dữ liệu ESP32 thành bản ghi database (None nếu không nhận dạng được)"""
+        # Phân tích dữ liệu từ ESP32
+        if data_str.startswith("1:"):  # Định dạng RPM
+            pattern = r"(\d):(-?\d+(?:\.\d+)?)"
+            matches = re.findall(pattern, data_str)
             
-            # Phân tích dữ liệu từ ESP32
-            if data_str.startswith("1:"):  # Định dạng RPM
-                pattern = r"(\d):(-?\d+(?:\.\d+)?)"
-                matches = re.findall(pattern, data_str)
-                
-                # Tạo dữ liệu encoder
-                values = [0, 0, 0]
-                rpm = [0, 0, 0]
-                
-                for motor_id, value in matches:
-                    motor_idx = int(motor_id) - 1
-                    if 0 <= motor_idx < 3:
-                        values[motor_idx] = int(float(value)) if value else 0
-                        rpm[motor_idx] = float(value) if value else 0
-                
-                encoder_entry = EncoderData(
-                    values=values,
-                    rpm=rpm
-                )
-                db.add(encoder_entry)
-                    
-            elif data_str.startswith("IMU:"):  # Định dạng IMU data
-                # Giả sử dữ liệu có dạng "IMU:theta=1.2,omega=[10,20,30],x=5,y=10"
-                data = data_str.replace("IMU:", "").strip()
-                parts = data.split(",")
-                imu_data = {}
-                
-                for part in parts:
-                    key, value = part.split("=")
-                    if key == "omega":
-                        value = json.loads(value)
-                    else:
-                        value = float(value)
-                    imu_data[key] = value
-                
-                imu_entry = IMUData(
-                    yaw=imu_data.get("theta", 0),
-                    # Lưu omega trong raw_data
-                    raw_data={"omega": imu_data.get("omega", [0, 0, 0])},
-                    accel_x=imu_data.get("x", 0) * 100,  # Chuyển đổi đơn vị nếu cần
-                    accel_y=imu_data.get("y", 0) * 100,
-                    # Các giá trị khác cần thiết cho IMUData
-                    roll=0.0,
-                    pitch=0.0,
-                    accel_z=0.0,
-                    ang_vel_x=0.0,
-                    ang_vel_y=0.0,
-                    ang_vel_z=0.0
-                )
-                db.add(imu_entry)
+            # Tạo dữ liệu encoder
+            values = [0, 0, 0]
+            rpm = [0, 0, 0]
+            
+            for motor_id, value in matches:
+                motor_idx = int(motor_id) - 1
+                if 0 <= motor_idx < 3:
+                    values[motor_idx] = int(float(value)) if value else 0
+                    rpm[motor_idx] = float(value) if value else 0
+            
+            return EncoderData(
+                values=values,
+                rpm=rpm
+            )
                 
-            db.commit()
+        elif data_str.startswith("IMU:"):  # Định dạng IMU data
+            # Giả sử dữ liệu có dạng "IMU:theta=1.2,omega=[10,20,30],x=5,y=10"
+            data = data_str.replace("IMU:", "").strip()
+            parts = data.split(",")
+            imu_data = {}
             
-            # Phát sóng dữ liệu đến tất cả websocket clients
-            from main import broadcast_trajectory
-            import asyncio
-            asyncio.run_coroutine_threadsafe(broadcast_trajectory(), asyncio.get_event_loop())
+            for part in parts:
+                key, value = part.split("=")
+                if key == "omega":
+                    value = json.loads(value)
+                else:
+                    value = float(value)
+                imu_data[key] = value
             
-        except Exception as e:
-            print(f"Lỗi khi lưu dữ liệu: {e}")
+            return IMUData(
+                yaw=imu_data.get("theta", 0),
+                # Lưu omega trong raw_data
+                raw_data={"omega": imu_data.get("omega", [0, 0, 0])},
+                accel_x=imu_data.get("x", 0) * 100,  # Chuyển đổi đơn vị nếu cần
+                accel_y=imu_data.get("y", 0) * 100,
+                # Các giá trị khác cần thiết cho IMUData
+                roll=0.0,
+                pitch=0.0,
+                accel_z=0.0,
+                ang_vel_x=0.0,
+                ang_vel_y=0.0,
+                ang_vel_z=0.0
+            )
+        return None
+    
+    def store_journal_batch(self, robot_id, records):
+        """Sink của JournalDrainer: lưu một lô dòng dữ liệu trong một transaction, lỗi DB được ném ra để thử lại"""
+        entries = []
+        for _, payload in records:
+            line = payload.decode("utf-8", errors="replace")
+            try:
+                entry = self._parse_entry(line)
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Bỏ qua dòng không hợp lệ từ {robot_id}: {line} ({e})")
+                continue
+            if entry is not None:
+                entries.append(entry)
+        
+        if not entries:
+            return
+        
+        db = SessionLocal()
+        try:
+            db.add_all(entries)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
         finally:
             db.close()
+        
+        # Phát sóng dữ liệu đến tất cả websocket clients
+        try:
+            from main import broadcast_trajectory
+            self.broadcast(broadcast_trajectory)
+        except Exception as e:
+            logger.error(f"Lỗi khi phát dữ liệu: {e}")
+    
+    def broadcast(self, coroutine_function):
+        """Chạy coroutine phát dữ liệu trên event loop của ứng dụng, gọi được từ mọi thread"""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            logger.debug("Chưa có event loop của ứng dụng, bỏ qua phát dữ liệu")
+            return
+        asyncio.run_coroutine_threadsafe(coroutine_function(), loop)
     
     def handle_client(self, client_socket):
         """Xử lý kết nối từ ESP32"""
@@ -112,18 +152,15 @@ class TCPConnectionManager:
                 self.robot_connections[robot_id] = client_socket
             
             # Nhận dữ liệu liên tục từ ESP32
-            buffer = ""
+            framer = LineFramer()
             while self.running:
                 try:
-                    data = client_socket.recv(1024).decode()
+                    data = client_socket.recv(1024)
                     if not data:
                         break
                     
-                    buffer += data
-                    
                     # Xử lý dữ liệu theo từng dòng
-                    while "\n" in buffer:
-                        line, buffer = buffer.split("\n", 1)
+                    for line in framer.lines(data):
                         line = line.strip()
                         if line:
                             print(f"Nhận từ {robot_id}: {line}")
@@ -153,6 +190,9 @@ class TCPConnectionManager:
         server.listen(10)
         print(f"TCP Server đang chạy trên {self.server_host}:{self.server_port}...")
         
+        # Drainer replay dữ liệu chưa lưu từ lần chạy trước rồi tiếp tục lưu dữ liệu mới
+        self.drainer.start()
+        
         while self.running:
             try:
                 client_socket, addr = server.accept()
@@ -186,6 +226,8 @@ class TCPConnectionManager:
     def stop(self):
         """Dừng TCP server"""
         self.running = False
+        self.drainer.stop()
+        self.journal.close()
         with self.lock:
             for sock in self.robot_connections.values():
                 try:
@@ -211,13 +253,11 @@ class TCPConnectionManager:
             if msg_type == "encoder_data":
                 # Create task to broadcast updated data to clients
                 from main import broadcast_motor_data
-                import asyncio
-                asyncio.run_coroutine_threadsafe(broadcast_motor_data(), asyncio.get_event_loop())
+                self.broadcast(broadcast_motor_data)
             elif msg_type == "trajectory_data":
                 # Create task to broadcast updated trajectory
                 from main import broadcast_trajectory
-                import asyncio
-                asyncio.run_coroutine_threadsafe(broadcast_trajectory(), asyncio.get_event_loop())
+                self.broadcast(broadcast_trajectory)
             elif msg_type == "imu_data":
                 # Update any UI that needs IMU data
                 pass
@@ -0,0 +1,510 @@
+"""
+Bulk importer for recorded robot data.
+
+Supported inputs:
+    json_data/*.json             lists of messages, or the combined dict format
+                                 {"encoder": [...], "imu": [...], "log": [...]}
+    logs/encoder_log_*.txt       space separated "Time RPM1 RPM2 RPM3"
+    logs/bno055_log_*.txt        space separated "Time Heading Pitch Roll ..."
+                                 (written by Omni_Server_ver2/raw_server.Server)
+
+Files are parsed incrementally, records are collected into columnar batches
+and loaded with PostgreSQL COPY. A file is loaded in one transaction together
+with its row in imported_files (absolute path, byte offset imported up to and
+the hash of those bytes), so importing the same file twice is a no-op.
+
+raw_server logs grow while a recording runs. Only complete lines are imported,
+and the next import of the same path resumes from the stored offset when the
+bytes before it are unchanged (otherwise the file was rewritten: the rows of
+that path are replaced by a fresh import, as they are for a changed JSON dump).
+--force deletes the rows of that path and imports it again.
+
+Usage:
+    python bulk_import.py ../json_data/*.json ../Omni_Server_ver2/logs/*.txt --robot-id 1
+"""
+import io
+import os
+import re
+import csv
+import json
+import time
+import hashlib
+import logging
+import argparse
+import datetime
+from typing import Dict, Iterator, List, Optional
+
+import kinematics
+from robot_database import engine, ImportedFile, Base
+
+logger = logging.getLogger("bulk_import")
+
+# Rows per COPY round trip
+BATCH_SIZE = 10000
+
+# Bytes read from disk per chunk
+CHUNK_SIZE = 1 << 16
+
+_FILE_TIME = re.compile(r"(\d{8}_\d{6})")
+
+_DELIMITERS = frozenset(",:]} \t\r\n")
+
+
+# === STREAMING JSON ===
+
+class JSONStream:
+    """
+    Incremental reader for a JSON array, or an object whose values are arrays.
+
+    Only one array element is decoded at a time, so memory use does not grow
+    with the file size.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += chunk
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number may be cut short by the chunk edge, it must be followed by a delimiter
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in _DELIMITERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def _iter_array(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self._decode()
+            if self._expect(",]") == "]":
+                return
+
+    def __iter__(self) -> Iterator[dict]:
+        first = self._peek()
+        if first == "[":
+            yield from self._iter_array()
+        elif first == "{":
+            # Combined format: {"encoder": [...], "imu": [...], ...}
+            self.pos += 1
+            if self._peek() == "}":
+                return
+            while True:
+                self._decode()  # key
+                self._expect(":")
+                if self._peek() == "[":
+                    yield from self._iter_array()
+                else:
+                    self._decode()
+                if self._expect(",}") == "}":
+                    return
+        elif first:
+            raise ValueError(f"Unsupported JSON layout, starts with {first!r}")
+
+
+# === COLUMNAR BATCHES ===
+
+class ColumnBatch:
+    """Column buffers for one table, flushed with COPY"""
+
+    def __init__(self, table, columns, batch_size=BATCH_SIZE):
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.data: Dict[str, list] = {c: [] for c in columns}
+        self.rows = 0
+        self.copied = 0
+
+    def append(self, cursor, *values):
+        for column, value in zip(self.columns, values):
+            self.data[column].append(value)
+        self.rows += 1
+        if self.rows >= self.batch_size:
+            self.flush(cursor)
+
+    def extend(self, cursor, *columns):
+        """Many rows at once, given column by column (all columns the same length)"""
+        for column, values in zip(self.columns, columns):
+            self.data[column].extend(values)
+        self.rows += len(columns[0])
+        if self.rows >= self.batch_size:
+            self.flush(cursor)
+
+    def flush(self, cursor):
+        if not self.rows:
+            return
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(zip(*(self.data[c] for c in self.columns)))
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {self.table} ({', '.join(self.columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        self.copied += self.rows
+        self.rows = 0
+        for values in self.data.values():
+            values.clear()
+
+
+class Loader:
+    """Routes parsed records into the encoder/imu/log batches of one file"""
+
+    def __init__(self, cursor, source_path, batch_size=BATCH_SIZE):
+        self.cursor = cursor
+        # Constant per file, marks every row with where it came from
+        self.raw = json.dumps({"source_file": os.path.basename(source_path), "source_path": source_path})
+        self.robot_ids = set()
+        self.encoder = ColumnBatch(
+            "encoder_data", ["robot_id", "timestamp", "rpm_1", "rpm_2", "rpm_3", "robot_data", "raw_data"], batch_size)
+        self.imu = ColumnBatch(
+            "imu_data", ["robot_id", "timestamp", "roll", "pitch", "yaw",
+                         "quat_w", "quat_x", "quat_y", "quat_z", "robot_data", "raw_data"], batch_size)
+        self.log = ColumnBatch(
+            "log_data", ["robot_id", "timestamp", "log_level", "message", "robot_data", "raw_data"], batch_size)
+
+    def _ensure_robot(self, robot_id):
+        """Create missing robots before their rows are copied (foreign key)"""
+        if robot_id in self.robot_ids:
+            return
+        self.robot_ids.add(robot_id)
+        self.cursor.execute(
+            "INSERT INTO robots (robot_id, name, description, last_seen) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (robot_id) DO NOTHING",
+            (robot_id, f"Robot {robot_id}", f"Automatically created for robot ID {robot_id}",
+             datetime.datetime.utcnow())
+        )
+
+    def add_encoder(self, robot_id, timestamp, rpm):
+        self._ensure_robot(robot_id)
+        self.encoder.append(self.cursor, robot_id, timestamp, rpm[0], rpm[1], rpm[2], True, self.raw)
+
+    def add_imu(self, robot_id, timestamp, euler, quaternion=(None, None, None, None)):
+        self._ensure_robot(robot_id)
+        self.imu.append(self.cursor, robot_id, timestamp, euler[0], euler[1], euler[2],
+                        quaternion[0], quaternion[1], quaternion[2], quaternion[3], True, self.raw)
+
+    def add_log(self, robot_id, timestamp, message, level="INFO"):
+        self.log.append(self.cursor, robot_id, timestamp, level, message, True, self.raw)
+
+    def finish(self):
+        for batch in (self.encoder, self.imu, self.log):
+            batch.flush(self.cursor)
+        return {"encoder": self.encoder.copied, "imu": self.imu.copied, "log": self.log.copied}
+
+
+# === PARSERS ===
+
+def file_start_time(path) -> datetime.datetime:
+    """Recording start from the YYYYmmdd_HHMMSS part of the file name (local time), as naive UTC"""
+    match = _FILE_TIME.search(os.path.basename(path))
+    if match:
+        local = datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M%S")
+    else:
+        local = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+    return local.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def load_json(path, loader: Loader, robot_id=None):
+    """
+    Stream a JSON dump into the loader
+
+    Encoder messages carry no time, they are spaced by the nominal sample period
+    from the file start so their order is preserved. IMU messages use data.time.
+    """
+    start = file_start_time(path)
+    encoder_index = 0
+    with open(path, "r") as f:
+        for item in JSONStream(f):
+            if not isinstance(item, dict):
+                continue
+            rid = str(robot_id or item.get("id", "unknown"))
+            data_type = item.get("type")
+
+            if data_type == "encoder":
+                data = item.get("data", [0.0, 0.0, 0.0])
+                if len(data) < 3:
+                    continue
+                step = kinematics.get_geometry(rid).dt
+                timestamp = start + datetime.timedelta(seconds=encoder_index * step)
+                encoder_index += 1
+                loader.add_encoder(rid, timestamp, [float(v) for v in data[:3]])
+
+            elif data_type == "bno055":
+                data = item.get("data", {})
+                euler = data.get("euler", [0.0, 0.0, 0.0])
+                quaternion = data.get("quaternion", [1.0, 0.0, 0.0, 0.0])
+                device_time = data.get("time")
+                timestamp = datetime.datetime.utcfromtimestamp(device_time) if device_time else start
+                loader.add_imu(rid, timestamp, [float(v) for v in euler[:3]], [float(v) for v in quaternion[:4]])
+
+            elif data_type == "log":
+                loader.add_log(rid, start, item.get("message", ""))
+
+            else:
+                loader.add_log(rid, start, f"Unknown data type: {data_type}")
+
+
+def _iter_columns(path, start=0, end=None) -> Iterator[List[str]]:
+    """Whitespace separated rows of a raw_server log in bytes [start, end), header and malformed lines skipped"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            position += len(line)
+            if end is not None and position > end:
+                return
+            fields = line.decode("utf-8", errors="replace").split()
+            if not fields:
+                continue
+            try:
+                float(fields[0])
+            except ValueError:
+                continue  # header
+            yield fields
+
+
+def load_encoder_log(path, loader: Loader, robot_id="1", offset=0, end=None):
+    """encoder_log_*.txt: Time is seconds since the file was opened"""
+    start = file_start_time(path)
+    for fields in _iter_columns(path, offset, end):
+        if len(fields) < 4:
+            continue
+        timestamp = start + datetime.timedelta(seconds=float(fields[0]))
+        loader.add_encoder(robot_id, timestamp, [float(v) for v in fields[1:4]])
+
+
+def load_bno055_log(path, loader: Loader, robot_id="1", offset=0, end=None):
+    """
+    bno055_log_*.txt: Heading Pitch Roll follow the device time column
+
+    The device time is not a wall clock, rows are spaced by the nominal
+    sample period from the file start (rows before offset are counted).
+    """
+    start = file_start_time(path)
+    step = kinematics.get_geometry(robot_id).dt
+    first = sum(1 for _ in _iter_columns(path, 0, offset)) if offset else 0
+    for index, fields in enumerate(_iter_columns(path, offset, end), first):
+        if len(fields) < 4:
+            continue
+        heading, pitch, roll = (float(v) for v in fields[1:4])
+        timestamp = start + datetime.timedelta(seconds=index * step)
+        loader.add_imu(robot_id, timestamp, (roll, pitch, heading))
+
+
+def detect_format(path) -> str:
+    name = os.path.basename(path)
+    if name.endswith(".json"):
+        return "json"
+    if name.startswith("encoder_log"):
+        return "encoder_log"
+    if name.startswith("bno055_log"):
+        return "bno055_log"
+    raise ValueError(f"Unknown file format: {name}")
+
+
+def file_hash(path, size=None) -> str:
+    """sha256 of the file, or of its first size bytes"""
+    digest = hashlib.sha256()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(1 << 20, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def complete_size(path) -> int:
+    """Bytes up to the last newline, a line raw_server is still writing is left for the next import"""
+    position = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while position > 0:
+            step = min(CHUNK_SIZE, position)
+            f.seek(position - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline >= 0:
+                return position - step + newline + 1
+            position -= step
+    return 0
+
+
+def _ensure_imported_files():
+    Base.metadata.create_all(engine, tables=[ImportedFile.__table__])
+    # Tables created before file_path/byte_offset existed
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE imported_files ADD COLUMN IF NOT EXISTS file_path VARCHAR, "
+                             "ADD COLUMN IF NOT EXISTS byte_offset BIGINT DEFAULT 0")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_imported_files_file_path ON imported_files (file_path)")
+
+
+def _delete_source_rows(cursor, source_path):
+    """Delete the rows loaded from one file (Loader stores its path in raw_data)"""
+    for table in ("encoder_data", "imu_data", "log_data"):
+        cursor.execute(f"DELETE FROM {table} WHERE raw_data->>'source_path' = %s", (source_path,))
+
+
+# === IMPORT ===
+
+def import_file(path, robot_id: Optional[str] = None, force=False, batch_size=BATCH_SIZE) -> dict:
+    """
+    Import one file, or what was appended to it since the last import, in a single transaction
+
+    Args:
+        path: JSON dump or raw_server log file
+        robot_id: Robot ID for log files (they carry none), overrides JSON ids when set
+        force: Re-import a file that was already imported, replacing its rows
+        batch_size: Rows per COPY
+
+    Returns:
+        Dict with per table row counts, elapsed seconds and records per second
+    """
+    started = time.perf_counter()
+    fmt = detect_format(path)
+    name = os.path.basename(path)
+    source_path = os.path.abspath(path)
+    # A JSON dump is only valid whole, a log is imported up to its last complete line
+    end = os.path.getsize(path) if fmt == "json" else complete_size(path)
+    if not end:
+        logger.info(f"{name} has no complete line yet, skipping")
+        return {"file": name, "skipped": True}
+    digest = file_hash(path, end)
+
+    _ensure_imported_files()
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if force:
+            _delete_source_rows(cursor, source_path)
+            cursor.execute("DELETE FROM imported_files WHERE file_path = %s OR sha256 = %s", (source_path, digest))
+        else:
+            cursor.execute("SELECT file_path FROM imported_files WHERE sha256 = %s", (digest,))
+            row = cursor.fetchone()
+            if row:
+                logger.info(f"{name} already imported" + (f" as {row[0]}" if row[0] != source_path else "")
+                            + ", skipping")
+                return {"file": name, "skipped": True}
+
+        cursor.execute("SELECT id, sha256, byte_offset, records FROM imported_files WHERE file_path = %s",
+                       (source_path,))
+        progress = cursor.fetchone()
+        offset = 0
+        if progress and fmt != "json":
+            _, progress_hash, progress_offset, _ = progress
+            if progress_offset and progress_offset <= end and file_hash(path, progress_offset) == progress_hash:
+                offset = progress_offset
+            else:
+                logger.warning(f"{name} changed since it was imported up to byte {progress_offset}, "
+                               f"importing it from the start")
+        if progress and not offset:
+            # Rewritten log or new JSON dump at a known path: its rows are replaced, in this transaction
+            _delete_source_rows(cursor, source_path)
+
+        loader = Loader(cursor, source_path, batch_size)
+        if fmt == "json":
+            load_json(path, loader, robot_id)
+        elif fmt == "encoder_log":
+            load_encoder_log(path, loader, robot_id or "1", offset, end)
+        else:
+            load_bno055_log(path, loader, robot_id or "1", offset, end)
+        counts = loader.finish()
+
+        records = sum(counts.values())
+        now = datetime.datetime.utcnow()
+        if progress:
+            total = (progress[3] or 0) + records if offset else records
+            cursor.execute(
+                "UPDATE imported_files SET file_name = %s, sha256 = %s, byte_offset = %s, records = %s, "
+                "imported_at = %s WHERE id = %s",
+                (name, digest, end, total, now, progress[0])
+            )
+        else:
+            cursor.execute(
+                "INSERT INTO imported_files (file_name, file_path, sha256, byte_offset, records, imported_at) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                (name, source_path, digest, end, records, now)
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    stats = dict(counts, file=name, records=records, resumed_at=offset, seconds=elapsed,
+                 records_per_second=records / elapsed if elapsed > 0 else 0.0)
+    logger.info(f"Imported {records} records from {name}" + (f" (from byte {offset})" if offset else "")
+                + f" in {elapsed:.2f}s ({stats['records_per_second']:.0f} records/s)")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import JSON dumps and raw_server logs with COPY')
+    parser.add_argument('files', nargs='+', help='Files to import')
+    parser.add_argument('--robot-id', default=None, help='Robot ID for log files (default: 1)')
+    parser.add_argument('--force', action='store_true', help='Re-import files that were already imported')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help=f'Rows per COPY (default: {BATCH_SIZE})')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    total = 0
+    started = time.perf_counter()
+    for path in args.files:
+        try:
+            stats = import_file(path, args.robot_id, args.force, args.batch_size)
+        except Exception as e:
+            print(f"❌ {path}: {e}")
+            continue
+        if stats.get("skipped"):
+            print(f"⏭  {stats['file']}: already imported")
+            continue
+        total += stats["records"]
+        print(f"✅ {stats['file']}: {stats['encoder']} encoder, {stats['imu']} imu, {stats['log']} log "
+              f"({stats['records_per_second']:.0f} records/s)")
+
+    elapsed = time.perf_counter() - started
+    print(f"Total: {total} records in {elapsed:.2f}s ({total / elapsed if elapsed > 0 else 0:.0f} records/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Outbound queues by priority, one writer task per connection.
+
+tcp_server used to write each ack, registration confirmation and forwarded
+command straight to the robot's StreamWriter and await drain(); the bridge
+awaited websocket.send() for every frontend command on its one link to
+tcp_server. Under load an emergency_stop waited behind whatever was already
+being written.
+
+CommandLanes keeps four FIFO lanes per connection and a single task that
+always sends from the highest non-empty lane:
+
+    SAFETY   emergency_stop, stop                     (SAFETY_COMMAND_TYPES)
+    CONTROL  motor_control, motion_command, ...       (CONTROL_COMMAND_TYPES)
+    CONFIG   every other command (update_pid, firmware_update, ...)
+    BULK     data_ack, heartbeat, error responses
+
+A safety command therefore waits for at most the message being sent plus
+what is already buffered below the lanes, which stream_sender() keeps small:
+OUTBOUND_HIGH_WATER bytes in the transport and an OUTBOUND_SNDBUF kernel send
+buffer (with the default autotuned buffer, megabytes of queued motor_control
+on a stalled robot went out before the stop). The BULK lane is bounded
+(OUTBOUND_BULK_MAX): when a robot stops reading, its oldest acks are dropped
+rather than queued without limit. Time spent in each lane is exported as
+outbound_queue_seconds{lane}. drained() lets the reader of the connection
+wait for the BULK lane to go down (ingest_guard.py stops reading from a robot
+whose acks pile up).
+
+Setpoints (SETPOINT_COMMAND_TYPES: teleop, trajectory steps, dashboard
+sliders) are latest-wins per robot: a new one replaces the robot's setpoint
+that is still queued, in place, unless another control command was queued
+after it (order between them is kept). A stop cancels the robot's queued
+setpoint, which would otherwise go out after the stop and restart the motors.
+Setpoints to a robot are sent at most SETPOINT_MAX_RATE per second; while the
+next one waits, newer ones keep replacing it. Other commands are never
+dropped, coalesced or delayed by the rate limit.
+
+    lanes = CommandLanes(client_id, stream_sender(writer))
+    lanes.put_command(json.dumps(command) + "\\n", command["type"], robot_id)
+    lanes.put(json.dumps(ack) + "\\n")
+"""
+import time
+import socket
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable
+
+import metrics
+from config import (SAFETY_COMMAND_TYPES, CONTROL_COMMAND_TYPES, SETPOINT_COMMAND_TYPES, SETPOINT_MAX_RATE,
+                    OUTBOUND_HIGH_WATER, OUTBOUND_SNDBUF, OUTBOUND_BULK_MAX)
+
+logger = logging.getLogger("command_lanes")
+
+SAFETY, CONTROL, CONFIG, BULK = range(4)
+LANE_NAMES = ("safety", "control", "config", "bulk")
+
+_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+OUTBOUND_QUEUE_SECONDS = metrics.histogram("outbound_queue_seconds", "Time from queueing a message to writing it",
+                                           ["lane"], buckets=_LATENCY_BUCKETS)
+OUTBOUND_SENT = metrics.counter("outbound_sent_total", "Messages written by connection writer tasks", ["lane"])
+OUTBOUND_DROPPED = metrics.counter("outbound_dropped_total", "Queued messages dropped (bulk overflow or closed connection)", ["lane"])
+OUTBOUND_SUPERSEDED = metrics.counter("outbound_setpoints_superseded_total",
+                                      "Queued setpoints never sent: replaced by a newer one or cancelled by a stop", ["reason"])
+
+_QUEUE_SECONDS = [OUTBOUND_QUEUE_SECONDS.labels(name) for name in LANE_NAMES]
+_SENT = [OUTBOUND_SENT.labels(name) for name in LANE_NAMES]
+_DROPPED = [OUTBOUND_DROPPED.labels(name) for name in LANE_NAMES]
+_REPLACED = OUTBOUND_SUPERSEDED.labels("replaced")
+_CANCELLED = OUTBOUND_SUPERSEDED.labels("stop")
+
+
+def lane_of(message_type) -> int:
+    """Lane of a command sent to a robot"""
+    if message_type in SAFETY_COMMAND_TYPES:
+        return SAFETY
+    if message_type in CONTROL_COMMAND_TYPES or message_type in SETPOINT_COMMAND_TYPES:
+        return CONTROL
+    return CONFIG
+
+
+def setpoint_interval(robot_id) -> float:
+    """Minimum seconds between two setpoints to a robot (SETPOINT_MAX_RATE), 0 = no limit"""
+    rate = SETPOINT_MAX_RATE.get(robot_id, SETPOINT_MAX_RATE.get("default", 0))
+    return 1.0 / rate if rate > 0 else 0.0
+
+
+def stream_sender(writer: asyncio.StreamWriter, high_water=OUTBOUND_HIGH_WATER,
+                  sndbuf=OUTBOUND_SNDBUF) -> Callable[[str], Awaitable[None]]:
+    """send() for a StreamWriter whose transport and socket buffer little ahead of the lanes"""
+    # Writers without a transport (ingest_capture replay) are sent to as they are
+    transport = getattr(writer, "transport", None)
+    if transport is not None:
+        transport.set_write_buffer_limits(high=high_water)
+    sock = writer.get_extra_info("socket")
+    if sndbuf and sock is not None:
+        # The kernel send buffer is FIFO too: keep it small so the lanes hold the backlog
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+    async def send(line):
+        writer.write(line.encode("utf-8"))
+        await writer.drain()
+    return send
+
+
+class CommandLanes:
+    __slots__ = ("name", "send", "queues", "bulk_max", "wakeup", "task", "closed",
+                 "setpoints", "min_interval", "setpoint_ready", "timer", "drain_waiter", "drain_level")
+
+    def __init__(self, name, send: Callable[[str], Awaitable[None]], bulk_max=OUTBOUND_BULK_MAX, min_interval=0.0):
+        self.name = name
+        self.send = send
+        self.queues = tuple(deque() for _ in LANE_NAMES)  # entries: [line, queued_at, setpoint key or None]
+        self.bulk_max = bulk_max
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.setpoints = {}  # robot_id -> its queued setpoint entry that may still be replaced
+        self.min_interval = min_interval  # between setpoints, see setpoint_interval()
+        self.setpoint_ready = 0.0  # perf_counter time the next setpoint may go out
+        self.timer = None
+        self.drain_waiter = None  # future of drained(), resolved by the writer task
+        self.drain_level = 0
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, line: str, lane=BULK) -> bool:
+        """Queue one message; False if the connection is already closed"""
+        if self.closed:
+            _DROPPED[lane].inc()
+            return False
+        queue = self.queues[lane]
+        if lane == BULK and len(queue) >= self.bulk_max:
+            queue.popleft()
+            _DROPPED[BULK].inc()
+        queue.append([line, time.perf_counter(), None])
+        self.wakeup.set()
+        return True
+
+    def put_command(self, line: str, message_type, robot_id=None) -> bool:
+        """Queue a command for a robot in the lane of its type, coalescing setpoints"""
+        lane = lane_of(message_type)
+        if lane == SAFETY:
+            self._cancel_setpoint(robot_id)
+        elif message_type in SETPOINT_COMMAND_TYPES:
+            if self.closed:
+                _DROPPED[CONTROL].inc()
+                return False
+            entry = self.setpoints.get(robot_id)
+            if entry is not None:
+                # Latest wins: the queued setpoint is obsolete, keep its place in the lane
+                entry[0] = line
+                _REPLACED.inc()
+                return True
+            entry = [line, time.perf_counter(), robot_id]
+            self.setpoints[robot_id] = entry
+            self.queues[CONTROL].append(entry)
+            self.wakeup.set()
+            return True
+        elif lane == CONTROL:
+            # A later setpoint must not jump ahead of this command
+            self.setpoints.pop(robot_id, None)
+        return self.put(line, lane)
+
+    def depth(self) -> dict:
+        return {name: len(queue) for name, queue in zip(LANE_NAMES, self.queues)}
+
+    async def drained(self, level):
+        """Wait until at most `level` messages are queued in the BULK lane (or the connection closed)"""
+        if self.closed or len(self.queues[BULK]) <= level:
+            return
+        self.drain_level = level
+        self.drain_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self.drain_waiter
+        finally:
+            self.drain_waiter = None
+
+    def close(self):
+        """Stop the writer task; whatever is still queued is dropped"""
+        if not self.closed:
+            self.closed = True
+            self.task.cancel()
+            if self.timer is not None:
+                self.timer.cancel()
+            self._drop_all()
+
+    async def _run(self):
+        queues = self.queues
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                # Highest non-empty lane first, re-checked after every send;
+                # a setpoint held back by the rate limit lets the lower lanes go
+                now = time.perf_counter()
+                for lane, queue in enumerate(queues):
+                    if not queue:
+                        continue
+                    if lane == CONTROL and queue[0][2] is not None and now < self.setpoint_ready:
+                        self._wake_at(self.setpoint_ready - now)
+                        continue
+                    break
+                else:
+                    break
+                line, queued_at, key = entry = queue.popleft()
+                if key is not None:
+                    if self.setpoints.get(key) is entry:
+                        del self.setpoints[key]
+                    self.setpoint_ready = now + self.min_interval
+                try:
+                    await self.send(line)
+                except Exception as e:
+                    logger.warning(f"Writer of {self.name} stopped: {e}")
+                    self.closed = True
+                    _DROPPED[lane].inc()
+                    self._drop_all()
+                    return
+                _QUEUE_SECONDS[lane].observe(time.perf_counter() - queued_at)
+                _SENT[lane].inc()
+                if lane == BULK and self.drain_waiter is not None and len(queue) <= self.drain_level:
+                    self._wake_drain()
+
+    def _wake_at(self, delay):
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(delay, self._timer_fired)
+
+    def _timer_fired(self):
+        self.timer = None
+        self.wakeup.set()
+
+    def _cancel_setpoint(self, robot_id):
+        entry = self.setpoints.pop(robot_id, None)
+        if entry is not None:
+            self.queues[CONTROL].remove(entry)
+            _CANCELLED.inc()
+
+    def _wake_drain(self):
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def _drop_all(self):
+        for lane, queue in enumerate(self.queues):
+            if queue:
+                _DROPPED[lane].inc(len(queue))
+                queue.clear()
+        self.setpoints.clear()
+        self._wake_drain()
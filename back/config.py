@@ -1,6 +1,7 @@
 # File cấu hình chung cho hệ thống
 
 import os
+import socket
 
 # Server configuration
 TCP_SERVER_HOST = "0.0.0.0"
@@ -21,9 +22,114 @@ BACKEND_PORT = 8000
 # Authentication
 API_KEY = "140504"  # Thay đổi thành một key bảo mật hơn
 
+# Thông số hình học robot cho động học (kinematics.py)
+# "default" được dùng cho mọi robot_id không có cấu hình riêng
+ROBOT_GEOMETRY = {
+    "default": {"wheel_radius": 0.03, "robot_radius": 0.153, "dt": 0.05},
+}
+
+# Thư mục lưu trữ telemetry dạng Parquet/Arrow (telemetry_archive.py)
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")
+
+# Nhật ký telemetry trên đĩa (telemetry_journal.py) - dữ liệu ingest được ghi vào đây trước khi vào DB
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal"))
+JOURNAL_SEGMENT_SIZE = 4 * 1024 * 1024  # bytes mỗi segment
+JOURNAL_RETAIN_SEGMENTS = 2  # số segment đã drain được giữ lại cho truy vấn gần đây
+JOURNAL_DRAIN_BATCH = 500  # số bản ghi mỗi lần ghi vào DB
+JOURNAL_DRAIN_INTERVAL = 0.2  # giây giữa các lần drain
+JOURNAL_QUARANTINE_ATTEMPTS = 5  # số lần một lô lỗi dữ liệu (không phải lỗi kết nối DB) được thử lại trước khi chuyển ra quarantine.jsonl
+
+# Cổng HTTP /metrics (metrics.py) của các server không có HTTP riêng
+TCP_SERVER_METRICS_PORT = int(os.environ.get("TCP_SERVER_METRICS_PORT", 9100))
+WS_BRIDGE_METRICS_PORT = int(os.environ.get("WS_BRIDGE_METRICS_PORT", 9101))
+
+# Tracing (tracing.py)
+TRACE_BUFFER_SIZE = 5000  # số span giữ trong ring buffer mỗi process
+TRACE_RESPONSE_TIMEOUT = 10.0  # giây chờ phản hồi của robot cho một lệnh
+
+# Giám sát event loop (loop_monitor.py)
+LOOP_MONITOR_INTERVAL = 0.05  # giây giữa hai lần đo độ trễ
+LOOP_LAG_THRESHOLD = 0.1  # loop bị chặn lâu hơn ngưỡng này thì ghi lại stack
+LOOP_MONITOR_MAX_SITES = 50  # số call site được giữ lại
+
+# Profiler theo yêu cầu (profiler.py)
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+PROFILE_MAX_SECONDS = 120  # giới hạn thời gian một lần lấy mẫu
+PROFILE_SIGNAL_SECONDS = 10  # thời gian lấy mẫu khi nhận SIGUSR1
+
+# Ingest nhiều process (ingest_workers.py): N worker cùng bind TCP_SERVER_PORT bằng SO_REUSEPORT
+TCP_WORKERS = int(os.environ.get("TCP_WORKERS", os.cpu_count() or 1))
+WORKER_BUS_PATH = os.environ.get("WORKER_BUS_PATH", "/tmp/robot_worker_bus.sock")  # Unix socket của bus giữa các worker
+TCP_WORKER_METRICS_BASE_PORT = int(os.environ.get("TCP_WORKER_METRICS_BASE_PORT", 9110))  # worker i: cổng 9110 + i
+
+# Nhiều node (ownership.py): lease robot được chia shard giữa các node bằng consistent hashing
+NODE_ID = os.environ.get("NODE_ID", socket.gethostname())
+NODE_LISTEN = os.environ.get("NODE_LISTEN", "")  # địa chỉ cho các node khác: "host:port" hoặc "unix:/path", rỗng = một node
+NODE_PEERS = os.environ.get("NODE_PEERS", "")  # "b=10.0.0.2:9200,c=unix:/tmp/c.sock"
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 10.0))  # giây; node không gửi heartbeat trong khoảng này thì mất quyền sở hữu robot
+HASH_RING_VNODES = 64  # số điểm ảo của mỗi node trên vòng hash
+NODE_METRICS_PORT = int(os.environ.get("NODE_METRICS_PORT", 9109))  # /metrics và /cluster của supervisor
+
+# Gateway một process (gateway.py)
+GATEWAY_CLIENT_QUEUE = 1000  # tin nhắn chờ gửi tối đa mỗi browser, đầy thì bỏ tin cũ nhất
+
+# Chuyển tiếp nguyên văn (message_peek.py): chỉ đọc type/robot_id rồi gửi đi dòng gốc, không json.loads + json.dumps
+TCP_PASSTHROUGH = os.environ.get("TCP_PASSTHROUGH", "1").strip() == "1"
+FULL_DECODE_TYPES = set(filter(None, os.environ.get("FULL_DECODE_TYPES", "registration").split(",")))  # các type luôn được decode đầy đủ
+
+# Tách dòng cho mọi socket reader (line_framer.py)
+LINE_MAX_BYTES = int(os.environ.get("LINE_MAX_BYTES", 1024 * 1024))  # dòng dài hơn bị bỏ, reader đồng bộ lại ở dấu xuống dòng kế tiếp
+
+# Frame nhiều mẫu (sample_batch.py): encoder_batch / imu_batch
+BATCH_MAX_SAMPLES = int(os.environ.get("BATCH_MAX_SAMPLES", 200))  # mẫu tối đa mỗi frame, phần thừa bị bỏ
+
+# Kênh telemetry UDP (udp_telemetry.py), token cấp khi robot đăng ký qua TCP
+UDP_TELEMETRY_PORT = int(os.environ.get("UDP_TELEMETRY_PORT", 0))  # 0 = tắt; worker i dùng port + i
+UDP_QUEUE_SIZE = int(os.environ.get("UDP_QUEUE_SIZE", 10000))  # datagram chờ xử lý tối đa, vượt quá thì bỏ
+UDP_RCVBUF = int(os.environ.get("UDP_RCVBUF", 4 * 1024 * 1024))  # SO_RCVBUF của socket UDP
+UDP_CHECK_SOURCE = os.environ.get("UDP_CHECK_SOURCE", "1").strip() == "1"  # chỉ nhận datagram từ IP của kết nối TCP
+
+# Hàng đợi gửi theo mức ưu tiên (command_lanes.py): safety > control > config > bulk (ack/heartbeat)
+SAFETY_COMMAND_TYPES = set(filter(None, os.environ.get("SAFETY_COMMAND_TYPES", "emergency_stop,stop").split(",")))
+CONTROL_COMMAND_TYPES = set(filter(None, os.environ.get(
+    "CONTROL_COMMAND_TYPES", "motor_control,motion_command,velocity_command,trajectory,execute_trajectory").split(",")))
+OUTBOUND_HIGH_WATER = int(os.environ.get("OUTBOUND_HIGH_WATER", 16 * 1024))  # byte chờ trong transport trước khi writer drain()
+OUTBOUND_SNDBUF = int(os.environ.get("OUTBOUND_SNDBUF", 32 * 1024))  # SO_SNDBUF của kết nối robot, 0 = mặc định của kernel
+OUTBOUND_BULK_MAX = int(os.environ.get("OUTBOUND_BULK_MAX", 10000))  # ack chờ tối đa mỗi kết nối, vượt quá thì bỏ ack cũ nhất
+
+# Gộp lệnh setpoint (command_lanes.py): lệnh chưa gửi bị thay bằng lệnh mới hơn của cùng robot
+SETPOINT_COMMAND_TYPES = set(filter(None, os.environ.get(
+    "SETPOINT_COMMAND_TYPES", "motor_control,motion_command,velocity_command").split(",")))
+# Số lệnh setpoint tối đa mỗi giây theo robot_id, "default" cho robot không có cấu hình riêng; 0 = không giới hạn
+SETPOINT_MAX_RATE = {
+    "default": float(os.environ.get("SETPOINT_MAX_RATE", 50)),
+}
+
+# Heartbeat và đóng kết nối không hoạt động (timer_wheel.py)
+TCP_IDLE_TIMEOUT = float(os.environ.get("TCP_IDLE_TIMEOUT", 300))  # giây không nhận gì (TCP hoặc UDP) thì đóng kết nối robot, 0 = không bao giờ
+
+# Registry kết nối của tcp_server (connection_registry.py)
+REGISTRY_INFO_MAX_BYTES = int(os.environ.get("REGISTRY_INFO_MAX_BYTES", 4096))  # dữ liệu đăng ký giữ lại tối đa mỗi kết nối (JSON)
+REGISTRY_EVENT_HISTORY = int(os.environ.get("REGISTRY_EVENT_HISTORY", 1000))  # số sự kiện kết nối/ngắt kết nối giữ cho /connections?since=
+
+# Giới hạn ingest theo kết nối và chế độ quá tải (ingest_guard.py)
+# Số tin tối đa mỗi giây theo robot_id, "default" cho robot không có cấu hình riêng; vượt quá thì tạm dừng đọc kết nối đó, 0 = không giới hạn
+INGEST_MAX_RATE = {
+    "default": float(os.environ.get("INGEST_MAX_RATE", 1000)),
+}
+INGEST_BURST_SECONDS = float(os.environ.get("INGEST_BURST_SECONDS", 1.0))  # token bucket chứa tối đa rate * giây này
+INGEST_PAUSE_QUEUE = int(os.environ.get("INGEST_PAUSE_QUEUE", 1000))  # ack chờ gửi cho robot vượt quá thì ngừng đọc robot đó tới khi còn một nửa, 0 = tắt
+INGEST_OVERLOAD_LAG = float(os.environ.get("INGEST_OVERLOAD_LAG", 0.1))  # độ trễ event loop (loop_monitor.py) để vào chế độ quá tải, 0 = tắt
+INGEST_OVERLOAD_HOLD = float(os.environ.get("INGEST_OVERLOAD_HOLD", 2.0))  # giây không còn trễ trước khi thoát chế độ quá tải
+# Khi quá tải: bỏ heartbeat, status trùng với status trước đó của robot, log vượt INGEST_LOG_RATE mỗi giây
+INGEST_HEARTBEAT_TYPES = set(filter(None, os.environ.get("INGEST_HEARTBEAT_TYPES", "heartbeat,ping,pong").split(",")))
+INGEST_STATUS_TYPES = set(filter(None, os.environ.get("INGEST_STATUS_TYPES", "status,robot_status").split(",")))
+INGEST_LOG_TYPES = set(filter(None, os.environ.get("INGEST_LOG_TYPES", "log").split(",")))
+INGEST_LOG_RATE = float(os.environ.get("INGEST_LOG_RATE", 5))
+
 # Logging configuration
 LOG_LEVEL = "INFO"
-LOG_FILE = "tcp_server.log"
+LOG_FILE = os.environ.get("LOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tcp_server.log"))  # đường dẫn tuyệt đối, không phụ thuộc thư mục chạy
 
 # Debug mode (set to False in production)
 DEBUG = True
\ No newline at end of file
@@ -0,0 +1,230 @@
+"""
+One registry for every connection tcp_server holds.
+
+tcp_server.py used to keep robots (legacy socket/WebSocket robots, sometimes
+a dict of status fields instead), tcp_robots, robot_data, clients (phones),
+backend_connections and bridge_connections side by side, guarded by
+threading locks although the asyncio server touches them from its one loop.
+Asking "is robot X connected", "which phones are connected" or "who is
+10.0.0.7:51234" meant checking several of them or scanning one in full.
+
+ConnectionRegistry keeps a Session per connection (__slots__, the
+registration data compacted to REGISTRY_INFO_MAX_BYTES) and three indexes,
+all O(1) to look up and update:
+
+    by robot_id      registry.get("robot1"), "robot1" in registry
+    by peer address  registry.by_peer("10.0.0.7:51234")
+    by device type   registry.of_type("phone"), registry.count("bridge")
+
+Connections without a robot_id (WebSocket bridges) are only in the last two.
+Registering a robot_id that is already connected replaces the old session;
+remove(robot_id, conn) only removes the session of that connection, so a
+connection that closes after its robot reconnected elsewhere leaves the new
+session alone.
+
+There is no lock: the registry belongs to the event loop that serves the
+connections. Code running on other threads (the legacy thread-per-robot
+server) goes through call_soon_threadsafe(). Every add/remove appends a
+change event (robot_connected / robot_disconnected) with a sequence number to
+a ring of REGISTRY_EVENT_HISTORY events; GET /connections on the metrics port
+returns the current sessions, and /connections?since=<seq> only the changes
+after seq, so status pages can poll without rebuilding the whole list.
+"""
+import json
+import time
+import asyncio
+import logging
+from collections import deque, Counter
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import metrics
+from config import REGISTRY_INFO_MAX_BYTES, REGISTRY_EVENT_HISTORY
+
+logger = logging.getLogger("connection_registry")
+
+REGISTRY_SESSIONS = metrics.gauge("registry_sessions", "Connections in the registry", ["device_type"])
+REGISTRY_EVENTS = metrics.counter("registry_events_total", "Registry change events", ["event"])
+REGISTRY_INFO_TRUNCATED = metrics.counter("registry_info_truncated_total",
+                                          "Registration fields not kept because of REGISTRY_INFO_MAX_BYTES")
+
+
+def compact_info(data, max_bytes=REGISTRY_INFO_MAX_BYTES) -> dict:
+    """The registration fields that fit in max_bytes of JSON, in their original order"""
+    if not isinstance(data, dict):
+        return {}
+    info = {}
+    used = 2
+    for key, value in data.items():
+        size = len(json.dumps({key: value}, default=str)) - 1
+        if used + size > max_bytes:
+            REGISTRY_INFO_TRUNCATED.inc()
+            continue
+        info[key] = value
+        used += size
+    return info
+
+
+class Session:
+    __slots__ = ("robot_id", "peer", "device_type", "transport", "conn", "lanes", "info", "backend",
+                 "connected_at", "last_seen", "messages")
+
+    def __init__(self, robot_id, peer, device_type, transport, conn, lanes, info):
+        self.robot_id = robot_id
+        self.peer = peer  # "host:port"
+        self.device_type = device_type
+        self.transport = transport  # "tcp" | "ws" | "socket"
+        self.conn = conn  # StreamWriter, websocket or socket.socket
+        self.lanes = lanes  # CommandLanes for transports that queue outbound messages
+        self.info = info
+        self.backend = None  # WebSocket to main.py for this robot, opened on first use
+        self.connected_at = time.time()
+        self.last_seen = self.connected_at
+        self.messages = 0
+
+    @property
+    def host(self):
+        return self.peer.rsplit(":", 1)[0] if self.peer else None
+
+    def to_dict(self) -> dict:
+        return {"robot_id": self.robot_id, "peer": self.peer, "device_type": self.device_type,
+                "transport": self.transport, "connected_at": self.connected_at, "last_seen": self.last_seen,
+                "messages": self.messages, "info": self.info}
+
+
+class ConnectionRegistry:
+    def __init__(self, history=REGISTRY_EVENT_HISTORY):
+        self._by_robot: Dict[str, Session] = {}
+        self._by_peer: Dict[str, Session] = {}
+        self._by_type: Dict[str, Dict[int, Session]] = {}
+        self._transports: Counter = Counter()
+        self.events: deque = deque(maxlen=history)
+        self.seq = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind_loop(self, loop=None):
+        """The loop that owns the registry (call_soon_threadsafe() schedules on it)"""
+        self.loop = loop or asyncio.get_running_loop()
+
+    def call_soon_threadsafe(self, callback: Callable[..., Any], *args):
+        """Run callback(*args) on the registry's loop, e.g. registry.add/remove from another thread"""
+        if self.loop is None or not self.loop.is_running():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    # === Changes ===
+
+    def add(self, robot_id, peer, transport, conn=None, lanes=None, info=None, device_type="robot") -> Session:
+        """Register a connection; an existing session of the same robot_id or peer is replaced"""
+        session = Session(robot_id, peer, device_type, transport, conn, lanes, compact_info(info))
+        if robot_id is not None and robot_id in self._by_robot:
+            self._discard(self._by_robot[robot_id], "robot_replaced")
+        if peer is not None and peer in self._by_peer:
+            self._discard(self._by_peer[peer], "robot_replaced")
+        if robot_id is not None:
+            self._by_robot[robot_id] = session
+        if peer is not None:
+            self._by_peer[peer] = session
+        self._by_type.setdefault(device_type, {})[id(session)] = session
+        self._transports[transport] += 1
+        REGISTRY_SESSIONS.labels(device_type).set(len(self._by_type[device_type]))
+        self._publish("robot_connected", session)
+        return session
+
+    def remove(self, robot_id, conn=None) -> Optional[Session]:
+        """Remove the session of robot_id (only if it belongs to conn when given); the removed session or None"""
+        session = self._by_robot.get(robot_id)
+        if session is None or (conn is not None and session.conn is not conn):
+            return None
+        self._discard(session, "robot_disconnected")
+        return session
+
+    def remove_peer(self, peer) -> Optional[Session]:
+        session = self._by_peer.get(peer)
+        if session is not None:
+            self._discard(session, "robot_disconnected")
+        return session
+
+    def _discard(self, session, event):
+        if session.robot_id is not None and self._by_robot.get(session.robot_id) is session:
+            del self._by_robot[session.robot_id]
+        if session.peer is not None and self._by_peer.get(session.peer) is session:
+            del self._by_peer[session.peer]
+        sessions = self._by_type.get(session.device_type)
+        if sessions is not None and sessions.pop(id(session), None) is not None:
+            self._transports[session.transport] -= 1
+            REGISTRY_SESSIONS.labels(session.device_type).set(len(sessions))
+            if not sessions:
+                del self._by_type[session.device_type]
+        self._publish(event, session)
+
+    def _publish(self, event, session):
+        self.seq += 1
+        self.events.append({"seq": self.seq, "type": event, "robot_id": session.robot_id, "peer": session.peer,
+                            "device_type": session.device_type, "timestamp": time.time()})
+        REGISTRY_EVENTS.labels(event).inc()
+
+    # === Lookups ===
+
+    def get(self, robot_id) -> Optional[Session]:
+        return self._by_robot.get(robot_id)
+
+    def by_peer(self, peer) -> Optional[Session]:
+        return self._by_peer.get(peer)
+
+    def of_type(self, device_type) -> List[Session]:
+        return list(self._by_type.get(device_type, {}).values())
+
+    def count(self, device_type=None, transport=None) -> int:
+        if transport is not None:
+            return self._transports[transport]
+        if device_type is not None:
+            return len(self._by_type.get(device_type, ()))
+        return sum(len(group) for group in self._by_type.values())
+
+    def robot_ids(self) -> List[str]:
+        return list(self._by_robot)
+
+    def __contains__(self, robot_id) -> bool:
+        return robot_id in self._by_robot
+
+    def __len__(self) -> int:
+        """Number of robots (sessions with a robot_id)"""
+        return len(self._by_robot)
+
+    def __iter__(self) -> Iterator[Session]:
+        """Sessions with a robot_id"""
+        return iter(list(self._by_robot.values()))
+
+    # === Status ===
+
+    def changes(self, since) -> Optional[List[dict]]:
+        """Events after sequence number since, None if some were already dropped from the ring"""
+        if since >= self.seq:
+            return []
+        if not self.events or self.events[0]["seq"] > since + 1:
+            return None
+        return [event for event in self.events if event["seq"] > since]
+
+    def snapshot(self, device_type=None) -> dict:
+        sessions = self.of_type(device_type) if device_type else [
+            session for group in self._by_type.values() for session in group.values()]
+        return {"seq": self.seq, "count": len(sessions),
+                "by_type": {name: len(group) for name, group in self._by_type.items()},
+                "sessions": [session.to_dict() for session in sessions]}
+
+    def endpoint(self, query):
+        """GET /connections[?type=phone][&since=seq]"""
+        if "since" in query:
+            try:
+                since = int(query["since"])
+            except ValueError:
+                since = -1
+            changes = self.changes(since) if since >= 0 else None
+            if changes is not None:
+                return "application/json", json.dumps({"seq": self.seq, "changes": changes}, default=str)
+            # Too old (or invalid): the client starts over from the full list
+        return "application/json", json.dumps(self.snapshot(query.get("type")), default=str)
+
+    def serve(self, path="/connections"):
+        metrics.add_endpoint(path, self.endpoint)
@@ -7,6 +7,12 @@ import logging
 import threading
 import os
 
+import metrics
+import loop_monitor
+import profiler
+from line_framer import LineFramer
+from command_lanes import CommandLanes, stream_sender, setpoint_interval
+
 # Configure logging
 logging.basicConfig(
     level=logging.DEBUG,
@@ -15,12 +21,22 @@ logging.basicConfig(
 logger = logging.getLogger("direct_bridge")
 
 # Global variables
-tcp_clients = {}  # robot_id -> socket
+tcp_clients = {}  # robot_id -> CommandLanes của kết nối robot
 ws_clients = {}   # client_id -> websocket
 
 # Đọc cấu hình port từ biến môi trường hoặc sử dụng mặc định
 TCP_PORT = int(os.environ.get("TCP_PORT", "9000"))
 WS_PORT = int(os.environ.get("WS_BRIDGE_PORT", "9003"))
+METRICS_PORT = int(os.environ.get("DIRECT_BRIDGE_METRICS_PORT", "9102"))
+
+# Cùng tên metric với tcp_server / ws_tcp_bridge để dashboard dùng chung được
+TCP_CONNECTIONS = metrics.gauge("tcp_connections", "Open TCP client connections")
+TCP_MESSAGES_RECEIVED = metrics.counter("tcp_messages_received_total", "Messages read from TCP clients", ["type"])
+TCP_PARSE_ERRORS = metrics.counter("tcp_parse_errors_total", "Lines that were not valid JSON")
+TCP_MESSAGE_SECONDS = metrics.histogram("tcp_message_seconds", "Time from parsing a message to sending its response")
+BRIDGE_CLIENTS = metrics.gauge("bridge_clients", "Connected frontend WebSocket clients")
+BRIDGE_FORWARDED = metrics.counter("bridge_forwarded_total", "Messages forwarded by the bridge", ["direction"])
+BRIDGE_FORWARD_ERRORS = metrics.counter("bridge_forward_errors_total", "Failed forwards", ["direction"])
 
 class DirectBridge:
     def __init__(self, tcp_port=TCP_PORT, ws_port=WS_PORT):
@@ -46,6 +62,10 @@ class DirectBridge:
         )
         logger.info(f"WebSocket server started on 0.0.0.0:{self.ws_port}")
         
+        await metrics.serve_metrics(port=METRICS_PORT)
+        loop_monitor.start_monitor()
+        profiler.install_signal_handler("direct_bridge")
+        
         # Keep servers running
         await asyncio.gather(
             self.tcp_server.serve_forever(),
@@ -58,6 +78,7 @@ class DirectBridge:
         client_id = f"{addr[0]}:{addr[1]}"
         robot_id = None
         logger.info(f"TCP client connected: {client_id}")
+        TCP_CONNECTIONS.inc()
         
         # Send welcome message
         welcome = {
@@ -68,31 +89,33 @@ class DirectBridge:
         writer.write((json.dumps(welcome) + "\n").encode())
         await writer.drain()
         
-        buffer = ""
+        # Ack và lệnh cho robot đi qua một writer task, lệnh dừng khẩn cấp được gửi trước
+        lanes = CommandLanes(client_id, stream_sender(writer))
+        framer = LineFramer()
         try:
             while True:
                 data = await reader.read(4096)
                 if not data:
                     break
                 
-                buffer += data.decode()
-                
                 # Process complete messages
-                while "\n" in buffer:
-                    message, buffer = buffer.split("\n", 1)
+                for message in framer.lines(data):
                     if not message.strip():
                         continue
                     
+                    started = time.perf_counter()
                     try:
                         # Parse JSON
                         msg = json.loads(message)
                         msg_type = msg.get("type", "unknown")
+                        TCP_MESSAGES_RECEIVED.labels(msg_type).inc()
                         
                         # Handle registration
                         if msg_type == "registration":
                             robot_id = msg.get("robot_id", "unknown")
                             logger.info(f"Robot registered: {robot_id}")
-                            tcp_clients[robot_id] = writer
+                            tcp_clients[robot_id] = lanes
+                            lanes.min_interval = setpoint_interval(robot_id)
                             
                             # Send confirmation
                             response = {
@@ -101,19 +124,19 @@ class DirectBridge:
                                 "status": "success",
                                 "timestamp": time.time()
                             }
-                            writer.write((json.dumps(response) + "\n").encode())
-                            await writer.drain()
+                            lanes.put(json.dumps(response) + "\n")
                         
                         # Forward other messages to WebSocket clients
                         elif robot_id:
                             logger.info(f"Forwarding from robot {robot_id} to all WebSocket clients: {msg_type}")
                             
                             # Send to all WebSocket clients
-                            for ws in ws_clients.values():
+                            for ws in list(ws_clients.values()):
                                 try:
                                     await ws.send(json.dumps(msg))
+                                    BRIDGE_FORWARDED.labels("to_client").inc()
                                 except:
-                                    pass
+                                    BRIDGE_FORWARD_ERRORS.labels("to_client").inc()
                             
                             # Send acknowledgment
                             response = {
@@ -122,9 +145,10 @@ class DirectBridge:
                                 "message_type": msg_type,
                                 "timestamp": time.time()
                             }
-                            writer.write((json.dumps(response) + "\n").encode())
-                            await writer.drain()
+                            lanes.put(json.dumps(response) + "\n")
+                        TCP_MESSAGE_SECONDS.observe(time.perf_counter() - started)
                     except json.JSONDecodeError:
+                        TCP_PARSE_ERRORS.inc()
                         logger.error(f"Invalid JSON from TCP client: {message}")
                     except Exception as e:
                         logger.error(f"Error processing TCP message: {e}")
@@ -132,8 +156,10 @@ class DirectBridge:
             logger.error(f"TCP client error: {e}")
         finally:
             # Clean up
-            if robot_id and robot_id in tcp_clients:
+            TCP_CONNECTIONS.dec()
+            if robot_id and tcp_clients.get(robot_id) is lanes:
                 del tcp_clients[robot_id]
+            lanes.close()
             writer.close()
             await writer.wait_closed()
             logger.info(f"TCP client disconnected: {client_id}")
@@ -145,6 +171,7 @@ class DirectBridge:
         
         # Add to clients
         ws_clients[client_id] = websocket
+        BRIDGE_CLIENTS.set(len(ws_clients))
         
         # Send welcome
         await websocket.send(json.dumps({
@@ -170,13 +197,14 @@ class DirectBridge:
                     
                     # Forward to robot
                     if robot_id in tcp_clients:
-                        # Get robot writer
-                        robot_writer = tcp_clients[robot_id]
+                        # Get robot lanes
+                        robot_lanes = tcp_clients[robot_id]
                         
                         # Forward message
                         try:
-                            robot_writer.write((json.dumps(msg) + "\n").encode())
-                            await robot_writer.drain()
+                            if not robot_lanes.put_command(json.dumps(msg) + "\n", msg_type, robot_id):
+                                raise ConnectionError("connection closed")
+                            BRIDGE_FORWARDED.labels("to_robot").inc()
                             logger.info(f"Forwarded to robot {robot_id}: {msg_type}")
                             
                             # Send acknowledgment
@@ -187,6 +215,7 @@ class DirectBridge:
                                 "timestamp": time.time()
                             }))
                         except Exception as e:
+                            BRIDGE_FORWARD_ERRORS.labels("to_robot").inc()
                             logger.error(f"Error forwarding to robot {robot_id}: {e}")
                             await websocket.send(json.dumps({
                                 "type": "error",
@@ -215,6 +244,7 @@ class DirectBridge:
             # Clean up
             if client_id in ws_clients:
                 del ws_clients[client_id]
+            BRIDGE_CLIENTS.set(len(ws_clients))
 
 # Main function
 async def main():
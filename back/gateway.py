@@ -0,0 +1,184 @@
+"""
+Single-process gateway: robot TCP ingest and frontend WebSocket in one event loop.
+
+In the split deployment a robot message goes tcp_server -> WebSocket to
+ws_tcp_bridge (/tcp_server) -> every browser: it is serialized by tcp_server,
+parsed again by the bridge, serialized once more and crosses an extra loopback
+socket. Here tcp_server (handle_tcp_client, journal, tracing, worker bus) runs
+unchanged, but its frontend link is a LocalBus: the message dict is published
+in-process, serialized once, and queued to each browser connection. Commands
+from browsers call tcp_server.dispatch_command directly.
+
+Each browser has its own bounded queue and sender task, so a slow browser
+loses its oldest messages instead of stalling ingest for everyone.
+
+    python gateway.py      robots on localhost:9000, browsers on ws://0.0.0.0:9003
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Dict
+
+import websockets
+
+import metrics
+import tracing
+import tcp_server
+from config import GATEWAY_CLIENT_QUEUE
+
+logger = logging.getLogger("gateway")
+
+WS_HOST = os.environ.get("WS_BRIDGE_HOST", "0.0.0.0")
+WS_PORT = int(os.environ.get("WS_BRIDGE_PORT", 9003))
+
+# Cùng tên metric với ws_tcp_bridge để dashboard dùng chung được
+BRIDGE_CLIENTS = metrics.gauge("bridge_clients", "Connected frontend WebSocket clients")
+BRIDGE_RECEIVED = metrics.counter("bridge_messages_received_total", "Messages received by the bridge", ["source"])
+BRIDGE_PARSE_ERRORS = metrics.counter("bridge_parse_errors_total", "Invalid JSON messages", ["source"])
+BRIDGE_FORWARDED = metrics.counter("bridge_forwarded_total", "Messages forwarded by the bridge", ["direction"])
+BRIDGE_FORWARD_ERRORS = metrics.counter("bridge_forward_errors_total", "Failed forwards", ["direction"])
+BRIDGE_FANOUT_SECONDS = metrics.histogram("bridge_fanout_seconds", "Time to send one tcp_server message to all clients")
+BRIDGE_COMMAND_SECONDS = metrics.histogram("bridge_command_seconds", "Time to forward one frontend command to tcp_server", ["path"])
+GATEWAY_DROPPED = metrics.counter("gateway_dropped_total", "Messages dropped because a browser queue was full")
+
+
+class LocalBus:
+    """In-process pub/sub from the robot side to the browser connections"""
+
+    def __init__(self, queue_size=GATEWAY_CLIENT_QUEUE):
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, asyncio.Queue] = {}
+
+    def subscribe(self, client_id) -> asyncio.Queue:
+        queue = self.subscribers[client_id] = asyncio.Queue(self.queue_size)
+        return queue
+
+    def unsubscribe(self, client_id):
+        self.subscribers.pop(client_id, None)
+
+    def publish(self, data: dict):
+        started = time.perf_counter()
+        fanout_start = time.time()
+        # Span đã nằm trong recorder của chính process này, không gửi cho frontend
+        data.pop(tracing.SPANS_KEY, None)
+        if isinstance(data.get("ts"), dict):
+            data["ts"]["bridge"] = time.time()
+        self._enqueue(json.dumps(data))  # một lần cho mọi browser
+        BRIDGE_FANOUT_SECONDS.observe(time.perf_counter() - started)
+        if data.get(tracing.TRACE_KEY):
+            tracing.RECORDER.record(data[tracing.TRACE_KEY], "bridge.fanout", fanout_start, type=data.get("type"),
+                                    clients=len(self.subscribers))
+
+    def publish_raw(self, text: str):
+        """Dòng JSON của robot được chuyển nguyên văn (tcp_server không decode nó)"""
+        started = time.perf_counter()
+        self._enqueue(text)
+        BRIDGE_FANOUT_SECONDS.observe(time.perf_counter() - started)
+
+    def _enqueue(self, text):
+        for queue in list(self.subscribers.values()):
+            if queue.full():
+                queue.get_nowait()
+                GATEWAY_DROPPED.inc()
+            queue.put_nowait(text)
+
+
+class Gateway:
+    def __init__(self, ws_host=WS_HOST, ws_port=WS_PORT):
+        self.ws_host = ws_host
+        self.ws_port = ws_port
+        self.bus = LocalBus()
+        self.ws_server = None
+
+    async def start(self):
+        """Start the frontend WebSocket listener, then tcp_server with the local bus as its frontend link"""
+        tcp_server.local_bus = self.bus
+        self.ws_server = await websockets.serve(self.handle_frontend, self.ws_host, self.ws_port,
+                                                ping_interval=30, ping_timeout=10)
+        logger.info(f"Gateway WebSocket listener on {self.ws_host}:{self.ws_port}")
+        await tcp_server.start_server(connect_bridge=False)
+
+    async def _sender(self, websocket, queue):
+        while True:
+            text = await queue.get()
+            try:
+                await websocket.send(text)
+                BRIDGE_FORWARDED.labels("to_client").inc()
+            except websockets.exceptions.ConnectionClosed:
+                BRIDGE_FORWARD_ERRORS.labels("to_client").inc()
+                return
+
+    async def handle_frontend(self, websocket):
+        client_id = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
+        logger.info(f"[GW] Kết nối mới từ {client_id}")
+        queue = self.bus.subscribe(client_id)
+        BRIDGE_CLIENTS.set(len(self.bus.subscribers))
+        sender = asyncio.create_task(self._sender(websocket, queue))
+        try:
+            await websocket.send(json.dumps({
+                "type": "heartbeat",
+                "robot_id": "websocket_bridge",
+                "source": "ws_bridge",
+                "timestamp": time.time()
+            }))
+            async for message_text in websocket:
+                BRIDGE_RECEIVED.labels("frontend").inc()
+                started = time.perf_counter()
+                received_at = time.time()
+                try:
+                    message = json.loads(message_text)
+                except json.JSONDecodeError:
+                    BRIDGE_PARSE_ERRORS.labels("frontend").inc()
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "status": "invalid_json",
+                        "message": "Định dạng JSON không hợp lệ",
+                        "timestamp": time.time()
+                    }))
+                    continue
+
+                # Như ws_tcp_bridge: trace id, timestamp, robot_id và cờ frontend
+                trace_id = tracing.ensure_trace_id(message)
+                message.setdefault("timestamp", received_at)
+                message.setdefault("robot_id", "unknown")
+                message.setdefault("frontend", True)
+
+                ack = await tcp_server.dispatch_command(message, received_at)
+                BRIDGE_COMMAND_SECONDS.labels("gateway").observe(time.perf_counter() - started)
+                tracing.RECORDER.record(trace_id, "bridge.receive", received_at, type=message.get("type"),
+                                        robot_id=message.get("robot_id"), path="gateway")
+                if ack is None:
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "status": "not_found",
+                        "robot_id": message["robot_id"],
+                        "message": f"Robot {message['robot_id']} not connected",
+                        "timestamp": time.time()
+                    }))
+                else:
+                    # Ack đến mọi browser, giống khi đi qua bridge
+                    if ack.get("type") == "command_sent":
+                        BRIDGE_FORWARDED.labels("to_robot").inc()
+                    else:
+                        BRIDGE_FORWARD_ERRORS.labels("to_robot").inc()
+                    self.bus.publish(ack)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.bus.unsubscribe(client_id)
+            BRIDGE_CLIENTS.set(len(self.bus.subscribers))
+            sender.cancel()
+            logger.info(f"[GW] Client {client_id} đã ngắt kết nối")
+
+
+async def main():
+    await Gateway().start()
+
+
+if __name__ == "__main__":
+    print("Starting gateway - robot TCP ingest and frontend WebSocket in one process")
+    print("Use localhost:9000 for robots (TCP)")
+    print(f"Use ws://localhost:{WS_PORT} for frontend (WebSocket)")
+    asyncio.run(main())
@@ -0,0 +1,379 @@
+"""
+Record and replay of the TCP ingest path.
+
+Capture: when the TCP_CAPTURE_FILE environment variable is set, tcp_server
+records every inbound frame (one JSON line) with its arrival time and
+connection number, plus connection open/close events, to a compact binary file.
+
+Replay: feeds a capture back at 1x, Nx or maximum speed, either over TCP to a
+running server or directly into tcp_server.handle_tcp_client (no sockets).
+Connections are multiplexed on one event loop, and --clone N adds N copies of
+every captured robot (robot_id suffixed) to scale the load. Error responses,
+handler exceptions and connections that got no response at all count as
+errors; replay exits with status 1 if there were any.
+
+File format: the magic b"OMNICAP1", then records
+    <kind:uint8><conn:uint32><timestamp:float64><length:uint32><payload>
+kind is OPEN (payload = peer address), FRAME or CLOSE.
+
+Usage:
+    TCP_CAPTURE_FILE=capture.bin python tcp_server.py
+    python ingest_capture.py info capture.bin
+    python ingest_capture.py replay capture.bin --mode tcp --speed 4 --clone 10
+    python ingest_capture.py replay capture.bin --mode direct --speed 0
+"""
+import sys
+import json
+import time
+import struct
+import asyncio
+import logging
+import argparse
+import threading
+from collections import deque
+from typing import Dict, Iterator, List, Tuple
+
+logger = logging.getLogger("ingest_capture")
+
+MAGIC = b"OMNICAP1"
+RECORD = struct.Struct("<BIdI")
+OPEN, FRAME, CLOSE = 0, 1, 2
+
+
+# === CAPTURE ===
+
+class CaptureWriter:
+    """Thread-safe, buffered writer of capture records"""
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.next_conn = 0
+        self.frames = 0
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+
+    def _write(self, kind, conn, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.file.write(RECORD.pack(kind, conn, timestamp, len(payload)))
+            self.file.write(payload)
+            if timestamp - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = timestamp
+
+    def open(self, peer="") -> int:
+        """Register a new connection, returns its capture number"""
+        with self.lock:
+            conn = self.next_conn
+            self.next_conn += 1
+        self._write(OPEN, conn, str(peer).encode("utf-8"))
+        return conn
+
+    def frame(self, conn, payload, timestamp=None):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self._write(FRAME, conn, payload, timestamp)
+        self.frames += 1
+
+    def close_conn(self, conn):
+        self._write(CLOSE, conn, b"")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path) -> Iterator[Tuple[int, int, float, bytes]]:
+    """Yield (kind, conn, timestamp, payload) records, a truncated tail is ignored"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, conn, timestamp, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield kind, conn, timestamp, payload
+
+
+def load_sessions(path, clone=0) -> List[dict]:
+    """
+    Group a capture into per-connection sessions
+
+    Returns:
+        List of {"peer", "frames": [(offset_seconds, payload)]}, offsets relative
+        to the first record of the capture
+    """
+    sessions: Dict[int, dict] = {}
+    start = None
+    for kind, conn, timestamp, payload in read_capture(path):
+        if start is None:
+            start = timestamp
+        if kind == OPEN:
+            sessions[conn] = {"peer": payload.decode("utf-8", errors="replace"), "frames": []}
+        elif kind == FRAME:
+            sessions.setdefault(conn, {"peer": "", "frames": []})["frames"].append((timestamp - start, payload))
+
+    result = [s for s in sessions.values() if s["frames"]]
+    captured = list(result)
+    for copy in range(1, clone + 1):
+        for session in captured:
+            result.append({"peer": f"{session['peer']}#{copy}",
+                           "frames": [(t, _rename_robot(p, copy)) for t, p in session["frames"]]})
+    return result
+
+
+def _rename_robot(payload, copy):
+    """Give a cloned session its own robot_id"""
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return payload
+    if isinstance(data, dict):
+        for key in ("robot_id", "id"):
+            if key in data:
+                data[key] = f"{data[key]}-c{copy}"
+    return json.dumps(data).encode("utf-8")
+
+
+def summarize(path) -> dict:
+    connections = set()
+    frames = 0
+    nbytes = 0
+    first = last = None
+    types: Dict[str, int] = {}
+    for kind, conn, timestamp, payload in read_capture(path):
+        first = timestamp if first is None else first
+        last = timestamp
+        connections.add(conn)
+        if kind == FRAME:
+            frames += 1
+            nbytes += len(payload)
+            try:
+                msg_type = json.loads(payload).get("type", "unknown")
+            except (ValueError, AttributeError):
+                msg_type = "invalid"
+            types[msg_type] = types.get(msg_type, 0) + 1
+    duration = (last - first) if first is not None else 0.0
+    return {"connections": len(connections), "frames": frames, "bytes": nbytes,
+            "duration_seconds": duration, "frames_per_second": frames / duration if duration > 0 else 0.0,
+            "types": types}
+
+
+# === REPLAY ===
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class ReplayStats:
+    def __init__(self):
+        self.sent = 0
+        self.acks = 0
+        self.errors = 0
+        self.failed_sessions = 0
+        self.latencies: List[float] = []
+
+    def failed(self, session, error=None):
+        """A session that crashed the handler or got no response at all counts as an error"""
+        self.failed_sessions += 1
+        self.errors += 1
+        logger.error(f"Replay of connection {session['peer']} failed: {error or 'no responses'}")
+
+    def report(self, elapsed) -> dict:
+        ms = [v * 1000 for v in self.latencies]
+        return {
+            "frames_sent": self.sent,
+            "responses": self.acks,
+            "errors": self.errors,
+            "failed_sessions": self.failed_sessions,
+            "seconds": elapsed,
+            "frames_per_second": self.sent / elapsed if elapsed > 0 else 0.0,
+            "latency_ms": {"p50": _percentile(ms, 50), "p90": _percentile(ms, 90),
+                           "p99": _percentile(ms, 99), "max": max(ms) if ms else 0.0},
+        }
+
+
+async def _pace(start, offset, speed):
+    """Sleep until the frame's (scaled) capture time, speed 0 = no pacing"""
+    if speed <= 0:
+        return
+    delay = start + offset / speed - time.perf_counter()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def _read_responses(reader, pending: deque, stats: ReplayStats):
+    """Every frame gets one response line; match them in order for latency"""
+    await reader.readline()  # welcome
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        stats.acks += 1
+        if b'"error"' in line:
+            stats.errors += 1
+        if pending:
+            stats.latencies.append(time.perf_counter() - pending.popleft())
+
+
+async def _replay_session_tcp(session, host, port, start, speed, stats):
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        stats.failed(session, e)
+        return
+    pending = deque()
+    responses = asyncio.create_task(_read_responses(reader, pending, stats))
+    try:
+        for offset, payload in session["frames"]:
+            await _pace(start, offset, speed)
+            pending.append(time.perf_counter())
+            writer.write(payload + b"\n")
+            await writer.drain()
+            stats.sent += 1
+        # Give outstanding responses a moment to arrive
+        for _ in range(50):
+            if not pending:
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        responses.cancel()
+        writer.close()
+    if pending and len(pending) == len(session["frames"]):
+        stats.failed(session)
+
+
+class _DirectWriter:
+    """Minimal StreamWriter stand-in that records response lines"""
+
+    def __init__(self, peer, on_line):
+        self.peer = peer
+        self.on_line = on_line
+        self.closed = False
+
+    def get_extra_info(self, name, default=None):
+        return self.peer if name == "peername" else default
+
+    def write(self, data):
+        for _ in range(data.count(b"\n")):
+            self.on_line(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+async def _replay_session_direct(session, handler, index, start, speed, stats):
+    reader = asyncio.StreamReader()
+    pending = deque()
+    welcome = [True]
+
+    def on_line(data):
+        if welcome[0]:
+            welcome[0] = False
+            return
+        stats.acks += 1
+        if b'"error"' in data:
+            stats.errors += 1
+        if pending:
+            stats.latencies.append(time.perf_counter() - pending.popleft())
+
+    task = asyncio.create_task(handler(reader, _DirectWriter(("replay", index), on_line)))
+    for offset, payload in session["frames"]:
+        await _pace(start, offset, speed)
+        pending.append(time.perf_counter())
+        reader.feed_data(payload + b"\n")
+        stats.sent += 1
+        # Let the handler run so latency reflects processing, not queueing in the reader
+        await asyncio.sleep(0)
+    reader.feed_eof()
+    try:
+        await task
+    except Exception as e:
+        stats.failed(session, e)
+        return
+    # handle_tcp_client logs its own exceptions and returns, so a crash shows as silence
+    if pending and len(pending) == len(session["frames"]):
+        stats.failed(session)
+
+
+async def replay(path, mode="tcp", host="localhost", port=9000, speed=1.0, clone=0, handler=None) -> dict:
+    """
+    Replay a capture
+
+    Args:
+        mode: "tcp" to connect to a running server, "direct" to call the handler in-process
+        speed: Time scale (1 = real time, 4 = 4x faster, 0 = as fast as possible)
+        clone: Extra copies of every session with renamed robot_ids
+        handler: Coroutine (reader, writer) for direct mode, tcp_server.handle_tcp_client by default
+
+    Returns:
+        Throughput and response latency report
+    """
+    sessions = load_sessions(path, clone)
+    stats = ReplayStats()
+    if mode == "direct" and handler is None:
+        import tcp_server
+        handler = tcp_server.handle_tcp_client
+
+    start = time.perf_counter()
+    if mode == "tcp":
+        await asyncio.gather(*(_replay_session_tcp(s, host, port, start, speed, stats) for s in sessions))
+    else:
+        await asyncio.gather(*(_replay_session_direct(s, handler, i, start, speed, stats)
+                               for i, s in enumerate(sessions)))
+    report = stats.report(time.perf_counter() - start)
+    report.update({"mode": mode, "speed": speed, "sessions": len(sessions)})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and replay TCP ingest captures')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    info = sub.add_parser('info', help='Summarize a capture')
+    info.add_argument('file')
+
+    rep = sub.add_parser('replay', help='Replay a capture')
+    rep.add_argument('file')
+    rep.add_argument('--mode', choices=['tcp', 'direct'], default='tcp', help='Replay target (default: tcp)')
+    rep.add_argument('--host', default='localhost')
+    rep.add_argument('--port', type=int, default=9000)
+    rep.add_argument('--speed', type=float, default=1.0, help='Speed factor, 0 = max speed (default: 1)')
+    rep.add_argument('--clone', type=int, default=0, help='Extra copies of every robot (default: 0)')
+    rep.add_argument('--output', help='Write the JSON report to this file')
+
+    args = parser.parse_args()
+    if args.command == 'info':
+        print(json.dumps(summarize(args.file), indent=2))
+        return
+
+    logging.basicConfig(level=logging.WARNING)
+    report = asyncio.run(replay(args.file, args.mode, args.host, args.port, args.speed, args.clone))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if report["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
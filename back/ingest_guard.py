@@ -0,0 +1,265 @@
+"""
+Per-connection admission control for tcp_server.
+
+handle_tcp_client used to read whatever a robot wrote as fast as it arrived
+and do the full work (journal, forward, ack) for every line, so one robot
+flooding the server took event-loop time from every other robot.
+
+One IngestGuard per connection sits in front of that work:
+
+- Token bucket: INGEST_MAX_RATE messages per second per robot, with a burst of
+  INGEST_BURST_SECONDS worth. Nothing is dropped for going over the rate.
+  Before the next read the guard sleeps for the deficit, so unread bytes stay
+  in the socket buffers and TCP flow control slows the robot down.
+- Downstream queue: when more than INGEST_PAUSE_QUEUE acks wait in the
+  connection's BULK lane (command_lanes.py) because the robot is not reading,
+  the guard stops reading from it until half of them have gone out.
+- Overload mode, process-wide: entered when the event-loop lag seen by
+  loop_monitor reaches INGEST_OVERLOAD_LAG, left INGEST_OVERLOAD_HOLD seconds
+  after it comes back down. While overloaded, low-value lines are shed before
+  they are journaled or forwarded:
+    - heartbeats;
+    - a status identical to the robot's previous one (timestamps aside);
+    - log lines beyond INGEST_LOG_RATE per second.
+  A shed line is answered with a constant data_ack with status "shed", so
+  robots that match acks to messages stay in step.
+
+Registration, safety commands (SAFETY_COMMAND_TYPES) and frontend commands are
+never shed and use no tokens.
+
+Shed lines and pauses are counted per robot. They are exposed by GET /ingest
+on the metrics port (also for the last 100 closed connections that had any)
+and by ingest_shed_total{reason} and ingest_paused_seconds_total{reason}. /ingest?overload=on|off|auto&key=API_KEY
+forces the mode, e.g. for testing.
+"""
+import re
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Optional
+
+import metrics
+from loop_monitor import monitor
+from command_lanes import BULK
+from config import (API_KEY, SAFETY_COMMAND_TYPES, INGEST_MAX_RATE, INGEST_BURST_SECONDS, INGEST_PAUSE_QUEUE,
+                    INGEST_OVERLOAD_LAG, INGEST_OVERLOAD_HOLD, INGEST_HEARTBEAT_TYPES, INGEST_STATUS_TYPES,
+                    INGEST_LOG_TYPES, INGEST_LOG_RATE)
+
+logger = logging.getLogger("ingest_guard")
+
+INGEST_SHED = metrics.counter("ingest_shed_total", "Lines dropped in overload mode", ["reason"])
+INGEST_PAUSED = metrics.counter("ingest_paused_seconds_total", "Time connection readers were paused", ["reason"])
+INGEST_OVERLOADED = metrics.gauge("ingest_overloaded", "1 while low-value traffic is shed")
+INGEST_OVERLOAD_EPISODES = metrics.counter("ingest_overload_episodes_total", "Times overload mode was entered")
+
+# Never shed, never rate limited
+EXEMPT_TYPES = {"registration"} | SAFETY_COMMAND_TYPES
+
+# Timestamps differ between otherwise identical status messages
+_TIMESTAMPS = re.compile(r'"(?:timestamp|ts)"\s*:\s*(?:\{[^{}]*\}|[-+0-9.eE]+)')
+_SHED_ACKS: Dict[str, str] = {}
+
+
+def ingest_rate(robot_id) -> float:
+    """Messages per second allowed from a robot (INGEST_MAX_RATE), 0 = no limit"""
+    return INGEST_MAX_RATE.get(robot_id, INGEST_MAX_RATE.get("default", 0))
+
+
+def shed_ack(msg_type) -> str:
+    """Response line for a shed message, serialized once per type"""
+    line = _SHED_ACKS.get(msg_type)
+    if line is None:
+        line = json.dumps({"type": "data_ack", "status": "shed", "message_type": msg_type}) + "\n"
+        if len(_SHED_ACKS) < 256:  # types come from the network
+            _SHED_ACKS[msg_type] = line
+    return line
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def charge(self):
+        """Use one token even if none is left (refilled lazily by deficit())"""
+        self.tokens -= 1
+
+    def deficit(self, now) -> float:
+        """Seconds until the bucket is no longer in debt"""
+        self._refill(now)
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Overload:
+    """Overload mode of the process, driven by event-loop lag"""
+
+    def __init__(self, lag=INGEST_OVERLOAD_LAG, hold=INGEST_OVERLOAD_HOLD):
+        self.lag = lag
+        self.hold = hold
+        self.active = False
+        self.forced = None  # True/False from /ingest, None = automatic
+        self.since = None
+        self.calm_since = None
+        self.episodes = 0
+
+    def check(self) -> bool:
+        if self.forced is not None:
+            return self.forced
+        if not self.lag:
+            return False
+        now = time.monotonic()
+        # Last lag measured, or the stall in progress if the ticker is overdue
+        lag = monitor.recent[-1] if monitor.recent else 0.0
+        if monitor.running:
+            lag = max(lag, now - monitor.last_tick - monitor.interval)
+        if lag >= self.lag:
+            self.calm_since = None
+            if not self.active:
+                self._set(True, now, lag)
+        elif self.active:
+            if self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since >= self.hold:
+                self._set(False, now, lag)
+        return self.active
+
+    def _set(self, active, now, lag):
+        self.active = active
+        INGEST_OVERLOADED.set(1 if active else 0)
+        if active:
+            self.since = now
+            self.episodes += 1
+            INGEST_OVERLOAD_EPISODES.inc()
+            logger.warning(f"Overload mode on (event loop lag {lag * 1000:.0f} ms): shedding heartbeats, "
+                           f"duplicate status and excess log lines")
+        else:
+            logger.warning(f"Overload mode off after {now - self.since:.1f} s")
+            self.since = self.calm_since = None
+
+
+OVERLOAD = Overload()
+GUARDS: Dict[str, "IngestGuard"] = {}
+# Counts of the last connections that were shed or paused before they closed
+CLOSED = deque(maxlen=100)
+
+
+class IngestGuard:
+    __slots__ = ("name", "robot_id", "lanes", "bucket", "log_bucket", "last_status", "overloaded", "shed", "paused")
+
+    def __init__(self, name, lanes):
+        self.name = name
+        self.robot_id = None
+        self.lanes = lanes
+        self.bucket = None
+        self.log_bucket = TokenBucket(INGEST_LOG_RATE, max(1.0, INGEST_LOG_RATE))
+        self.last_status = None
+        self.overloaded = False
+        self.shed: Dict[str, int] = {}
+        self.paused: Dict[str, float] = {}
+        self.set_robot(None)
+        GUARDS[name] = self
+
+    def set_robot(self, robot_id):
+        """Apply the rate of the robot that registered on this connection"""
+        self.robot_id = robot_id
+        rate = ingest_rate(robot_id)
+        self.bucket = TokenBucket(rate, max(1.0, rate * INGEST_BURST_SECONDS)) if rate > 0 else None
+
+    def close(self):
+        if GUARDS.get(self.name) is self:
+            del GUARDS[self.name]
+            if self.shed or self.paused:
+                CLOSED.append(self.to_dict())
+
+    async def pace(self):
+        """Before each read: wait out the token deficit and a full ack queue"""
+        if self.bucket is not None:
+            wait = self.bucket.deficit(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                self._paused("rate", wait)
+        if INGEST_PAUSE_QUEUE and len(self.lanes.queues[BULK]) > INGEST_PAUSE_QUEUE:
+            started = time.monotonic()
+            await self.lanes.drained(INGEST_PAUSE_QUEUE // 2)
+            self._paused("queue", time.monotonic() - started)
+        self.overloaded = OVERLOAD.check()
+
+    def admit(self, msg_type, message) -> Optional[str]:
+        """None if the line is to be processed, otherwise the reason it is shed"""
+        if msg_type in EXEMPT_TYPES or '"frontend"' in message:
+            return None
+        if self.overloaded:
+            reason = None
+            if msg_type in INGEST_HEARTBEAT_TYPES:
+                reason = "heartbeat"
+            elif msg_type in INGEST_STATUS_TYPES:
+                status = _TIMESTAMPS.sub("", message)
+                if status == self.last_status:
+                    reason = "duplicate_status"
+                self.last_status = status
+            elif msg_type in INGEST_LOG_TYPES and not self.log_bucket.take(time.monotonic()):
+                reason = "log"
+            if reason is not None:
+                self.shed[reason] = self.shed.get(reason, 0) + 1
+                INGEST_SHED.labels(reason).inc()
+                return reason
+        if self.bucket is not None:
+            self.bucket.charge()
+        return None
+
+    def _paused(self, reason, seconds):
+        self.paused[reason] = self.paused.get(reason, 0.0) + seconds
+        INGEST_PAUSED.labels(reason).inc(seconds)
+
+    def to_dict(self) -> dict:
+        return {"robot_id": self.robot_id, "connection": self.name, "shed": self.shed,
+                "paused_seconds": {reason: round(seconds, 3) for reason, seconds in self.paused.items()},
+                "rate": self.bucket.rate if self.bucket is not None else 0,
+                "ack_queue": len(self.lanes.queues[BULK])}
+
+
+def stats(robot_id=None) -> dict:
+    guards = [guard for guard in GUARDS.values() if robot_id is None or guard.robot_id == robot_id]
+    return {
+        "overloaded": OVERLOAD.active if OVERLOAD.forced is None else OVERLOAD.forced,
+        "forced": OVERLOAD.forced,
+        "episodes": OVERLOAD.episodes,
+        "lag_threshold_ms": OVERLOAD.lag * 1000,
+        "connections": len(GUARDS),
+        # Only robots that were shed or paused, the list stays short
+        "robots": {guard.robot_id or guard.name: guard.to_dict() for guard in guards
+                   if guard.shed or guard.paused or robot_id is not None},
+        "closed": [entry for entry in CLOSED if robot_id is None or entry["robot_id"] == robot_id],
+    }
+
+
+def _endpoint(query):
+    """GET /ingest[?robot_id=...][&overload=on|off|auto&key=API_KEY]"""
+    mode = query.get("overload")
+    if mode is not None:
+        if query.get("key") != API_KEY:
+            return "application/json", json.dumps({"error": "invalid key"})
+        OVERLOAD.forced = {"on": True, "off": False}.get(mode)
+        INGEST_OVERLOADED.set(1 if OVERLOAD.check() else 0)
+        logger.warning(f"Overload mode set to {mode} from /ingest")
+    return "application/json", json.dumps(stats(query.get("robot_id")))
+
+
+metrics.add_endpoint("/ingest", _endpoint)
@@ -0,0 +1,174 @@
+"""
+Multi-process TCP ingest.
+
+tcp_server handles every robot on one event loop in one process, so ingest
+stops scaling at one core. This supervisor starts N tcp_server workers that
+each bind TCP_SERVER_PORT with SO_REUSEPORT; the kernel spreads incoming robot
+connections across them. The shared robot registry lives in the supervisor
+(worker_bus.BusHub): workers publish registrations and disconnects to it, and
+a command that the bridge hands to a worker not holding the robot is routed
+through the bus to the worker that does.
+
+Every worker connects to the WS bridge, keeps its own metrics port
+(TCP_WORKER_METRICS_BASE_PORT + worker id) and its own journal
+(<JOURNAL_DIR>-worker<i>). Journals that no running worker owns (the
+single-process journal, or workers beyond N after scaling down) are drained
+by the supervisor.
+
+Several supervisors form a cluster when given --listen and --peers: the hub
+of each node then shares robot ownership with the others (ownership.py) and
+commands reach robots connected to any node. The supervisor serves
+GET /metrics and GET /cluster on NODE_METRICS_PORT.
+
+    python ingest_workers.py --workers 4
+    python ingest_workers.py --node-id a --listen 127.0.0.1:9201 --peers b=127.0.0.1:9202
+"""
+import os
+import json
+import glob
+import time
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import multiprocessing
+
+import metrics
+from config import TCP_WORKERS, WORKER_BUS_PATH, JOURNAL_DIR, NODE_ID, NODE_LISTEN, NODE_PEERS, NODE_METRICS_PORT
+from ownership import parse_peers
+from worker_bus import BusHub
+
+logger = logging.getLogger("ingest_workers")
+
+RESTART_DELAY = 1.0  # giây chờ trước khi khởi động lại worker bị chết
+
+
+def reuseport_socket(host, port) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(worker_id, host, port, bus_path):
+    """Entry point of a worker process"""
+    import tcp_server
+    sock = reuseport_socket(host, port)
+    try:
+        asyncio.run(tcp_server.start_server(sock=sock, worker_id=worker_id, bus_path=bus_path))
+    except KeyboardInterrupt:
+        pass
+
+
+def orphan_journals(workers):
+    """Journal roots not owned by any of the `workers` running workers"""
+    import tcp_server
+    owned = {os.path.abspath(tcp_server.worker_journal_dir(i)) for i in range(workers)}
+    roots = [JOURNAL_DIR] + sorted(glob.glob(f"{JOURNAL_DIR}-worker*"))
+    return [root for root in roots
+            if os.path.isdir(root) and os.path.abspath(root) not in owned and os.listdir(root)]
+
+
+class Supervisor:
+    def __init__(self, workers, host, port, bus_path=WORKER_BUS_PATH, node_id=NODE_ID, listen=None, peers=None,
+                 metrics_port=NODE_METRICS_PORT):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.bus_path = bus_path
+        self.metrics_port = metrics_port
+        self.hub = BusHub(bus_path, node_id, listen, peers)
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = {}
+        self.drainers = []
+        self.running = False
+
+    def spawn(self, worker_id):
+        process = self.context.Process(target=run_worker, name=f"tcp-worker-{worker_id}",
+                                       args=(worker_id, self.host, self.port, self.bus_path))
+        process.start()
+        self.processes[worker_id] = process
+        logger.info(f"Worker {worker_id} started (pid {process.pid})")
+
+    def drain_orphans(self):
+        from telemetry_journal import TelemetryJournal, JournalDrainer
+        for root in orphan_journals(self.workers):
+            logger.info(f"Draining journal {root}, no worker owns it")
+            drainer = JournalDrainer(TelemetryJournal(root))
+            drainer.start()
+            self.drainers.append(drainer)
+
+    async def run(self):
+        self.running = True
+        await self.hub.start()
+        metrics.add_endpoint("/cluster", lambda query: ("application/json", json.dumps(self.hub.stats())))
+        await metrics.serve_metrics(port=self.metrics_port)
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        self.drain_orphans()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        logger.info(f"Node {self.hub.node_id}: {self.workers} ingest workers on {self.host}:{self.port}")
+        try:
+            while self.running:
+                await asyncio.sleep(RESTART_DELAY)
+                for worker_id, process in list(self.processes.items()):
+                    if not process.is_alive() and self.running:
+                        logger.error(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+                        self.spawn(worker_id)
+        finally:
+            await self.shutdown()
+
+    def stop(self):
+        self.running = False
+
+    async def shutdown(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + 5
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - time.time()))
+            if process.is_alive():
+                process.kill()
+        for drainer in self.drainers:
+            drainer.stop()
+        await self.hub.close()
+        if os.path.exists(self.bus_path):
+            os.remove(self.bus_path)
+        logger.info("Ingest workers stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run tcp_server as N SO_REUSEPORT worker processes')
+    parser.add_argument('--workers', type=int, default=TCP_WORKERS, help=f'Worker processes (default: {TCP_WORKERS})')
+    parser.add_argument('--host', default='localhost', help='Listen address (default: localhost)')
+    parser.add_argument('--port', type=int, default=9000, help='Listen port (default: 9000)')
+    parser.add_argument('--bus', default=WORKER_BUS_PATH, help=f'Unix socket of the worker bus (default: {WORKER_BUS_PATH})')
+    parser.add_argument('--node-id', default=NODE_ID, help=f'Name of this node in a cluster (default: {NODE_ID})')
+    parser.add_argument('--listen', default=NODE_LISTEN or None, help='Address for peer nodes, host:port or unix:/path')
+    parser.add_argument('--peers', default=NODE_PEERS, help='Peer nodes, node=address[,node=address...]')
+    parser.add_argument('--metrics-port', type=int, default=NODE_METRICS_PORT,
+                        help=f'Port of /metrics and /cluster (default: {NODE_METRICS_PORT})')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning("SO_REUSEPORT is not available on this platform, running a single worker")
+        args.workers = 1
+    if args.workers <= 1 and not (args.listen or args.peers):
+        import tcp_server
+        asyncio.run(tcp_server.start_server())
+        return
+    supervisor = Supervisor(args.workers, args.host, args.port, args.bus, args.node_id, args.listen,
+                            parse_peers(args.peers), args.metrics_port)
+    asyncio.run(supervisor.run())
+
+
+if __name__ == "__main__":
+    main()
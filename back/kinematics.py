@@ -0,0 +1,276 @@
+import math
+import logging
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import ROBOT_GEOMETRY
+
+logger = logging.getLogger("kinematics")
+
+# RPM -> rad/s
+RPM_TO_RAD_S = 2 * math.pi / 60
+
+
+class RobotGeometry:
+    """Physical parameters of a 3-wheel omni robot"""
+
+    def __init__(self, wheel_radius=0.03, robot_radius=0.153, dt=0.05):
+        self.wheel_radius = float(wheel_radius)  # Wheel radius (m)
+        self.robot_radius = float(robot_radius)  # Center to wheel distance (m)
+        self.dt = float(dt)                      # Default sampling time (s)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create geometry from a config dict, missing keys use defaults"""
+        return cls(**{k: data[k] for k in ("wheel_radius", "robot_radius", "dt") if k in data})
+
+    def key(self):
+        """Hashable key identifying this geometry"""
+        return (self.wheel_radius, self.robot_radius, self.dt)
+
+    def wheel_matrix(self, theta=0.0):
+        """
+        Inverse kinematics matrix H(theta) mapping robot velocities to wheel rim speeds
+
+        H(theta) = H0 · R(theta), where H0 = H(0) and R is the planar rotation
+        """
+        L = self.robot_radius
+        return np.array([
+            [-math.sin(theta), math.cos(theta), L],
+            [-math.sin(math.pi / 3 - theta), -math.cos(math.pi / 3 - theta), L],
+            [math.sin(math.pi / 3 + theta), -math.cos(math.pi / 3 + theta), L]
+        ])
+
+    def __repr__(self):
+        return (f"<RobotGeometry(wheel_radius={self.wheel_radius}, "
+                f"robot_radius={self.robot_radius}, dt={self.dt})>")
+
+
+def closed_form_inverse(robot_radius: float) -> np.ndarray:
+    """
+    Analytic inverse of H0 = H(0) for wheels at 90°, 210° and 330°
+
+    Solving H0·u = w row by row gives
+        vx    = (w3 - w2) / sqrt(3)
+        vy    = (2·w1 - w2 - w3) / 3
+        omega = (w1 + w2 + w3) / (3·L)
+    """
+    a = 1 / math.sqrt(3)
+    d = 1 / (3 * robot_radius)
+    return np.array([
+        [0.0, -a, a],
+        [2 / 3, -1 / 3, -1 / 3],
+        [d, d, d]
+    ])
+
+
+class OmniKinematics:
+    """
+    Forward kinematics for one robot geometry.
+
+    Because H(theta) = H0 · R(theta), the inverse is R(theta)^T · H0^-1. H0^-1 is
+    computed once here, so converting wheel speeds to robot velocities only
+    needs a matrix-vector product and a 2x2 rotation - no per-sample inversion.
+    """
+
+    def __init__(self, geometry: RobotGeometry):
+        self.geometry = geometry
+        self.H0 = geometry.wheel_matrix(0.0)
+        # Maps wheel angular speed (rad/s) to robot velocities at theta = 0
+        self.inv_rad = closed_form_inverse(geometry.robot_radius) * geometry.wheel_radius
+        # Same mapping with the RPM -> rad/s conversion folded in
+        self.inv_rpm = self.inv_rad * RPM_TO_RAD_S
+
+        # Non-zero entries of inv_rpm as plain floats for the scalar fast path
+        k = geometry.wheel_radius * RPM_TO_RAD_S
+        self._kx = k / math.sqrt(3)
+        self._ky = k / 3
+        self._kw = k / (3 * geometry.robot_radius)
+
+    # --- scalar API ---
+
+    def velocity(self, theta: float, rpm: Sequence[float]) -> Tuple[float, float, float]:
+        """
+        Robot velocity from wheel RPM values
+
+        Uses the closed form of H0^-1 on plain floats, so a sample costs a
+        handful of multiplications and one sin/cos pair (no array allocation).
+
+        Args:
+            theta: Current robot orientation (rad)
+            rpm: RPM values of the three wheels
+
+        Returns:
+            Tuple (vx, vy, omega) - world frame linear (m/s) and angular (rad/s) velocity
+        """
+        w1, w2, w3 = rpm
+        ux = (w3 - w2) * self._kx
+        uy = (2 * w1 - w2 - w3) * self._ky
+        c = math.cos(theta)
+        s = math.sin(theta)
+        return (c * ux - s * uy, s * ux + c * uy, (w1 + w2 + w3) * self._kw)
+
+    def velocity_rad(self, theta: float, omega_wheel: Sequence[float]) -> Tuple[float, float, float]:
+        """Same as velocity() but wheel speeds are given in rad/s"""
+        w1, w2, w3 = omega_wheel
+        return self.velocity(theta, (w1 / RPM_TO_RAD_S, w2 / RPM_TO_RAD_S, w3 / RPM_TO_RAD_S))
+
+    # --- batched API ---
+
+    def velocities(self, thetas, rpm, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Robot velocities for many samples at once
+
+        Args:
+            thetas: (N,) orientations (rad), or a scalar applied to every sample
+            rpm: (N, 3) wheel RPM values
+            out: Optional (N, 3) float array to write the result into
+
+        Returns:
+            (N, 3) array of (vx, vy, omega) rows
+        """
+        rpm = np.asarray(rpm, dtype=float).reshape(-1, 3)
+        if out is None:
+            out = np.empty_like(rpm)
+        u = rpm.dot(self.inv_rpm.T)
+        c = np.cos(thetas)
+        s = np.sin(thetas)
+        # Only the 2x2 rotation depends on theta
+        np.multiply(c, u[:, 0], out=out[:, 0])
+        out[:, 0] -= s * u[:, 1]
+        np.multiply(s, u[:, 0], out=out[:, 1])
+        out[:, 1] += c * u[:, 1]
+        out[:, 2] = u[:, 2]
+        return out
+
+    def integrate(self, rpm, dt=None, initial_position=(0.0, 0.0, 0.0)) -> Dict[str, np.ndarray]:
+        """
+        Integrate a whole RPM series into a trajectory (explicit Euler)
+
+        The angular rate does not depend on theta, so the heading sequence is a
+        cumulative sum and the whole series is evaluated without a Python loop.
+
+        Args:
+            rpm: (N, 3) wheel RPM values
+            dt: Scalar or (N,) time steps in seconds, geometry.dt when None
+            initial_position: (x, y, theta) start pose
+
+        Returns:
+            Dict {'x', 'y', 'theta'} with N + 1 points each, theta wrapped to [-pi, pi]
+        """
+        x0, y0, theta0 = initial_position
+        rpm = np.asarray(rpm, dtype=float).reshape(-1, 3)
+        n = len(rpm)
+        if dt is None:
+            dt = self.geometry.dt
+        dt = np.broadcast_to(np.asarray(dt, dtype=float), (n,))
+
+        u = rpm.dot(self.inv_rpm.T)
+
+        # Heading before each step (the velocity uses the pose at the start of the step)
+        theta = np.empty(n + 1)
+        theta[0] = theta0
+        np.cumsum(u[:, 2] * dt, out=theta[1:])
+        theta[1:] += theta0
+
+        c = np.cos(theta[:-1])
+        s = np.sin(theta[:-1])
+        x = np.empty(n + 1)
+        y = np.empty(n + 1)
+        x[0] = x0
+        y[0] = y0
+        np.cumsum((c * u[:, 0] - s * u[:, 1]) * dt, out=x[1:])
+        np.cumsum((s * u[:, 0] + c * u[:, 1]) * dt, out=y[1:])
+        x[1:] += x0
+        y[1:] += y0
+
+        return {'x': x, 'y': y, 'theta': np.arctan2(np.sin(theta), np.cos(theta))}
+
+    # --- streaming API ---
+
+    def integrator(self, x=0.0, y=0.0, theta=0.0) -> "PoseIntegrator":
+        """Create a streaming pose integrator bound to this geometry"""
+        return PoseIntegrator(self, x, y, theta)
+
+
+class PoseIntegrator:
+    """Incremental pose tracking, one RPM sample at a time"""
+
+    def __init__(self, kinematics: OmniKinematics, x=0.0, y=0.0, theta=0.0):
+        self.kinematics = kinematics
+        self.x = x
+        self.y = y
+        self.theta = theta
+
+    def update(self, rpm: Sequence[float], dt: Optional[float] = None,
+               theta: Optional[float] = None) -> Dict[str, float]:
+        """
+        Advance the pose by one sample
+
+        Args:
+            rpm: RPM values of the three wheels
+            dt: Time step (s), geometry.dt when None or not positive
+            theta: Externally measured heading (e.g. IMU yaw) to use for this step
+
+        Returns:
+            Dict {'x', 'y', 'theta'} with the new pose
+        """
+        if dt is None or dt <= 0:
+            dt = self.kinematics.geometry.dt
+        if theta is not None:
+            self.theta = theta
+
+        vx, vy, omega = self.kinematics.velocity(self.theta, rpm)
+        self.x += vx * dt
+        self.y += vy * dt
+        self.theta = math.atan2(math.sin(self.theta + omega * dt), math.cos(self.theta + omega * dt))
+        return self.pose()
+
+    def pose(self) -> Dict[str, float]:
+        return {'x': self.x, 'y': self.y, 'theta': self.theta}
+
+
+# --- per robot geometry registry ---
+
+_geometries: Dict[str, RobotGeometry] = {}
+_kinematics: Dict[tuple, OmniKinematics] = {}
+
+
+def _load_config():
+    """Fill the registry from config.ROBOT_GEOMETRY"""
+    for robot_id, params in ROBOT_GEOMETRY.items():
+        _geometries[str(robot_id)] = RobotGeometry.from_dict(params)
+
+
+def register_geometry(robot_id, geometry: RobotGeometry):
+    """Set the geometry used for a robot_id"""
+    _geometries[str(robot_id)] = geometry
+    logger.info(f"Registered geometry for robot {robot_id}: {geometry}")
+
+
+def get_geometry(robot_id=None) -> RobotGeometry:
+    """Geometry for a robot_id, falling back to the 'default' entry"""
+    if robot_id is not None and str(robot_id) in _geometries:
+        return _geometries[str(robot_id)]
+    return _geometries["default"]
+
+
+def for_geometry(geometry: RobotGeometry) -> OmniKinematics:
+    """Cached OmniKinematics for a geometry (matrices are built once per geometry)"""
+    key = geometry.key()
+    kin = _kinematics.get(key)
+    if kin is None:
+        kin = OmniKinematics(geometry)
+        _kinematics[key] = kin
+    return kin
+
+
+def for_robot(robot_id=None) -> OmniKinematics:
+    """Cached OmniKinematics for a robot_id"""
+    return for_geometry(get_geometry(robot_id))
+
+
+_load_config()
+if "default" not in _geometries:
+    _geometries["default"] = RobotGeometry()
@@ -0,0 +1,107 @@
+"""
+Newline framing for every socket reader (tcp_server, direct_bridge,
+TCPConnectionManager, ws_tcp_bridge, Omni_Server_ver2/raw_server).
+
+The readers used to do `buffer += data.decode()` then
+`buffer.split('\\n', 1)` per line. That copies the whole remaining buffer for
+every line, so a large message arriving in small reads costs O(n²), and a
+UTF-8 character cut between two reads raises UnicodeDecodeError.
+
+LineFramer keeps the bytes in one bytearray, remembers how far it already
+scanned for a newline, and returns the complete frames of each read as
+memoryview slices of that buffer. Nothing is copied or decoded until the
+caller decodes a frame, and only whole frames are decoded. A frame stays valid
+after the next feed(): the consumed part of the buffer is left to the views
+still using it and the framer continues in a fresh bytearray holding only the
+partial tail.
+
+    framer = LineFramer()
+    for frame in framer.feed(await reader.read(4096)):
+        handle(frame)          # bytes-like, e.g. json.loads(frame) or a raw write
+
+Readers that want text use lines() instead: every complete line of the read
+is decoded with one decode() and one split() call, which for small telemetry
+lines is cheaper than decoding each memoryview frame separately.
+
+Frames longer than max_frame bytes are dropped (counted in `dropped`) instead
+of growing the buffer without bound; the reader resynchronizes on the next
+newline.
+"""
+from typing import List
+
+from config import LINE_MAX_BYTES
+
+
+class LineFramer:
+    __slots__ = ("buffer", "scanned", "max_frame", "skipping", "dropped")
+
+    def __init__(self, max_frame=LINE_MAX_BYTES):
+        self.buffer = bytearray()
+        self.scanned = 0  # byte offset already searched for a newline
+        self.max_frame = max_frame
+        self.skipping = False  # inside an oversized frame, discard up to the next newline
+        self.dropped = 0
+
+    def feed(self, data) -> List[memoryview]:
+        """Add one read; returns the complete frames it finished, without the newline"""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        view = None
+        start = 0
+        end = buffer.find(b"\n", self.scanned)
+        while end >= 0:
+            if self.skipping:
+                self.skipping = False
+            elif end - start > self.max_frame:
+                self.dropped += 1
+            else:
+                if view is None:
+                    view = memoryview(buffer)
+                frames.append(view[start:end])
+            start = end + 1
+            end = buffer.find(b"\n", start)
+
+        if start and view is not None:
+            # Frames still point into the old buffer, the tail moves to a new one
+            buffer = self.buffer = buffer[start:]
+        elif start:
+            del buffer[:start]
+        if len(buffer) > self.max_frame:
+            if not self.skipping:
+                self.dropped += 1
+                self.skipping = True
+            buffer = self.buffer = bytearray()
+        self.scanned = len(buffer)
+        return frames
+
+    def lines(self, data, errors="replace") -> List[str]:
+        """feed() decoded as UTF-8 text"""
+        buffer = self.buffer
+        if not buffer and data and data[-1] == 10 and not self.skipping and len(data) <= self.max_frame:
+            # Read ends on a line boundary (a robot writing one line at a time): nothing to keep
+            lines = data.decode("utf-8", errors).split("\n")
+            lines.pop()
+            return lines
+        if self.skipping or len(buffer) + len(data) > self.max_frame:
+            # Some frame may be over the limit: go frame by frame
+            return [str(frame, "utf-8", errors) for frame in self.feed(data)]
+        buffer += data
+        end = buffer.rfind(b"\n", self.scanned)
+        if end < 0:
+            self.scanned = len(buffer)
+            return []
+        text = buffer[:end].decode("utf-8", errors)
+        del buffer[:end + 1]
+        self.scanned = len(buffer)
+        return text.split("\n")
+
+    def pending(self) -> int:
+        """Bytes of an incomplete frame waiting for more data"""
+        return len(self.buffer)
+
+    def reset(self):
+        """Forget buffered bytes (after a reconnect)"""
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.skipping = False
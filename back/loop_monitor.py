@@ -0,0 +1,188 @@
+"""
+Event-loop lag and blocking-call detector.
+
+A ticker task on the monitored loop sleeps LOOP_MONITOR_INTERVAL and measures
+how late it wakes up: that delay is the scheduling lag every other coroutine
+saw. A watchdog thread checks the ticker's heartbeat; when a tick is overdue
+it captures the stack of the loop thread *while it is still blocked*, and if
+the lag then reaches LOOP_LAG_THRESHOLD the offending call site (a
+socket.recv, time.sleep or synchronous DB query inside a coroutine) is
+recorded, not just the fact that something was slow.
+
+Exposed as:
+    event_loop_lag_seconds          histogram (metrics)
+    event_loop_blocked_total        counter of blocking episodes
+    GET /stats/loop                 side port of tcp_server / bridges
+    GET /api/loop-stats             FastAPI
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import metrics
+from config import LOOP_MONITOR_INTERVAL, LOOP_LAG_THRESHOLD, LOOP_MONITOR_MAX_SITES
+
+logger = logging.getLogger("loop_monitor")
+
+LOOP_LAG = metrics.histogram("event_loop_lag_seconds", "Event loop scheduling lag",
+                             buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_BLOCKED = metrics.counter("event_loop_blocked_total", "Times the event loop was blocked longer than the threshold")
+LOOP_MAX_LAG = metrics.gauge("event_loop_max_lag_seconds", "Largest lag since start")
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _call_site(stack: List[traceback.FrameSummary]) -> str:
+    """Innermost frame of our own code, else the innermost frame"""
+    for frame in reversed(stack):
+        if frame.filename.startswith(APP_DIR) and os.path.basename(frame.filename) != "loop_monitor.py":
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    frame = stack[-1]
+    return f"{frame.filename}:{frame.lineno} in {frame.name}"
+
+
+class BlockingSite:
+    __slots__ = ("site", "count", "total_blocked", "max_blocked", "last_seen", "stack")
+
+    def __init__(self, site, stack):
+        self.site = site
+        self.count = 0
+        self.total_blocked = 0.0
+        self.max_blocked = 0.0
+        self.last_seen = 0.0
+        self.stack = stack
+
+    def to_dict(self) -> dict:
+        return {"site": self.site, "count": self.count, "total_blocked_ms": round(self.total_blocked * 1000, 3),
+                "max_blocked_ms": round(self.max_blocked * 1000, 3), "last_seen": self.last_seen,
+                "stack": self.stack}
+
+
+class LoopMonitor:
+    def __init__(self, interval=LOOP_MONITOR_INTERVAL, threshold=LOOP_LAG_THRESHOLD, max_sites=LOOP_MONITOR_MAX_SITES):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_sites = max_sites
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id = None
+        self.last_tick = time.monotonic()
+        # Lags of the last ~minute for percentiles
+        self.recent = deque(maxlen=max(1, int(60 / interval)))
+        self.max_lag = 0.0
+        self.blocked = 0
+        self.sites: Dict[str, BlockingSite] = {}
+        self.lock = threading.Lock()
+        self.task = None
+        self.thread = None
+        self.running = False
+        # Stack sampled by the watchdog during the current stall, consumed by the next tick
+        self._candidate = None
+
+    async def _ticker(self):
+        while self.running:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.last_tick = now
+            self.recent.append(lag)
+            LOOP_LAG.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+                LOOP_MAX_LAG.set(lag)
+            with self.lock:
+                stack, self._candidate = self._candidate, None
+            if lag >= self.threshold:
+                self._record(lag, stack)
+
+    def _record(self, lag, stack):
+        self.blocked += 1
+        LOOP_BLOCKED.inc()
+        site_name = _call_site(stack) if stack else "unknown (not sampled)"
+        with self.lock:
+            site = self.sites.get(site_name)
+            if site is None:
+                if len(self.sites) >= self.max_sites:
+                    # Drop the site seen longest ago
+                    oldest = min(self.sites.values(), key=lambda s: s.last_seen)
+                    del self.sites[oldest.site]
+                site = self.sites[site_name] = BlockingSite(site_name, [])
+            site.count += 1
+            site.total_blocked += lag
+            site.max_blocked = max(site.max_blocked, lag)
+            site.last_seen = time.time()
+            if stack:
+                site.stack = [f"{f.filename}:{f.lineno} in {f.name}" + (f"\n    {f.line}" if f.line else "")
+                              for f in stack[-15:]]
+        logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms at {site_name}")
+
+    def _watchdog(self):
+        # Sample the loop thread's stack once it is half the threshold overdue, while it
+        # is still blocked; the ticker keeps the sample only if the lag reaches the threshold
+        poll = min(self.interval, self.threshold) / 2
+        while self.running:
+            time.sleep(poll)
+            overdue = time.monotonic() - self.last_tick - self.interval
+            if overdue < self.threshold / 2 or self._candidate is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self.lock:
+                self._candidate = stack
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """Start monitoring the given (or the running) loop; call from the loop's thread"""
+        if self.running:
+            return self
+        self.loop = loop or asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.running = True
+        self.task = self.loop.create_task(self._ticker())
+        self.thread = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        self.thread.start()
+        logger.info(f"Event loop monitor started (threshold {self.threshold * 1000:.0f} ms)")
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.task:
+            self.task.cancel()
+
+    def stats(self) -> dict:
+        lags = np.asarray(self.recent) * 1000 if self.recent else np.zeros(1)
+        p50, p99 = np.percentile(lags, [50, 99])
+        with self.lock:
+            sites = sorted(self.sites.values(), key=lambda s: s.total_blocked, reverse=True)
+            sites = [s.to_dict() for s in sites]
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag_ms": {"p50": round(float(p50), 3), "p99": round(float(p99), 3),
+                       "max_recent": round(float(lags.max()), 3), "max": round(self.max_lag * 1000, 3)},
+            "blocked_episodes": self.blocked,
+            "histogram": {"buckets": list(LOOP_LAG.buckets), "counts": list(LOOP_LAG.counts)},
+            "sites": sites,
+        }
+
+
+monitor = LoopMonitor()
+
+
+def start_monitor(loop=None) -> LoopMonitor:
+    """Start the process-wide monitor on the running loop"""
+    return monitor.start(loop)
+
+
+metrics.add_endpoint("/stats/loop", lambda query: ("application/json", json.dumps(monitor.stats())))
@@ -102,6 +102,8 @@ threading.Thread(target=tcp_manager.start, daemon=True).start()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Drainer và các thread của TCP manager phát dữ liệu qua event loop này
+    tcp_manager.loop = asyncio.get_running_loop()
     # Khởi động broadcast loop để gửi dữ liệu tới WebSocket clients
     broadcast_task = asyncio.create_task(broadcast_loop())
     yield
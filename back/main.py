@@ -4,6 +4,7 @@ import time
 import traceback
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from sqlalchemy.orm import Session
 from contextlib import asynccontextmanager
 # Replace old database imports with new ones
@@ -12,6 +13,12 @@ from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 import logging
 from data_converter import DataConverter
 from trajectory_service import TrajectoryService
+import trajectory_recompute
+import metrics
+import tracing
+import loop_monitor
+import profiler
+from timer_wheel import Keepalive
 from datetime import datetime, timedelta
 import math
 import random
@@ -63,7 +70,11 @@ MAX_INACTIVE_TIME = 600  # 10 minutes - very high to prevent automatic disconnec
 # Simple lifespan manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Đo độ trễ event loop; các lệnh đồng bộ (SQLAlchemy, socket) chặn loop sẽ hiện trong /api/loop-stats
+    monitor = loop_monitor.start_monitor()
+    profiler.install_signal_handler("api")
     yield
+    monitor.stop()
 
 # Create FastAPI app
 app = FastAPI(lifespan=lifespan)
@@ -82,6 +93,23 @@ app.add_middleware(
 # Store app start time for uptime tracking
 app.state.start_time = time.time()
 
+# Metrics (GET /metrics)
+API_REQUESTS = metrics.counter("api_requests_total", "HTTP requests", ["method", "route", "status"])
+API_REQUEST_SECONDS = metrics.histogram("api_request_seconds", "HTTP request latency", ["route"])
+API_WS_CONNECTIONS = metrics.gauge("api_ws_connections", "Open dashboard WebSocket connections")
+API_WS_MESSAGES = metrics.counter("api_ws_messages_total", "WebSocket messages received", ["type"])
+API_WS_MESSAGE_SECONDS = metrics.histogram("api_ws_message_seconds", "Time to process one WebSocket message")
+
+@app.middleware("http")
+async def record_request_metrics(request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Nhãn theo route template (/api/trajectory/recompute/{job_id}) để số series không tăng theo tham số
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    API_REQUEST_SECONDS.labels(route).observe(time.perf_counter() - started)
+    API_REQUESTS.labels(request.method, route, response.status_code).inc()
+    return response
+
 #tcp
 import socket
 import traceback
@@ -113,6 +141,28 @@ async def health_check():
         "version": "1.0.0"
     }
 
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition of the API metrics"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/loop-stats")
+def get_loop_stats():
+    """Event loop lag percentiles and the call sites that blocked it"""
+    return loop_monitor.monitor.stats()
+
+@app.get("/api/traces/slowest")
+def get_slowest_traces(limit: int = 20, window: float = 300):
+    """Slowest recent traced WebSocket commands handled by the API"""
+    return tracing.RECORDER.slowest(limit, window)
+
+@app.get("/api/traces/{trace_id}")
+def get_trace(trace_id: str):
+    trace = tracing.RECORDER.trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"Trace {trace_id} not in the buffer")
+    return trace
+
 # WebSocket handler for robot connections
 async def handle_robot_connection(ws: WebSocket, robot_id: str):
     """Handle WebSocket connection for a specific robot"""
@@ -120,9 +170,6 @@ async def handle_robot_connection(ws: WebSocket, robot_id: str):
     print(f"Connection request from {client_id} for {robot_id}")
     print(f"Active connections for {robot_id}: {len(robot_connections[robot_id])}")
     
-    # Khởi tạo heartbeat task
-    heartbeat_task = None
-    
     try:
         # Accept connection immediately
         await ws.accept()
@@ -138,6 +185,7 @@ async def handle_robot_connection(ws: WebSocket, robot_id: str):
         # Add to connection list
         if ws not in robot_connections[robot_id]:
             robot_connections[robot_id].append(ws)
+        API_WS_CONNECTIONS.inc()
         
         # Send confirmation
         await ws.send_text(json.dumps({
@@ -146,8 +194,8 @@ async def handle_robot_connection(ws: WebSocket, robot_id: str):
             "timestamp": time.time()
         }))
         
-        # Khởi động heartbeat để giữ kết nối
-        heartbeat_task = asyncio.create_task(send_heartbeat(ws, robot_id))
+        # Heartbeat để giữ kết nối: timer wheel chung của process, không tạo task riêng
+        keepalive.add(ws, ws.send_text, group=robot_id)
         
         # Send initial data
         try:
@@ -169,8 +217,10 @@ async def handle_robot_connection(ws: WebSocket, robot_id: str):
                 ws.last_activity = time.time()
                 
                 # Process command
+                started = time.perf_counter()
                 try:
                     json_data = json.loads(data)
+                    API_WS_MESSAGES.labels(json_data.get("type", "unknown")).inc()
                     
                     # Kiểm tra xem client có yêu cầu ngắt kết nối không
                     if json_data.get("type") == "manual_disconnect":
@@ -184,7 +234,10 @@ async def handle_robot_connection(ws: WebSocket, robot_id: str):
                         }))
                         break
                     
-                    await process_robot_command(robot_id, json_data, ws)
+                    trace_id = tracing.ensure_trace_id(json_data)
+                    with tracing.span(trace_id, "api.command", type=json_data.get("type"), robot_id=robot_id):
+                        await process_robot_command(robot_id, json_data, ws)
+                    API_WS_MESSAGE_SECONDS.observe(time.perf_counter() - started)
                 except json.JSONDecodeError:
                     await ws.send_text(json.dumps({
                         "status": "error",
@@ -225,37 +278,25 @@ async def handle_robot_connection(ws: WebSocket, robot_id: str):
         print(f"ERROR in {robot_id} connection: {e}")
     
     finally:
-        # Hủy heartbeat task khi kết thúc
-        if heartbeat_task and not heartbeat_task.done():
-            heartbeat_task.cancel()
-            
+        # Ngừng heartbeat khi kết thúc
+        keepalive.remove(ws)
+        
         # Clean up
         if ws in robot_connections[robot_id]:
             robot_connections[robot_id].remove(ws)
+            API_WS_CONNECTIONS.dec()
         
         disconnect_type = "manual" if getattr(ws, "manual_disconnect", False) else "automatic"
         print(f"{robot_id} connection closed for {client_id} ({disconnect_type} disconnect)")
         print(f"Remaining {robot_id} connections: {len(robot_connections[robot_id])}")
 
-# Thêm hàm heartbeat để giữ kết nối ổn định
-async def send_heartbeat(ws: WebSocket, robot_id: str):
-    """Send periodic heartbeat to client to keep connection alive"""
-    try:
-        while True:
-            await asyncio.sleep(HEARTBEAT_INTERVAL)
-            try:
-                await ws.send_text(json.dumps({
-                    "type": "ping",
-                    "robot_id": robot_id,
-                    "timestamp": time.time()
-                }))
-            except Exception as e:
-                # Nếu không gửi được, thoát khỏi vòng lặp
-                print(f"Heartbeat failed for {robot_id}: {e}")
-                break
-    except asyncio.CancelledError:
-        # Normal cancellation when connection closes
-        pass
+# Heartbeat giữ kết nối ổn định: một payload cho mỗi robot_id mỗi tick, gửi tới mọi kết nối đến hạn.
+# Kết nối gửi heartbeat lỗi chỉ bị bỏ khỏi wheel, vòng nhận tin sẽ tự kết thúc
+keepalive = Keepalive("api_ws", lambda robot_id: {
+    "type": "ping",
+    "robot_id": robot_id,
+    "timestamp": time.time()
+}, interval=HEARTBEAT_INTERVAL)
 
 @app.websocket("/ws/server")
 async def server_endpoint(ws: WebSocket):
@@ -390,7 +431,8 @@ async def process_robot_command(robot_id: str, data: dict, ws: WebSocket):
         # Common response data
         response_base = {
             "timestamp": time.time(),
-            "robot_id": robot_id
+            "robot_id": robot_id,
+            "trace_id": data.get("trace_id")
         }
         
         # XỬ LÝ PING - Ưu tiên cao nhất để giữ kết nối sống
@@ -831,6 +873,7 @@ async def get_connection_status():
             },
             "websocket_connections": ws_connections,
             "total_connections": sum(ws_connections.values()),
+            "event_loop": {k: v for k, v in loop_monitor.monitor.stats().items() if k != "sites"},
             "active_connections": active_connections,
             "timestamp": time.time()
         }
@@ -959,6 +1002,44 @@ async def get_robot_status_data(robot_id: str, db: Session = None):
         if close_db:
             db.close()
 
+@app.post("/api/trajectory/recompute")
+async def start_trajectory_recompute(request: dict):
+    """Start a background batch recompute of trajectories from encoder data"""
+    try:
+        shard_hours = float(request.get("shard_hours", 1.0))
+        workers = int(request["workers"]) if request.get("workers") is not None else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="shard_hours and workers must be numbers")
+    # shard_hours <= 0 would never advance the shard cursor
+    if not shard_hours > 0:
+        raise HTTPException(status_code=400, detail="shard_hours must be positive")
+    if workers is not None and workers < 1:
+        raise HTTPException(status_code=400, detail="workers must be at least 1")
+    # A string would be split into one robot per character
+    robot_ids = request.get("robot_ids")
+    if robot_ids is not None and not (isinstance(robot_ids, list) and all(isinstance(r, str) for r in robot_ids)):
+        raise HTTPException(status_code=400, detail="robot_ids must be a list of strings (or omitted for all robots)")
+    try:
+        job_id = trajectory_recompute.start_recompute_job(
+            robot_ids=robot_ids,
+            start_time=datetime.fromisoformat(request["start_time"]) if request.get("start_time") else None,
+            end_time=datetime.fromisoformat(request["end_time"]) if request.get("end_time") else None,
+            shard_hours=shard_hours,
+            workers=workers,
+            write=not request.get("dry_run", False)
+        )
+        return {"status": "started", "job_id": job_id, "timestamp": time.time()}
+    except Exception as e:
+        return {"status": "error", "message": str(e), "timestamp": time.time()}
+
+@app.get("/api/trajectory/recompute/{job_id}")
+async def get_trajectory_recompute(job_id: str):
+    """Progress and result of a trajectory recompute job"""
+    job = trajectory_recompute.recompute_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown recompute job {job_id}")
+    return job
+
 # Import cấu hình
 from config import API_KEY
 
@@ -993,6 +1074,16 @@ async def verify_api_key(authorization: str = Header(None)):
     
     return token
 
+@app.get("/api/admin/profile", dependencies=[Depends(verify_api_key)])
+async def run_profiler(seconds: float = 10, interval: float = 0.005, tracemalloc: int = 0, format: str = "collapsed"):
+    """Sample all thread stacks for N seconds; collapsed stacks (flame graph input) or JSON with allocations"""
+    try:
+        result = await profiler.profile(seconds, interval, tracemalloc)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    content_type, body = profiler.render(result, format)
+    return Response(content=body, media_type=content_type)
+
 # Route để kiểm tra định dạng xác thực
 @app.get("/api/auth/format")
 async def auth_format_info():
@@ -0,0 +1,290 @@
+"""
+Lightweight Prometheus-style metrics shared by all servers.
+
+Counters, gauges and histograms with fixed buckets live in one process-wide
+registry and are rendered in the Prometheus text exposition format:
+
+    import metrics
+    RECEIVED = metrics.counter("tcp_messages_received_total", "Messages read from robots", ["type"])
+    RECEIVED.labels("encoder").inc()
+
+The hot path takes no lock: every server handles messages on one asyncio
+event loop, and under the GIL a lost increment from a concurrent thread is the
+worst case, which is acceptable for monitoring. Only creating a new label
+combination takes the registry lock.
+
+Servers without an HTTP stack (tcp_server, ws_tcp_bridge, direct_bridge) call
+serve_metrics() to expose GET /metrics on a side port; main.py serves render()
+from FastAPI. Other diagnostics (tracing.py) add their own GET paths to the
+same listener with add_endpoint().
+"""
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger("metrics")
+
+# Seconds; covers sub-millisecond forwarding up to slow DB writes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label values often come from the network (message type); cap the number of series
+MAX_LABEL_SETS = 200
+OVERFLOW_LABEL = "other"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        return type(self)(self.name, self.documentation)
+
+    def labels(self, *values):
+        """Child metric for one label combination"""
+        # Fast path: label values are usually already strings
+        child = self._children.get(values)
+        if child is None:
+            key = tuple(str(v) for v in values)
+            child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                if len(self._children) >= MAX_LABEL_SETS:
+                    key = (OVERFLOW_LABEL,) * len(self.labelnames)
+                child = self._children.get(key)
+                if child is None:
+                    child = self._new_child()
+                    self._children[key] = child
+        return child
+
+    def _series(self):
+        if self.labelnames:
+            return list(self._children.items())
+        return [((), self)]
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+                for key, child in self._series()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # One slot per bucket plus +Inf; cumulative counts are computed when rendering
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Context manager observing the elapsed seconds"""
+        return _Timer(self)
+
+    def samples(self):
+        lines = []
+        for key, child in self._series():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Add a metric; registering the same name twice returns the existing one"""
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"Metric {metric.name} already registered as {existing.kind}")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in list(self.metrics.values())) + "\n"
+
+    def snapshot(self) -> dict:
+        """Plain values for JSON endpoints: counters/gauges by label set, histograms as count/sum"""
+        out = {}
+        for name, metric in list(self.metrics.items()):
+            values = {}
+            for key, child in metric._series():
+                label = ",".join(key) if key else "value"
+                if isinstance(child, Histogram):
+                    values[label] = {"count": child.count, "sum": child.sum}
+                else:
+                    values[label] = child.value
+            out[name] = values
+        return out
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, documentation, labelnames=()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# path -> handler(query dict) returning (content_type, body), or a coroutine of it;
+# a handler raises PermissionError to answer 403
+ENDPOINTS: Dict[str, Callable[[Dict[str, str]], Tuple[str, str]]] = {
+    "/metrics": lambda query: (CONTENT_TYPE, render()),
+}
+
+
+def add_endpoint(path, handler: Callable[[Dict[str, str]], Tuple[str, str]]):
+    """Serve GET path on the side-port listener"""
+    ENDPOINTS[path] = handler
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Skip the headers
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        url = urlsplit(parts[1]) if len(parts) >= 2 else None
+        handler = ENDPOINTS.get(url.path) if url and parts[0] == "GET" else None
+        if handler is not None:
+            try:
+                result = handler(dict(parse_qsl(url.query)))
+                if asyncio.iscoroutine(result):
+                    result = await result
+                content_type, body = result
+                status = "200 OK"
+            except PermissionError as e:
+                content_type, body, status = "text/plain", f"{e}\n", "403 Forbidden"
+            except Exception as e:
+                content_type, body, status = "text/plain", f"{e}\n", "500 Internal Server Error"
+            body = body.encode("utf-8") if isinstance(body, str) else body
+        else:
+            body = b"Not found\n"
+            status = "404 Not Found"
+            content_type = "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host="0.0.0.0", port=9100):
+    """Expose GET /metrics on a small HTTP listener of the running event loop"""
+    try:
+        server = await asyncio.start_server(_handle_http, host, port)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint disabled, cannot listen on {host}:{port}: {e}")
+        return None
+    logger.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,155 @@
+"""
+Robot ownership for multi-node ingest.
+
+A node is one ingest supervisor with its workers (ingest_workers.py). Which
+node holds a robot's TCP connection is recorded as a lease in a routing table.
+The table is sharded across nodes: the lease of a robot lives on its
+directory node, picked by consistent hashing of the robot_id over the live
+nodes (HashRing), so no single process has to know every robot and a node
+joining or leaving moves only ~1/N of the leases.
+
+The owning node renews its leases with heartbeats (LEASE_TTL / 3). A node that
+dies or is cut off stops renewing and its leases expire. A fresh registration
+on another node takes the robot over and the previous owner is told to drop
+its stale connection.
+
+This module only holds the data structures; worker_bus.BusHub moves the
+messages between nodes.
+"""
+import time
+import hashlib
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import LEASE_TTL, HASH_RING_VNODES
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing with virtual nodes"""
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes=HASH_RING_VNODES):
+        self.vnodes = vnodes
+        self.points: List[int] = []
+        self.owners: Dict[int, str] = {}
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            point = _hash(f"{node}#{i}")
+            self.owners[point] = node
+        self.points = sorted(self.owners)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self.owners = {p: n for p, n in self.owners.items() if n != node}
+        self.points = sorted(self.owners)
+
+    def node_for(self, key) -> Optional[str]:
+        if not self.points:
+            return None
+        i = bisect_right(self.points, _hash(str(key))) % len(self.points)
+        return self.owners[self.points[i]]
+
+
+class Lease:
+    __slots__ = ("robot_id", "node", "epoch", "expires")
+
+    def __init__(self, robot_id, node, epoch, expires):
+        self.robot_id = robot_id
+        self.node = node
+        self.epoch = epoch
+        self.expires = expires
+
+    def to_dict(self) -> dict:
+        return {"robot_id": self.robot_id, "node": self.node, "epoch": self.epoch,
+                "expires_in": round(self.expires - time.monotonic(), 3)}
+
+
+class RoutingTable:
+    """Leases of the robots whose directory is this node"""
+
+    def __init__(self, ttl=LEASE_TTL):
+        self.ttl = ttl
+        self.leases: Dict[str, Lease] = {}
+
+    def acquire(self, robot_id, node, now=None) -> Tuple[Lease, Optional[str]]:
+        """
+        Lease for a robot that just registered on `node`
+
+        The newest registration wins: a valid lease held by another node is taken
+        over (its epoch bumped) and that node is returned so it can be revoked.
+        """
+        now = time.monotonic() if now is None else now
+        lease = self.leases.get(robot_id)
+        previous = None
+        if lease is None:
+            lease = self.leases[robot_id] = Lease(robot_id, node, 1, now + self.ttl)
+            return lease, None
+        if lease.node != node:
+            if lease.expires > now:
+                previous = lease.node
+            lease.node = node
+            lease.epoch += 1
+        lease.expires = now + self.ttl
+        return lease, previous
+
+    def renew(self, node, robot_ids: Iterable[str], now=None) -> List[str]:
+        """Heartbeat of `node` for its robots; returns the robots it no longer owns"""
+        now = time.monotonic() if now is None else now
+        lost = []
+        for robot_id in robot_ids:
+            lease = self.leases.get(robot_id)
+            if lease is None or lease.expires <= now:
+                # Unknown here (directory moved, or expired while partitioned): grant again
+                self.acquire(robot_id, node, now)
+            elif lease.node == node:
+                lease.expires = now + self.ttl
+            else:
+                lost.append(robot_id)
+        return lost
+
+    def release(self, robot_id, node):
+        lease = self.leases.get(robot_id)
+        if lease is not None and lease.node == node:
+            del self.leases[robot_id]
+
+    def owner(self, robot_id, now=None) -> Optional[str]:
+        lease = self.leases.get(robot_id)
+        if lease is None:
+            return None
+        if lease.expires <= (time.monotonic() if now is None else now):
+            del self.leases[robot_id]
+            return None
+        return lease.node
+
+    def expire(self, now=None) -> List[Lease]:
+        now = time.monotonic() if now is None else now
+        expired = [lease for lease in self.leases.values() if lease.expires <= now]
+        for lease in expired:
+            del self.leases[lease.robot_id]
+        return expired
+
+    def snapshot(self) -> List[dict]:
+        return [lease.to_dict() for lease in self.leases.values()]
+
+
+def parse_peers(spec: str) -> Dict[str, str]:
+    """"b=127.0.0.1:9201,c=unix:/tmp/c.sock" -> {"b": "127.0.0.1:9201", "c": "unix:/tmp/c.sock"}"""
+    peers = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        node, _, address = item.partition("=")
+        if not address:
+            raise ValueError(f"Peer must be node=address, got {item!r}")
+        peers[node.strip()] = address.strip()
+    return peers
@@ -0,0 +1,155 @@
+"""
+On-demand statistical profiler for the running servers.
+
+Nothing runs until a profile is requested: a sampler thread then reads the
+stack of every thread with sys._current_frames() every `interval` seconds for
+`seconds` seconds and counts identical stacks. The result is in collapsed
+("folded") format, one "frame;frame;frame count" line per stack, which
+flamegraph.pl, speedscope and inferno read directly. Optionally tracemalloc is
+switched on for the same window and the top allocation sites are reported.
+
+Triggers:
+    GET /profile?seconds=10&interval=0.005&tracemalloc=20&key=<API_KEY>   metrics side port
+    GET /api/admin/profile?seconds=10 (Authorization: Bearer <API_KEY>)    FastAPI
+    kill -USR1 <pid>   writes <PROFILE_DIR>/<service>_<time>.folded (and .alloc.txt)
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List
+
+import metrics
+from config import API_KEY, PROFILE_DIR, PROFILE_MAX_SECONDS, PROFILE_SIGNAL_SECONDS
+
+logger = logging.getLogger("profiler")
+
+_busy = threading.Lock()
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+def _frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(seconds, interval=0.005) -> Dict[str, int]:
+    """Blocking sampler: collapsed stack -> number of samples (rooted at the thread name)"""
+    own = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks: Counter = Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if thread_id not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            labels.append(names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+    return dict(stacks)
+
+
+def collapsed(stacks: Dict[str, int]) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda kv: -kv[1]))
+
+
+def top_allocations(snapshot, limit) -> List[dict]:
+    # Leave out the sampler's own allocations
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, __file__, all_frames=True),
+                                       tracemalloc.Filter(False, tracemalloc.__file__)])
+    stats = snapshot.statistics("traceback")[:limit]
+    return [{"size_kb": round(s.size / 1024, 1), "count": s.count,
+             "traceback": [f"{f.filename}:{f.lineno}" for f in s.traceback]} for s in stats]
+
+
+def run_profile(seconds, interval=0.005, allocations=0) -> dict:
+    """Sample for `seconds`; allocations > 0 also reports that many tracemalloc sites"""
+    seconds = min(float(seconds), PROFILE_MAX_SECONDS)
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    started_tracemalloc = False
+    try:
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            started_tracemalloc = True
+        started = time.time()
+        stacks = sample_stacks(seconds, interval)
+        result = {"started": started, "seconds": seconds, "interval": interval,
+                  "samples": sum(stacks.values()), "stacks": stacks}
+        if allocations:
+            result["allocations"] = top_allocations(tracemalloc.take_snapshot(), int(allocations))
+        return result
+    finally:
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _busy.release()
+
+
+async def profile(seconds, interval=0.005, allocations=0) -> dict:
+    """Run the sampler in a worker thread so the loop being profiled keeps running"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, run_profile, seconds, interval, allocations)
+
+
+def write_profile(result, service) -> str:
+    """Save a profile as <service>_<time>.folded (+ .alloc.txt), returns the .folded path"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{service}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    with open(base + ".folded", "w") as f:
+        f.write(collapsed(result["stacks"]))
+    if result.get("allocations"):
+        with open(base + ".alloc.txt", "w") as f:
+            for alloc in result["allocations"]:
+                f.write(f"{alloc['size_kb']} KiB in {alloc['count']} blocks\n")
+                f.writelines(f"    {line}\n" for line in alloc["traceback"])
+    return base + ".folded"
+
+
+def install_signal_handler(service, seconds=PROFILE_SIGNAL_SECONDS, allocations=20):
+    """SIGUSR1 writes a profile to PROFILE_DIR (Unix only, call from the running loop)"""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    loop = asyncio.get_running_loop()
+
+    async def on_signal():
+        try:
+            result = await profile(seconds, allocations=allocations)
+            logger.info(f"Profile written to {write_profile(result, service)}")
+        except ProfilerBusy as e:
+            logger.warning(str(e))
+
+    loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(on_signal()))
+
+
+def render(result, fmt="collapsed"):
+    """(content_type, body) for an HTTP response"""
+    if fmt == "json" or result.get("allocations"):
+        stacks = result.pop("stacks")
+        return "application/json", json.dumps({**result, "collapsed": collapsed(stacks)})
+    return "text/plain; charset=utf-8", collapsed(result["stacks"])
+
+
+async def _profile_endpoint(query):
+    if query.get("key") != API_KEY:
+        raise PermissionError("Missing or invalid key")
+    result = await profile(float(query.get("seconds", 10)), float(query.get("interval", 0.005)),
+                           int(query.get("tracemalloc", 0)))
+    return render(result, query.get("format", "collapsed"))
+
+
+metrics.add_endpoint("/profile", _profile_endpoint)
@@ -0,0 +1,84 @@
+"""
+Multi-sample telemetry frames.
+
+A robot can send 10-50 encoder or IMU readings in one line instead of one
+message (and one ack, one journal record, one DB row insert) per reading:
+
+    {"type": "encoder_batch", "robot_id": "robot1", "t0": 1760000000.0,
+     "samples": [[0.00, 12.5, -3.1, 8.0], [0.02, 12.7, -3.0, 8.1], ...]}
+
+    encoder_batch   [t, rpm_1, rpm_2, rpm_3]
+    imu_batch       [t, roll, pitch, yaw] or [t, roll, pitch, yaw, quat_w, quat_x, quat_y, quat_z]
+
+t is in seconds. With "t0" the sample time is t0 + t. Without it (firmware
+with no wall clock, t is its uptime) the last sample is taken as received at
+the frame's arrival time and the others are placed before it by their t.
+
+tcp_server forwards and journals a frame as one line without decoding it; the
+journal drainer unpacks it here into columns and robot_database.DataHandler
+loads them with COPY.
+"""
+import json
+import time
+import logging
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+from config import BATCH_MAX_SAMPLES
+
+logger = logging.getLogger("sample_batch")
+
+# Frame type -> (table, value columns after t, values required per sample)
+BATCH_TYPES: Dict[str, Tuple[str, Tuple[str, ...], int]] = {
+    "encoder_batch": ("encoder_data", ("rpm_1", "rpm_2", "rpm_3"), 3),
+    "imu_batch": ("imu_data", ("roll", "pitch", "yaw", "quat_w", "quat_x", "quat_y", "quat_z"), 3),
+}
+
+
+def is_batch(message: dict) -> bool:
+    return message.get("type") in BATCH_TYPES
+
+
+def unpack(frame: dict, received_at: Optional[float] = None) -> Tuple[List[datetime.datetime], List[list]]:
+    """
+    Timestamps (naive UTC, like the ORM columns) and one list per value column
+
+    Samples that are not lists of numbers of the right length are skipped;
+    a frame longer than BATCH_MAX_SAMPLES is truncated.
+    """
+    _, names, required = BATCH_TYPES[frame["type"]]
+    samples = frame.get("samples") or []
+    if len(samples) > BATCH_MAX_SAMPLES:
+        logger.warning(f"{frame['type']} of {frame.get('id', frame.get('robot_id'))} has {len(samples)} samples, "
+                       f"keeping the first {BATCH_MAX_SAMPLES}")
+        samples = samples[:BATCH_MAX_SAMPLES]
+
+    offsets = []
+    columns = [[] for _ in names]
+    width = len(names)
+    for sample in samples:
+        if not isinstance(sample, list) or len(sample) < required + 1:
+            continue
+        try:
+            values = [float(v) for v in sample[:width + 1]]
+        except (TypeError, ValueError):
+            continue
+        offsets.append(values[0])
+        for column, value in zip(columns, values[1:]):
+            column.append(value)
+        for column in columns[len(values) - 1:]:
+            column.append(None)  # IMU sample without quaternion
+
+    if not offsets:
+        return [], columns
+    t0 = frame.get("t0")
+    if t0 is None:
+        # Uptime clock: anchor the last sample at arrival
+        t0 = (received_at if received_at is not None else time.time()) - offsets[-1]
+    utc = datetime.datetime.utcfromtimestamp
+    return [utc(t0 + offset) for offset in offsets], columns
+
+
+def header(frame: dict) -> str:
+    """raw_data of the rows of a frame: the frame without its samples, shared by all of them"""
+    return json.dumps({key: value for key, value in frame.items() if key != "samples"})
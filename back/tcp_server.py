@@ -11,17 +11,52 @@ import random
 from datetime import datetime
 import traceback
 ENABLE_BACKEND_CONNECTION = True
-robots = {}  # robot_id -> websocket
-robot_data = {}  # robot_id -> registration data
-tcp_robots = {}  # robot_id -> (reader, writer)
+journal = None  # TelemetryJournal, dữ liệu robot được ghi vào đây trước khi vào DB
+journal_drainer = None
+capture = None  # CaptureWriter khi biến môi trường TCP_CAPTURE_FILE được đặt
+pending_commands = None  # tracing.PendingCommands, lệnh đã gửi tới robot đang chờ phản hồi
+bus = None  # worker_bus.WorkerBus khi chạy nhiều worker (ingest_workers.py), registry robot dùng chung
+local_bus = None  # gateway.LocalBus ở chế độ gateway (gateway.py): frontend cùng process, không qua bridge
+udp = None  # udp_telemetry.UDPTelemetry khi UDP_TELEMETRY_PORT được đặt
+
+from telemetry_journal import TelemetryJournal, JournalDrainer
+from ingest_capture import CaptureWriter
+import metrics
+import tracing
+import loop_monitor
+import profiler
+from worker_bus import WorkerBus
+from message_peek import peek
+from line_framer import LineFramer
+from udp_telemetry import UDPTelemetry
+from command_lanes import CommandLanes, stream_sender, setpoint_interval
+from timer_wheel import Keepalive
+from connection_registry import ConnectionRegistry
+from ingest_guard import IngestGuard, shed_ack
 
 # Import cấu hình
 from config import (
     TCP_SERVER_HOST, TCP_SERVER_PORT,
     BACKEND_HOST, BACKEND_PORT,
-    API_KEY, LOG_LEVEL, LOG_FILE, DEBUG
+    API_KEY, LOG_LEVEL, LOG_FILE, DEBUG, TCP_SERVER_METRICS_PORT, JOURNAL_DIR,
+    TCP_WORKER_METRICS_BASE_PORT, TCP_PASSTHROUGH, FULL_DECODE_TYPES, UDP_TELEMETRY_PORT, TCP_IDLE_TIMEOUT
 )
 
+# Metrics (GET /metrics trên TCP_SERVER_METRICS_PORT)
+TCP_CONNECTIONS = metrics.gauge("tcp_connections", "Open TCP client connections")
+TCP_CONNECTIONS_TOTAL = metrics.counter("tcp_connections_total", "Accepted TCP client connections")
+TCP_ROBOTS = metrics.gauge("tcp_registered_robots", "Robots registered over TCP")
+TCP_BYTES_RECEIVED = metrics.counter("tcp_received_bytes_total", "Bytes read from TCP clients")
+TCP_MESSAGES_RECEIVED = metrics.counter("tcp_messages_received_total", "Messages read from TCP clients", ["type"])
+TCP_PARSE_ERRORS = metrics.counter("tcp_parse_errors_total", "Lines that were not valid JSON")
+TCP_OVERSIZED = metrics.counter("tcp_oversized_frames_total", "Lines dropped for exceeding LINE_MAX_BYTES")
+TCP_PROCESSING_ERRORS = metrics.counter("tcp_processing_errors_total", "Messages that raised while being handled")
+TCP_MESSAGE_SECONDS = metrics.histogram("tcp_message_seconds", "Time from parsing a message to sending its response")
+TCP_FORWARDED = metrics.counter("tcp_forwarded_total", "Messages forwarded", ["direction"])
+TCP_FORWARD_ERRORS = metrics.counter("tcp_forward_errors_total", "Failed forwards", ["direction"])
+TCP_FORWARD_SECONDS = metrics.histogram("tcp_forward_seconds", "Time to forward one message to the bridge", ["direction"])
+TCP_DECODE = metrics.counter("tcp_messages_decode_total", "Messages forwarded as raw lines or fully decoded", ["path"])
+
 # Cấu hình logging
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
@@ -70,14 +105,10 @@ def conditional_log(level, message, is_heartbeat=False):
         logger.debug(message)
 
 # Khai báo biến toàn cục
-robots = {}  # {robot_id: socket}
-backend_connections = {}  # {robot_id: websocket}
 frontend_bridge = None  # WebSocket connection to frontend bridge
-clients = {}  # {client_id: socket}
-clients_lock = threading.Lock()
-robots_lock = threading.Lock()
-robot_data = {}  # Lưu trữ dữ liệu robot: {robot_id: {data}}
-bridge_connections = {}  # {robot_id: websocket}
+# Robot (TCP, WebSocket, socket của server cũ), điện thoại và WebSocket bridge: một registry, không khóa,
+# chỉ thay đổi trên event loop (thread khác đi qua registry.call_soon_threadsafe)
+registry = ConnectionRegistry()
 
 # === BACKEND CONNECTION MANAGEMENT ===
 
@@ -109,41 +140,102 @@ async def connect_to_ws_bridge():
         logger.error(f"Failed to connect to WebSocket Bridge: {e}")
         return False
 
+async def dispatch_command(data, received_at, raw=None):
+    """
+    Chuyển lệnh của frontend tới robot: trực tiếp nếu robot kết nối với process này,
+    qua bus nếu robot ở worker/node khác. Trả về ack cho frontend, None nếu không ai giữ robot.
+    
+    raw: dòng JSON gốc của lệnh khi data chỉ là các trường peek được (type, robot_id, trace_id);
+    robot cục bộ nhận nguyên dòng này, chỉ lệnh đi qua bus mới phải decode.
+    """
+    robot_id = data.get("robot_id")
+    trace_id = data.get(tracing.TRACE_KEY)
+    session = registry.get(robot_id) if robot_id else None
+    if session is not None and session.lanes is None:
+        session = None  # robot của server cũ, không nhận lệnh qua đường này
+    if robot_id and session is None and bus:
+        if raw is not None:
+            data, raw = json.loads(raw), None
+        if not bus.send_command(robot_id, data):
+            return None
+        # Robot thuộc worker khác: bus chuyển lệnh tới worker đang giữ kết nối
+        TCP_FORWARDED.labels("to_worker").inc()
+        ack = {
+            "type": "command_sent",
+            "robot_id": robot_id,
+            "original_type": data.get("type"),
+            "worker": bus.owner(robot_id),
+            "timestamp": time.time()
+        }
+        if trace_id:
+            add_trace(ack, robot_id, trace_id, received_at, data.get("type"), local=False)
+        return ack
+    if session is not None:
+        # Forward message to TCP robot
+        try:
+            if not session.lanes.put_command((raw if raw is not None else json.dumps(data)) + '\n', data.get("type"), robot_id):
+                raise ConnectionError("connection closed")
+            logger.info(f"[WS] Forwarded message to robot {robot_id}")
+            
+            # Send acknowledgment back to frontend
+            ack = {
+                "type": "command_sent",
+                "robot_id": robot_id,
+                "original_type": data.get("type"),
+                "timestamp": time.time()
+            }
+            if trace_id:
+                add_trace(ack, robot_id, trace_id, received_at, data.get("type"))
+            return ack
+        except Exception as e:
+            logger.error(f"[WS] Error forwarding to robot {robot_id}: {e}")
+            return {
+                "type": "error",
+                "robot_id": robot_id,
+                "message": f"Error forwarding to robot: {str(e)}",
+                "timestamp": time.time()
+            }
+    return None
+
+async def send_to_frontend(data, raw=None):
+    """
+    Gửi tin nhắn cho frontend: qua bus nội bộ ở chế độ gateway (không serialize), không thì qua WebSocket tới bridge
+    
+    raw: dòng JSON gốc của robot, được gửi nguyên văn thay cho data (chuyển tiếp không decode)
+    """
+    if raw is not None:
+        if local_bus is not None:
+            local_bus.publish_raw(raw)
+        else:
+            await frontend_bridge.send(raw)
+    elif local_bus is not None:
+        local_bus.publish(data)
+    else:
+        await frontend_bridge.send(json.dumps(data))
+
+def frontend_connected():
+    return local_bus is not None or frontend_bridge is not None
+
 async def handle_ws_bridge_messages(websocket):
     """Handle messages from WebSocket Bridge"""
     global frontend_bridge
     
     try:
         async for message in websocket:
+            received_at = time.time()
             try:
-                data = json.loads(message)
+                # Lệnh cho robot cục bộ được chuyển nguyên văn, chỉ cần robot_id để định tuyến
+                header = peek(message) if TCP_PASSTHROUGH else None
+                if header is not None and header[1] and header[0] not in FULL_DECODE_TYPES:
+                    data, raw = {"type": header[0], "robot_id": header[1], tracing.TRACE_KEY: header[2]}, message
+                else:
+                    data, raw = json.loads(message), None
                 logger.info(f"[WS] Received from WebSocket Bridge: {data.get('type')}")
                 
                 # Handle frontend messages and forward to appropriate robot
-                robot_id = data.get("robot_id")
-                if robot_id and robot_id in tcp_robots:
-                    # Forward message to TCP robot
-                    try:
-                        _, writer = tcp_robots[robot_id]
-                        writer.write((json.dumps(data) + '\n').encode('utf-8'))
-                        await writer.drain()
-                        logger.info(f"[WS] Forwarded message to robot {robot_id}")
-                        
-                        # Send acknowledgment back to frontend
-                        await websocket.send(json.dumps({
-                            "type": "command_sent",
-                            "robot_id": robot_id,
-                            "original_type": data.get("type"),
-                            "timestamp": time.time()
-                        }))
-                    except Exception as e:
-                        logger.error(f"[WS] Error forwarding to robot {robot_id}: {e}")
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "robot_id": robot_id,
-                            "message": f"Error forwarding to robot: {str(e)}",
-                            "timestamp": time.time()
-                        }))
+                ack = await dispatch_command(data, received_at, raw)
+                if ack is not None:
+                    await websocket.send(json.dumps(ack))
             except json.JSONDecodeError:
                 logger.error(f"[WS] Invalid JSON from WebSocket Bridge: {message}")
             except Exception as e:
@@ -229,14 +321,18 @@ async def connect_to_backend(robot_id, max_retries=1):
 
 async def send_to_backend(robot_id, data):
     """Gửi dữ liệu từ robot đến backend"""
-    if robot_id not in backend_connections:
+    session = registry.get(robot_id)
+    if session is None:
+        logger.error(f"Không thể gửi dữ liệu đến backend cho robot {robot_id}: Robot không kết nối")
+        return False
+    if session.backend is None:
         websocket = await connect_to_backend(robot_id)
         if not websocket:
             logger.error(f"Không thể gửi dữ liệu đến backend cho robot {robot_id}: Không có kết nối")
             return False
-        backend_connections[robot_id] = websocket
+        session.backend = websocket
     else:
-        websocket = backend_connections[robot_id]
+        websocket = session.backend
     
     try:
         # Đảm bảo có trường robot_id
@@ -252,7 +348,7 @@ async def send_to_backend(robot_id, data):
         
         # Thử kết nối lại
         try:
-            backend_connections[robot_id] = await connect_to_backend(robot_id)
+            session.backend = await connect_to_backend(robot_id)
         except:
             pass
         return False
@@ -270,7 +366,8 @@ def send_to_robot(robot_id, data):
     Returns:
         bool: True nếu gửi thành công, False nếu thất bại
     """
-    if robot_id not in robots:
+    session = registry.get(robot_id)
+    if session is None or session.transport != "socket" or session.conn is None:
         logger.error(f"Không thể gửi dữ liệu: Robot {robot_id} không kết nối")
         return False
     
@@ -282,7 +379,7 @@ def send_to_robot(robot_id, data):
             data_str = str(data) + '\n'
         
         # Gửi dữ liệu
-        robots[robot_id].sendall(data_str.encode('utf-8'))
+        session.conn.sendall(data_str.encode('utf-8'))
         
         # Log với mức độ phù hợp
         if isinstance(data, dict) and data.get("frontend", False):
@@ -291,8 +388,7 @@ def send_to_robot(robot_id, data):
             logger.info(f"Đã gửi dữ liệu đến robot {robot_id}: {data}")
             
         # Cập nhật thời gian hoạt động cuối cùng
-        if robot_id in robot_data:
-            robot_data[robot_id]["last_activity"] = time.time()
+        session.last_seen = time.time()
             
         return True
         
@@ -300,20 +396,17 @@ def send_to_robot(robot_id, data):
         logger.error(f"Lỗi gửi dữ liệu đến robot {robot_id}: {e}")
         
         # Nếu lỗi kết nối, đánh dấu robot đã ngắt kết nối
-        if robot_id in robots:
-            del robots[robot_id]
-        if robot_id in robot_data:
-            del robot_data[robot_id]
-        if robot_id in backend_connections and backend_connections[robot_id]:
-            asyncio.create_task(backend_connections[robot_id].close())
-            backend_connections[robot_id] = None
+        registry.call_soon_threadsafe(registry.remove, robot_id, session.conn)
+        if session.backend:
+            asyncio.create_task(session.backend.close())
+            session.backend = None
             
         return False
 
 async def handle_robot_connection(client_socket, addr):
     """Xử lý kết nối từ robot"""
     client_id = f"{addr[0]}:{addr[1]}"
-    buffer = ""
+    framer = LineFramer()
     robot_id = None
     
     try:
@@ -333,9 +426,7 @@ async def handle_robot_connection(client_socket, addr):
                 break
             
             # Xử lý dữ liệu nhận được, tách các thông điệp hoàn chỉnh
-            buffer += data.decode('utf-8')
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
+            for line in framer.lines(data):
                 
                 # Bỏ qua dòng trống
                 if not line.strip():
@@ -349,7 +440,9 @@ async def handle_robot_connection(client_socket, addr):
                     # Lấy robot_id từ thông điệp nếu chưa có
                     if not robot_id and "robot_id" in message:
                         robot_id = message["robot_id"]
-                        robots[robot_id] = client_socket
+                        session = registry.get(robot_id)
+                        if session is None or session.conn is not client_socket:
+                            registry.call_soon_threadsafe(registry.add, robot_id, client_id, "socket", client_socket)
                         logger.info(f"Đã đăng ký robot {robot_id} từ {client_id}")
                         
                 except json.JSONDecodeError:
@@ -361,9 +454,9 @@ async def handle_robot_connection(client_socket, addr):
         logger.error(f"Lỗi xử lý kết nối từ {robot_id or client_id}: {e}")
     
     finally:
-        # Dọn dẹp khi kết nối đóng
-        if robot_id and robot_id in robots:
-            del robots[robot_id]
+        # Dọn dẹp khi kết nối đóng (chạy trong thread riêng: registry được cập nhật trên event loop chính)
+        if robot_id:
+            registry.call_soon_threadsafe(registry.remove, robot_id, client_socket)
         
         try:
             client_socket.close()
@@ -398,7 +491,7 @@ async def process_robot_message(message, client_socket, client_id):
             return
         
         # Lưu thông tin robot
-        robots[robot_id] = client_socket
+        registry.call_soon_threadsafe(registry.add, robot_id, client_id, "socket", client_socket, None, message)
         logger.info(f"Robot {robot_id} đã kết nối (địa chỉ {client_id})")
         
         # Gửi xác nhận
@@ -547,7 +640,7 @@ def handle_frontend_message(message):
         logger.warning(f"Nhận loại thông điệp không xác định từ frontend: {message_type}")
         
         # Chuyển tiếp đến robot nếu có chỉ định robot_id
-        if robot_id in robots:
+        if robot_id in registry:
             send_to_robot(robot_id, message)
             return {
                 "type": "generic_response",
@@ -600,8 +693,7 @@ async def handle_websocket_connection(websocket, path):
             return
             
         # Đăng ký robot
-        robots[robot_id] = websocket
-        robot_data[robot_id] = data
+        registry.add(robot_id, client_id, "ws", websocket, info=data)
         
         logger.info(f"[WS] Đã đăng ký robot {robot_id} từ {client_id}")
         
@@ -633,12 +725,8 @@ async def handle_websocket_connection(websocket, path):
         logger.error(traceback.format_exc())
     finally:
         # Dọn dẹp kết nối
-        if robot_id in robots:
-            logger.info(f"[WS] Xóa robot {robot_id} khỏi danh sách robots")
-            del robots[robot_id]
-        if robot_id in robot_data:
-            logger.info(f"[WS] Xóa robot {robot_id} khỏi danh sách robot_data")
-            del robot_data[robot_id]
+        if robot_id and registry.remove(robot_id, websocket) is not None:
+            logger.info(f"[WS] Xóa robot {robot_id} khỏi registry")
 
 # Thêm heartbeat để duy trì kết nối
 async def start_heartbeat():
@@ -646,15 +734,15 @@ async def start_heartbeat():
     while True:
         try:
             # Gửi heartbeat đến tất cả bridge connections
-            for robot_id, conn in bridge_connections.items():
+            for session in registry.of_type("bridge"):
                 try:
-                    if conn and conn.open:
-                        await conn.send(json.dumps({
+                    if session.conn and session.conn.open:
+                        await session.conn.send(json.dumps({
                             "type": "heartbeat",
                             "timestamp": time.time()
                         }))
                 except Exception as e:
-                    logger.error(f"Lỗi gửi heartbeat đến bridge {robot_id}: {e}")
+                    logger.error(f"Lỗi gửi heartbeat đến bridge {session.peer}: {e}")
                     
             # Đợi 30 giây
             await asyncio.sleep(30)
@@ -665,6 +753,9 @@ async def start_heartbeat():
 
 async def start_server(host='0.0.0.0', port=9000, ws_port=9002):
     """Khởi động TCP server and WebSocket server"""
+    # Các thread xử lý kết nối cập nhật registry qua loop này
+    registry.bind_loop()
+    
     # Tạo TCP Server cho robot
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -709,49 +800,6 @@ async def start_server(host='0.0.0.0', port=9000, ws_port=9002):
         server.close()
         ws_server.close()
 
-        # Khởi động task monitoring
-        asyncio.create_task(monitor_connections())
-        
-        # Giữ server hoạt động
-        while True:
-            await asyncio.sleep(3600)  # Chờ 1 giờ
-    
-    # Hàm để giám sát các kết nối
-    async def monitor_connections():
-        """Giám sát các kết nối and làm sạch các kết nối đã mất"""
-        while True:
-            try:
-                # Kiểm tra kết nối robot
-                with robots_lock:
-                    for robot_id in list(robots.keys()):
-                        # Kiểm tra xem robot còn kết nối không
-                        if robot_id in robot_data:
-                            last_activity = robot_data[robot_id].get("last_activity", 0)
-                            if time.time() - last_activity > 300:  # 5 phút không hoạt động
-                                logger.warning(f"Robot {robot_id} không hoạt động trong 5 phút, đánh dấu là ngắt kết nối")
-                                try:
-                                    del robots[robot_id]
-                                except KeyError:
-                                    pass
-    
-                # Kiểm tra kết nối backend
-                for robot_id in list(backend_connections.keys()):
-                    ws = backend_connections.get(robot_id)
-                    if ws and not ws.open:
-                        logger.warning(f"Kết nối backend cho robot {robot_id} đã đóng, xóa khỏi danh sách")
-                        backend_connections[robot_id] = None
-    
-                # Đợi 60 giây trước khi kiểm tra lại
-                await asyncio.sleep(60)
-            except Exception as e:
-                logger.error(f"Lỗi trong monitor_connections: {e}")
-                await asyncio.sleep(60)  # Vẫn đợi trước khi thử lại
-
-# Entry point
-if __name__ == "__main__":
-    logger.info("Khởi động TCP Server...")
-    asyncio.run(start_server())
-
 # Trong hàm handle_data or process_message, thêm xử lý cho các loại yêu cầu mới
 
 def handle_data(client_socket, client_id, robot_id, data):
@@ -767,10 +815,7 @@ def handle_data(client_socket, client_id, robot_id, data):
             logger.info(f"Xử lý yêu cầu get_robot_connections từ {client_id}")
         
         # Tạo danh sách các robot đang kết nối
-        robot_connections = {}
-        with robots_lock:
-            for rid in robots:
-                robot_connections[rid] = robots[rid]["connected"]
+        robot_connections = {rid: True for rid in registry.robot_ids()}
         
         # Gửi thông tin kết nối robot
         response = {
@@ -809,34 +854,18 @@ def handle_data(client_socket, client_id, robot_id, data):
     
     # Xử lý lệnh get_robot_list
     if data_type == "get_robot_list":
-        # Tạo danh sách robot kèm thông tin
+        # Tạo danh sách robot kèm thông tin (điện thoại được đăng ký là robot1 với device_type "phone")
         robot_list = []
-        with robots_lock:
-            for rid, info in robots.items():
-                robot_list.append({
-                    "id": rid,
-                    "connected": info["connected"],
-                    "ip": info.get("address", "unknown"),
-                    "last_seen": time.strftime("%H:%M:%S", time.localtime(info.get("last_seen", time.time())))
-                })
-        
-        # Thông tin điện thoại mới kết nối
-        # Kiểm tra nếu có kết nối từ điện thoại (IP không phải 127.0.0.1)
-        with clients_lock:
-            for cid, socket_info in clients.items():
-                if "127.0.0.1" not in cid and socket_info.get("robot_id") is None:
-                    parts = cid.split(":")
-                    if len(parts) == 2:
-                        ip = parts[0]
-                        # Thêm điện thoại ando danh sách, gán tạm là robot1 nếu chưa xác định
-                        phone_robot_id = "phone_" + ip.replace(".", "_")
-                        robot_list.append({
-                            "id": "robot1",  # Gán tạm là robot1
-                            "connected": True,
-                            "ip": ip,
-                            "last_seen": time.strftime("%H:%M:%S", time.localtime(time.time())),
-                            "device_type": "phone"
-                        })
+        for session in registry:
+            entry = {
+                "id": session.robot_id,
+                "connected": True,
+                "ip": session.host or "unknown",
+                "last_seen": time.strftime("%H:%M:%S", time.localtime(session.last_seen))
+            }
+            if session.device_type != "robot":
+                entry["device_type"] = session.device_type
+            robot_list.append(entry)
         
         # Gửi phản hồi
         response = {
@@ -912,10 +941,7 @@ def simulate_robot_connection(robot_id):
         logger.error(f"Lỗi khởi tạo giả lập cho robot {robot_id}: {e}")
     finally:
         # Đánh dấu robot ngắt kết nối khi kết thúc
-        with robots_lock:
-            if robot_id in robots:
-                robots[robot_id]["connected"] = False
-                robots[robot_id]["socket"] = None
+        registry.call_soon_threadsafe(remove_simulated_robot, robot_id)
         logger.info(f"Kết thúc giả lập kết nối cho robot {robot_id}")
 
 # Sửa lỗi 'int' object has no attribute 'get'
@@ -952,10 +978,7 @@ def handle_client_message(client_socket, client_id, data_str):
         # Xử lý các loại thông điệp
         if message_type == "get_robot_connections":
             # Tạo danh sách các robot đang kết nối
-            robot_connections = {}
-            with robots_lock:
-                for rid in robots:
-                    robot_connections[rid] = robots[rid]["connected"]
+            robot_connections = {rid: True for rid in registry.robot_ids()}
             
             # Gửi thông tin kết nối robot
             return {
@@ -976,13 +999,6 @@ async def handle_phone_connection(client_socket, addr):
     """Xử lý kết nối từ điện thoại"""
     client_id = f"{addr[0]}:{addr[1]}"
     
-    with clients_lock:
-        clients[client_id] = {
-            "socket": client_socket,
-            "robot_id": None,  # Chưa xác định robot_id
-            "device_type": "phone"
-        }
-    
     try:
         # Gửi welcome message
         welcome_msg = json.dumps({
@@ -994,22 +1010,8 @@ async def handle_phone_connection(client_socket, addr):
         
         logger.info(f"Điện thoại kết nối từ {client_id}")
         
-        # Cập nhật robot1 có kết nối mới
-        with robots_lock:
-            if "robot1" in robots:
-                # Cập nhật trạng thái robot1 là đã kết nối
-                robots["robot1"]["connected"] = True
-                robots["robot1"]["last_seen"] = time.time()
-                robots["robot1"]["socket"] = client_socket
-                robots["robot1"]["address"] = addr[0]
-            else:
-                # Tạo mới robot1 nếu chưa có
-                robots["robot1"] = {
-                    "connected": True,
-                    "socket": client_socket,
-                    "last_seen": time.time(),
-                    "address": addr[0]
-                }
+        # Điện thoại chưa xác định robot_id được gán tạm là robot1
+        registry.call_soon_threadsafe(registry.add, "robot1", client_id, "socket", client_socket, None, None, "phone")
         
         buffer = ""
         # Vòng lặp nhận dữ liệu
@@ -1045,20 +1047,13 @@ async def handle_phone_connection(client_socket, addr):
         logger.info(f"Đóng kết nối từ điện thoại {client_id}")
         
         # Cập nhật trạng thái robot1
-        with robots_lock:
-            if "robot1" in robots:
-                robots["robot1"]["connected"] = False
-                robots["robot1"]["socket"] = None
+        registry.call_soon_threadsafe(registry.remove, "robot1", client_socket)
         
-        # Đóng socket and xóa khỏi danh sách
+        # Đóng socket
         try:
             client_socket.close()
         except:
             pass
-        
-        with clients_lock:
-            if client_id in clients:
-                del clients[client_id]
 
 # Hàm kiểm tra nếu là heartbeat message
 def is_heartbeat_message(data):
@@ -1148,27 +1143,27 @@ def handle_ws_bridge_message(message):
             "timestamp": time.time()
         }
 
+def remove_simulated_robot(robot_id):
+    """Bỏ robot mô phỏng khỏi registry (không đụng tới robot thật cùng robot_id)"""
+    session = registry.get(robot_id)
+    if session is not None and session.device_type == "simulator":
+        registry.remove(robot_id)
+
 # Thêm or cập nhật hàm xử lý connect_robot_simulator
 def handle_connect_robot_simulator(data):
     """Xử lý lệnh mô phỏng kết nối robot"""
     robot_id = data.get("robot_id", "robot1")
     
-    with robots_lock:
-        # Kiểm tra xem robot đã tồn tại chưa
-        if robot_id not in robots:
-            robots[robot_id] = {
-                "socket": None,
-                "connected": True,  # Thiết lập trạng thái kết nối là True
-                "last_seen": time.time(),
-                "simulated": True  # Đánh dấu đây là robot mô phỏng
-            }
-            logger.info(f"Đã tạo robot mô phỏng: {robot_id}")
-        else:
-            # Cập nhật trạng thái kết nối
-            robots[robot_id]["connected"] = True
-            robots[robot_id]["last_seen"] = time.time()
-            robots[robot_id]["simulated"] = True
-            logger.info(f"Đã cập nhật robot mô phỏng: {robot_id}")
+    # Kiểm tra xem robot đã tồn tại chưa
+    session = registry.get(robot_id)
+    if session is None:
+        # Robot mô phỏng: không có kết nối riêng, device_type "simulator"
+        registry.add(robot_id, None, "simulated", device_type="simulator")
+        logger.info(f"Đã tạo robot mô phỏng: {robot_id}")
+    else:
+        # Cập nhật trạng thái kết nối
+        session.last_seen = time.time()
+        logger.info(f"Đã cập nhật robot mô phỏng: {robot_id}")
     
     # Khởi động thread giả lập robot
     threading.Thread(
@@ -1247,16 +1242,17 @@ async def handle_robot_messages(robot_id, websocket):
                     logger.debug(f"[ROBOT] Không có WebSocket Bridge để gửi dữ liệu từ {robot_id}")
                 
                 # Chuyển tiếp đến backend
-                if robot_id in backend_connections and backend_connections[robot_id]:
+                session = registry.get(robot_id)
+                if session is not None and session.backend:
                     # Bỏ qua các tin nhắn heartbeat để giảm tải backend
                     if not is_heartbeat:  
                         try:
-                            await backend_connections[robot_id].send(json.dumps(data))
+                            await session.backend.send(json.dumps(data))
                             logger.info(f"[ROBOT] Đã gửi dữ liệu từ robot {robot_id} đến backend")
                         except Exception as e:
                             logger.error(f"[ROBOT] Lỗi gửi dữ liệu đến backend cho robot {robot_id}: {e}")
                             # Nếu lỗi kết nối, thử kết nối lại
-                            backend_connections[robot_id] = await connect_to_backend(robot_id)
+                            session.backend = await connect_to_backend(robot_id)
                 
                 
                 # Xử lý các lệnh đặc biệt nếu cần
@@ -1354,7 +1350,7 @@ async def handle_bridge_message(websocket):
     # Thiết lập bridge connection
     frontend_bridge = websocket
     bridge_id = f"bridge-{client_id}"
-    bridge_connections[bridge_id] = websocket
+    registry.add(None, client_id, "ws", websocket, device_type="bridge")
     
     logger.info(f"[BRIDGE] WebSocket Bridge đã kết nối từ {client_id}")
     
@@ -1371,8 +1367,8 @@ async def handle_bridge_message(websocket):
         logger.error(f"[BRIDGE] Lỗi gửi welcome message đến bridge: {e}")
     
     # Log trạng thái kết nối hiện tại
-    logger.info(f"[BRIDGE] Số robots đang kết nối: {len(robots)}")
-    for rid, _ in robots.items():
+    logger.info(f"[BRIDGE] Số robots đang kết nối: {len(registry)}")
+    for rid in registry.robot_ids():
         logger.info(f"[BRIDGE] - Robot đang kết nối: {rid}")
     
     try:
@@ -1432,9 +1428,10 @@ async def handle_bridge_message(websocket):
         if frontend_bridge == websocket:
             logger.info(f"[BRIDGE] Xóa frontend_bridge")
             frontend_bridge = None
-        if bridge_id in bridge_connections:
-            logger.info(f"[BRIDGE] Xóa {bridge_id} khỏi bridge_connections")
-            del bridge_connections[bridge_id]
+        session = registry.by_peer(client_id)
+        if session is not None and session.conn is websocket:
+            logger.info(f"[BRIDGE] Xóa {bridge_id} khỏi registry")
+            registry.remove_peer(client_id)
         logger.info(f"[BRIDGE] Đã đóng kết nối WebSocket Bridge từ {client_id}")
 
 def handle_message(data):
@@ -1461,11 +1458,7 @@ def handle_message(data):
     
     elif message_type == "get_robot_status" and robot_id != "unknown":
         # Kiểm tra trạng thái robot
-        is_connected = False
-        if robot_id in robots:
-            is_connected = True
-        elif robot_id in tcp_robots:
-            is_connected = True
+        is_connected = robot_id in registry
             
         return {
             "type": "robot_status",
@@ -1480,7 +1473,7 @@ def handle_message(data):
             "type": "server_info",
             "version": "1.0.0",
             "uptime": int(time.time() - start_time),
-            "robots_count": len(robots) + len(tcp_robots),
+            "robots_count": len(registry),
             "timestamp": time.time()
         }
     
@@ -1494,24 +1487,22 @@ def handle_message(data):
     elif robot_id != "unknown":
         # Chuyển tiếp tin nhắn đến robot nếu có thể
         forwarded = False
+        session = registry.get(robot_id)
         
-        if robot_id in robots:
+        if session is not None and session.transport == "ws":
             try:
                 # Robot kết nối qua WebSocket
-                asyncio.create_task(robots[robot_id].send(json.dumps(data)))
+                asyncio.create_task(session.conn.send(json.dumps(data)))
                 logger.info(f"Đã chuyển tiếp tin nhắn tới robot {robot_id} qua WebSocket")
                 forwarded = True
             except Exception as e:
                 logger.error(f"Không thể chuyển tiếp tin nhắn đến robot {robot_id} (WebSocket): {e}")
                 
-        elif robot_id in tcp_robots:
+        elif session is not None and session.lanes is not None:
             try:
                 # Robot kết nối qua TCP
-                _, writer = tcp_robots[robot_id]
-                writer.write((json.dumps(data) + '\n').encode('utf-8'))
-                asyncio.create_task(writer.drain())
+                forwarded = session.lanes.put_command(json.dumps(data) + '\n', message_type, robot_id)
                 logger.info(f"Đã chuyển tiếp tin nhắn tới robot {robot_id} qua TCP")
-                forwarded = True
             except Exception as e:
                 logger.error(f"Không thể chuyển tiếp tin nhắn đến robot {robot_id} (TCP): {e}")
         
@@ -1540,12 +1531,33 @@ def handle_message(data):
         "timestamp": time.time()
     }
 
+def add_trace(ack, robot_id, trace_id, received_at, command_type, local=True):
+    """
+    Ghi span tcp_server.forward của lệnh và gửi kèm trong ack để bridge ghép trace
+    
+    local=False: lệnh đã chuyển qua bus, phản hồi của robot được worker giữ robot chờ.
+    """
+    span = tracing.RECORDER.record(trace_id, "tcp_server.forward", received_at, robot_id=robot_id, type=command_type)
+    if local and pending_commands is not None:
+        pending_commands.add(robot_id, trace_id, span.end)
+    ack[tracing.TRACE_KEY] = trace_id
+    ack[tracing.SPANS_KEY] = [span.to_dict()]
+
+# Kết nối robot: không có heartbeat từ server, chỉ đóng kết nối không hoạt động (timer wheel chung, không có task giám sát riêng)
+robot_keepalive = Keepalive("tcp_server", idle_timeout=TCP_IDLE_TIMEOUT or None)
+
 async def handle_tcp_client(reader, writer):
     """Xử lý kết nối TCP client"""
     addr = writer.get_extra_info('peername')
     client_id = f"{addr[0]}:{addr[1]}" if addr else "unknown"
     client_robot_id = None  # Track robot ID for this connection
+    session = None  # registry session sau khi robot đăng ký
+    capture_conn = None
+    lanes = None
+    guard = None
     logger.info(f"[TCP] Kết nối mới từ {client_id}")
+    TCP_CONNECTIONS.inc()
+    TCP_CONNECTIONS_TOTAL.inc()
     
     try:
         # Gửi tin nhắn chào mừng
@@ -1558,38 +1570,83 @@ async def handle_tcp_client(reader, writer):
         await writer.drain()
         logger.info(f"[TCP] Đã gửi welcome đến {client_id}: {welcome_message.strip()}")
         
+        # Từ đây mọi tin gửi cho client (ack, lệnh) đi qua một writer task theo mức ưu tiên
+        lanes = CommandLanes(client_id, stream_sender(writer))
+        
+        # Robot không gửi gì trong TCP_IDLE_TIMEOUT giây thì bị đóng kết nối
+        robot_keepalive.add(writer, None, writer.close)
+        
+        # Giới hạn tốc độ đọc, dừng đọc khi ack dồn lại, bỏ tin ít giá trị khi quá tải (ingest_guard.py)
+        guard = IngestGuard(client_id, lanes)
+        
+        # Ghi lại kết nối nếu đang capture
+        if capture:
+            capture_conn = capture.open(client_id)
+        
         # Xử lý dữ liệu
-        buffer = ""
+        framer = LineFramer()
         while True:
-            # Đọc dữ liệu
+            # Đọc dữ liệu (sau khi guard cho phép: còn token, hàng đợi ack chưa đầy)
+            await guard.pace()
             data = await reader.read(4096)
             if not data:
                 logger.info(f"[TCP] Kết nối đóng từ {client_id}")
                 break
+            received_at = time.time()
+            TCP_BYTES_RECEIVED.inc(len(data))
+            robot_keepalive.touch(writer)
+            if session is not None:
+                session.last_seen = received_at
                 
             # Log dữ liệu raw nhận được
-            raw_data = data.decode('utf-8')
-            logger.debug(f"[TCP] Nhận raw từ {client_id}: {raw_data}")
-                
-            # Thêm vào buffer
-            buffer += raw_data
+            logger.debug(f"[TCP] Nhận raw từ {client_id}: {data!r}")
             
-            # Xử lý từng dòng (tin nhắn)
-            while '\n' in buffer:
-                message, buffer = buffer.split('\n', 1)
+            # Xử lý từng dòng (tin nhắn), kể cả nhiều dòng trong cùng một lần đọc
+            dropped = framer.dropped
+            lines = framer.lines(data)
+            if framer.dropped != dropped:
+                TCP_OVERSIZED.inc(framer.dropped - dropped)
+                logger.warning(f"[TCP] Bỏ dòng dài hơn {framer.max_frame} bytes từ {client_id}")
+            if session is not None:
+                session.messages += len(lines)
+            for message in lines:
                 if not message.strip():
                     continue
+                
+                if capture:
+                    capture.frame(capture_conn, message, received_at)
                     
                 # Log tin nhắn nhận được
                 logger.info(f"[TCP] Nhận từ {client_id}: {message}")
                 
+                started = time.perf_counter()
                 try:
-                    # Parse JSON
-                    data = json.loads(message)
+                    # Chỉ đọc type/robot_id; tin được chuyển nguyên văn trừ khi phải đọc hoặc sửa nội dung:
+                    # type trong FULL_DECODE_TYPES, lệnh của frontend, có "ts" để đóng dấu, hoặc có thể là phản hồi lệnh đang trace
+                    data = None
+                    header = peek(message) if TCP_PASSTHROUGH else None
+                    if header is not None and (
+                            header[0] in FULL_DECODE_TYPES or '"frontend"' in message or '"ts"' in message
+                            or (pending_commands is not None and pending_commands.waiting(client_robot_id, header[0]))):
+                        header = None
+                    if header is None:
+                        # Parse JSON
+                        data = json.loads(message)
+                        msg_type = data.get("type", "unknown")
+                        robot_id = data.get("robot_id", "unknown")
+                        TCP_DECODE.labels("decoded").inc()
+                    else:
+                        msg_type = header[0]
+                        robot_id = header[1] or "unknown"
+                        TCP_DECODE.labels("passthrough").inc()
                     
                     # Log loại tin nhắn
-                    msg_type = data.get("type", "unknown")
-                    robot_id = data.get("robot_id", "unknown")
+                    TCP_MESSAGES_RECEIVED.labels(msg_type).inc()
+                    
+                    # Quá tải: tin ít giá trị bị bỏ trước khi ghi journal/chuyển tiếp, robot nhận ack "shed"
+                    if guard.admit(msg_type, message) is not None:
+                        lanes.put(shed_ack(msg_type))
+                        continue
                     logger.info(f"[TCP] Xử lý tin nhắn từ {client_id}: type={msg_type}, robot_id={robot_id}")
                     
                     # FIX: Handle registration with proper confirmation
@@ -1598,11 +1655,15 @@ async def handle_tcp_client(reader, writer):
                         client_robot_id = robot_id
                         logger.info(f"[TCP] Đăng ký robot {robot_id} từ {client_id}")
                         
-                        # Lưu kết nối TCP robot
-                        tcp_robots[robot_id] = (reader, writer)
+                        # Lưu kết nối TCP robot và thông tin đăng ký (đăng ký lại trên cùng kết nối thay session cũ)
+                        session = registry.add(robot_id, client_id, "tcp", writer, lanes, data,
+                                               (data or {}).get("device_type") or "robot")
+                        lanes.min_interval = setpoint_interval(robot_id)
+                        guard.set_robot(robot_id)
+                        TCP_ROBOTS.set(registry.count(transport="tcp"))
                         
-                        # Lưu thông tin robot
-                        robot_data[robot_id] = data
+                        if bus:
+                            bus.register(robot_id, data)
                         
                         # Gửi xác nhận đăng ký - IMPORTANT: Use registration_confirmation
                         response = {
@@ -1611,22 +1672,24 @@ async def handle_tcp_client(reader, writer):
                             "status": "success", 
                             "timestamp": time.time()
                         }
+                        if udp is not None and addr:
+                            # Token cho kênh telemetry UDP, gắn với robot và IP của kết nối này
+                            response["udp"] = {"port": udp.port, "token": udp.issue(robot_id, addr[0])}
                         
                         # Gửi response
-                        response_str = json.dumps(response) + '\n'
-                        writer.write(response_str.encode('utf-8'))
-                        await writer.drain()
+                        lanes.put(json.dumps(response) + '\n')
                         logger.info(f"[TCP] Đã gửi registration_confirmation đến {client_id}: {response}")
+                        TCP_MESSAGE_SECONDS.observe(time.perf_counter() - started)
                         
                         # Forward to frontend if connected
-                        if frontend_bridge:
+                        if frontend_connected():
                             try:
-                                await frontend_bridge.send(json.dumps({
+                                await send_to_frontend({
                                     "type": "robot_connected",
                                     "robot_id": robot_id,
                                     "info": data,
                                     "timestamp": time.time()
-                                }))
+                                })
                                 logger.info(f"[TCP] Forwarded robot registration to frontend")
                             except Exception as e:
                                 logger.error(f"[TCP] Error forwarding registration to frontend: {e}")
@@ -1634,15 +1697,17 @@ async def handle_tcp_client(reader, writer):
                         continue  # Skip normal response handling
                     
                     # FIX: Handle frontend messages
-                    if "frontend" in data and robot_id != "unknown":
+                    if data is not None and "frontend" in data and robot_id != "unknown":
                         # This is a message from frontend to robot
-                        if robot_id in tcp_robots:
+                        target = registry.get(robot_id)
+                        if target is not None and target.lanes is not None:
                             # Forward to TCP robot
-                            _, robot_writer = tcp_robots[robot_id]
+                            robot_lanes = target.lanes
                             try:
                                 # Forward the message
-                                robot_writer.write((json.dumps(data) + '\n').encode('utf-8'))
-                                await robot_writer.drain()
+                                if not robot_lanes.put_command(json.dumps(data) + '\n', msg_type, robot_id):
+                                    raise ConnectionError("connection closed")
+                                TCP_FORWARDED.labels("to_robot").inc()
                                 logger.info(f"[TCP] Forwarded message to robot {robot_id}")
                                 
                                 # Send acknowledgment
@@ -1652,7 +1717,10 @@ async def handle_tcp_client(reader, writer):
                                     "status": "success",
                                     "timestamp": time.time()
                                 }
+                                if data.get(tracing.TRACE_KEY):
+                                    add_trace(response, robot_id, data[tracing.TRACE_KEY], received_at, msg_type)
                             except Exception as e:
+                                TCP_FORWARD_ERRORS.labels("to_robot").inc()
                                 logger.error(f"[TCP] Error forwarding to robot {robot_id}: {e}")
                                 response = {
                                     "type": "error",
@@ -1660,6 +1728,18 @@ async def handle_tcp_client(reader, writer):
                                     "message": f"Error forwarding to robot: {str(e)}",
                                     "timestamp": time.time()
                                 }
+                        elif bus and bus.send_command(robot_id, data):
+                            # Robot thuộc worker khác
+                            TCP_FORWARDED.labels("to_worker").inc()
+                            response = {
+                                "type": "command_sent",
+                                "robot_id": robot_id,
+                                "status": "success",
+                                "worker": bus.owner(robot_id),
+                                "timestamp": time.time()
+                            }
+                            if data.get(tracing.TRACE_KEY):
+                                add_trace(response, robot_id, data[tracing.TRACE_KEY], received_at, msg_type, local=False)
                         else:
                             # Robot not connected
                             response = {
@@ -1671,11 +1751,28 @@ async def handle_tcp_client(reader, writer):
                     
                     # FIX: Handle data from robot to frontend
                     elif client_robot_id and msg_type not in ["heartbeat", "ping", "pong"]:
+                        # Ghi vào journal trước, drainer sẽ đưa vào DB
+                        if journal:
+                            journal.append(client_robot_id, message)
+                        
+                        # Phản hồi của robot cho một lệnh đang được trace
+                        if pending_commands is not None and data is not None:
+                            reply_span = pending_commands.match(client_robot_id, data)
+                            if reply_span is not None:
+                                data[tracing.TRACE_KEY] = reply_span.trace_id
+                                data[tracing.SPANS_KEY] = [reply_span.to_dict()]
+                        
                         # This is data from a registered robot - forward to frontend
-                        if frontend_bridge:
+                        if frontend_connected():
                             try:
+                                # Đóng dấu thời gian theo từng chặng nếu tin nhắn mang "ts" (benchmark)
+                                if data is not None and isinstance(data.get("ts"), dict):
+                                    data["ts"]["tcp_server"] = received_at
+                                
                                 # Forward to frontend
-                                await frontend_bridge.send(json.dumps(data))
+                                with TCP_FORWARD_SECONDS.labels("to_bridge").time():
+                                    await send_to_frontend(data, raw=message if data is None else None)
+                                TCP_FORWARDED.labels("to_bridge").inc()
                                 logger.info(f"[TCP] Forwarded {msg_type} from robot {robot_id} to frontend")
                                 
                                 # Send acknowledgment to robot
@@ -1686,6 +1783,7 @@ async def handle_tcp_client(reader, writer):
                                     "timestamp": time.time()
                                 }
                             except Exception as e:
+                                TCP_FORWARD_ERRORS.labels("to_bridge").inc()
                                 logger.error(f"[TCP] Error forwarding to frontend: {e}")
                                 response = {
                                     "type": "error",
@@ -1711,12 +1809,12 @@ async def handle_tcp_client(reader, writer):
                         }
                     
                     # Send response
-                    response_str = json.dumps(response) + '\n'
-                    writer.write(response_str.encode('utf-8'))
-                    await writer.drain()
+                    lanes.put(json.dumps(response) + '\n')
+                    TCP_MESSAGE_SECONDS.observe(time.perf_counter() - started)
                     logger.info(f"[TCP] Sent to {client_id}: {response}")
                     
                 except json.JSONDecodeError:
+                    TCP_PARSE_ERRORS.inc()
                     logger.error(f"[TCP] Invalid JSON from {client_id}: {message}")
                     # Send error response
                     error_msg = json.dumps({
@@ -1725,9 +1823,9 @@ async def handle_tcp_client(reader, writer):
                         "message": "Invalid JSON data",
                         "timestamp": time.time()
                     }) + '\n'
-                    writer.write(error_msg.encode('utf-8'))
-                    await writer.drain()
+                    lanes.put(error_msg)
                 except Exception as e:
+                    TCP_PROCESSING_ERRORS.inc()
                     logger.error(f"[TCP] Error processing data from {client_id}: {e}")
                     logger.error(traceback.format_exc())
                     
@@ -1739,8 +1837,7 @@ async def handle_tcp_client(reader, writer):
                             "message": f"Error processing data: {str(e)}",
                             "timestamp": time.time()
                         }) + '\n'
-                        writer.write(error_msg.encode('utf-8'))
-                        await writer.drain()
+                        lanes.put(error_msg)
                     except:
                         pass
     
@@ -1751,6 +1848,14 @@ async def handle_tcp_client(reader, writer):
         logger.error(traceback.format_exc())
     finally:
         # Clean up
+        TCP_CONNECTIONS.dec()
+        if capture and capture_conn is not None:
+            capture.close_conn(capture_conn)
+        if lanes is not None:
+            lanes.close()
+        if guard is not None:
+            guard.close()
+        robot_keepalive.remove(writer)
         writer.close()
         try:
             await writer.wait_closed()
@@ -1758,51 +1863,156 @@ async def handle_tcp_client(reader, writer):
             pass
         logger.info(f"[TCP] Connection closed with {client_id}")
         
+        if client_robot_id and pending_commands is not None:
+            pending_commands.forget(client_robot_id)
+        
         # Remove robot from tracking if this was a robot connection
-        if client_robot_id and client_robot_id in tcp_robots:
-            logger.info(f"[TCP] Removed robot {client_robot_id} from tcp_robots")
-            del tcp_robots[client_robot_id]
+        # (robot đã kết nối lại qua kết nối khác thì session mới được giữ nguyên)
+        if client_robot_id and registry.remove(client_robot_id, writer) is not None:
+            logger.info(f"[TCP] Removed robot {client_robot_id} from registry")
+            TCP_ROBOTS.set(registry.count(transport="tcp"))
+            
+            # Token UDP chỉ có hiệu lực khi robot còn kết nối TCP (kết nối mới đã cấp token khác thì giữ nguyên)
+            if udp is not None:
+                udp.revoke(client_robot_id)
+            if bus:
+                bus.unregister(client_robot_id)
             
             # Notify frontend that robot disconnected
-            if frontend_bridge:
+            if frontend_connected():
                 try:
-                    await frontend_bridge.send(json.dumps({
+                    await send_to_frontend({
                         "type": "robot_disconnected",
                         "robot_id": client_robot_id,
                         "timestamp": time.time()
-                    }))
+                    })
                 except:
                     pass
 
 
+async def ingest_udp_message(robot_id, message, msg_type, received_at):
+    """Telemetry nhận qua UDP (udp_telemetry.py): cùng đường với dữ liệu TCP nhưng không có ack"""
+    TCP_MESSAGES_RECEIVED.labels(msg_type).inc()
+    session = registry.get(robot_id)
+    if session is not None:
+        session.last_seen = received_at
+        session.messages += 1
+        robot_keepalive.touch(session.conn)
+    if journal:
+        journal.append(robot_id, message)
+    if frontend_connected():
+        data = None
+        if '"ts"' in message:
+            data = json.loads(message)
+            if isinstance(data.get("ts"), dict):
+                data["ts"]["tcp_server"] = received_at
+        try:
+            await send_to_frontend(data, raw=message if data is None else None)
+            TCP_FORWARDED.labels("udp_to_bridge").inc()
+        except Exception as e:
+            TCP_FORWARD_ERRORS.labels("udp_to_bridge").inc()
+            logger.error(f"[UDP] Error forwarding to frontend: {e}")
+
+async def deliver_routed_command(robot_id, data):
+    """Lệnh do worker khác nhận từ bridge, robot đang kết nối với worker này"""
+    session = registry.get(robot_id)
+    if session is None or session.lanes is None:
+        raise KeyError(f"Robot {robot_id} không còn kết nối với worker này")
+    if not session.lanes.put_command(json.dumps(data) + '\n', data.get("type"), robot_id):
+        raise ConnectionError(f"Kết nối của robot {robot_id} đã đóng")
+    TCP_FORWARDED.labels("to_robot").inc()
+    # Phản hồi của robot đi ra từ worker này nên lệnh chờ phản hồi cũng được ghi ở đây
+    if data.get(tracing.TRACE_KEY) and pending_commands is not None:
+        pending_commands.add(robot_id, data[tracing.TRACE_KEY])
+
+async def report_routed_failure(robot_id, data, reason):
+    """Bus không tìm được worker giữ robot (robot vừa ngắt kết nối)"""
+    TCP_FORWARD_ERRORS.labels("to_worker").inc()
+    if frontend_connected():
+        await send_to_frontend({
+            "type": "error",
+            "robot_id": robot_id,
+            "status": reason,
+            "message": f"Robot {robot_id} not connected",
+            "timestamp": time.time()
+        })
+
+async def revoke_robot(robot_id):
+    """Robot đã kết nối lại ở node khác: đóng kết nối cũ (thường đã chết nửa chừng) ở đây"""
+    session = registry.get(robot_id)
+    if session is not None and session.transport == "tcp":
+        logger.info(f"[TCP] Robot {robot_id} đã chuyển sang node khác, đóng kết nối cũ")
+        session.conn.close()
+
+def worker_journal_dir(worker_id):
+    """Mỗi worker có journal riêng để hai process không bao giờ ghi cùng một segment"""
+    return f"{JOURNAL_DIR}-worker{worker_id}"
+
 # Update start_server function to connect to WebSocket Bridge
-async def start_server():
-    """Start TCP server and connect to WebSocket Bridge"""
-    server = await asyncio.start_server(
-        handle_tcp_client, 'localhost', 9000
-    )
+async def start_server(sock=None, worker_id=None, bus_path=None, connect_bridge=True):
+    """
+    Start TCP server and connect to WebSocket Bridge
+    
+    Chạy một process: start_server(). Chạy nhiều worker (ingest_workers.py): sock đã
+    bind với SO_REUSEPORT, worker_id và bus_path của bus do supervisor mở. Chế độ gateway
+    (gateway.py) đặt local_bus và gọi với connect_bridge=False.
+    """
+    global journal, journal_drainer, capture, pending_commands, bus, udp
+    
+    registry.bind_loop()
+    
+    # Journal + drainer: ingest không phụ thuộc tình trạng DB, dữ liệu chưa drain được replay khi khởi động
+    journal = TelemetryJournal() if worker_id is None else TelemetryJournal(worker_journal_dir(worker_id))
+    journal_drainer = JournalDrainer(journal)
+    journal_drainer.start()
+    
+    pending_commands = tracing.PendingCommands()
+    
+    # Capture mode: ghi lại mọi frame đến để replay offline (ingest_capture.py)
+    if os.environ.get("TCP_CAPTURE_FILE"):
+        capture_path = os.environ["TCP_CAPTURE_FILE"]
+        if worker_id is not None:
+            capture_path = f"{capture_path}.worker{worker_id}"
+        capture = CaptureWriter(capture_path)
+        logger.info(f"Capturing inbound frames to {capture.path}")
+    
+    if bus_path:
+        bus = WorkerBus(bus_path, worker_id, deliver_routed_command, report_routed_failure, revoke_robot)
+        await bus.connect()
+    
+    if sock is not None:
+        server = await asyncio.start_server(handle_tcp_client, sock=sock)
+    else:
+        server = await asyncio.start_server(
+            handle_tcp_client, 'localhost', 9000
+        )
     
     addr = server.sockets[0].getsockname()
-    logger.info(f'TCP Server running on {addr[0]}:{addr[1]}')
+    logger.info(f'TCP Server running on {addr[0]}:{addr[1]}' + (f' (worker {worker_id})' if worker_id is not None else ''))
+    
+    # Kênh telemetry UDP: mỗi worker một port để datagram tới đúng worker giữ token của robot
+    if UDP_TELEMETRY_PORT:
+        udp = UDPTelemetry(ingest_udp_message)
+        await udp.start(TCP_SERVER_HOST, UDP_TELEMETRY_PORT + (worker_id or 0))
+    
+    # Endpoint /metrics (và /traces, /stats/loop); worker i dùng cổng TCP_WORKER_METRICS_BASE_PORT + i
+    if worker_id is None:
+        await metrics.serve_metrics(port=TCP_SERVER_METRICS_PORT)
+    else:
+        await metrics.serve_metrics(port=TCP_WORKER_METRICS_BASE_PORT + worker_id)
+    registry.serve()  # GET /connections[?type=...][&since=seq]
+    loop_monitor.start_monitor()
+    profiler.install_signal_handler("tcp_server" if worker_id is None else f"tcp_server_w{worker_id}")
     
     # Connect to WebSocket Bridge
-    asyncio.create_task(connect_to_ws_bridge())
+    if connect_bridge:
+        asyncio.create_task(connect_to_ws_bridge())
     
     async with server:
         await server.serve_forever()
 
-# Main entry point
+# Main entry point: the async start_server() above (capture, journal, metrics, UDP); logs go to LOG_FILE
 if __name__ == "__main__":
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler(f"tcp_server_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-        ]
-    )
-    logger = logging.getLogger('tcp_server')
     logger.info("Starting TCP Server...")
     
     # Run server
@@ -0,0 +1,357 @@
+"""
+Columnar export and archive tier for telemetry.
+
+encoder_data, imu_data and trajectory_data are written per robot per day to
+partitioned files under config.ARCHIVE_DIR:
+
+    <ARCHIVE_DIR>/<table>/robot_id=<id>/date=<YYYY-MM-DD>/data.parquet   (zstd compressed)
+    <ARCHIVE_DIR>/<table>/robot_id=<id>/date=<YYYY-MM-DD>/data.arrow     (Arrow IPC, uncompressed)
+
+Parquet is the compact long-term format; Arrow IPC files are memory-mapped on
+read so columns come back as NumPy views without copying. Archived rows can
+optionally be deleted from Postgres once the file has been written and its row
+count checked.
+
+A partition holds one file. Exporting a robot/day again (e.g. today, or after
+an earlier export with --delete) merges into it: archived rows are kept
+unless Postgres still has rows with the same timestamp, which replace them.
+
+Usage:
+    python telemetry_archive.py export --start 2025-03-01 --end 2025-03-31 --robot robot1 --delete
+    python telemetry_archive.py list --table encoder_data
+"""
+import os
+import glob
+import logging
+import argparse
+import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.ipc as ipc
+    import pyarrow.compute as pc
+except ImportError:  # pyarrow is only needed for the archive tier
+    pa = None
+
+import kinematics
+from config import ARCHIVE_DIR
+
+logger = logging.getLogger("telemetry_archive")
+
+# Archived columns per table (robot_id and date are encoded in the path)
+TABLE_COLUMNS = {
+    "encoder_data": ["timestamp", "rpm_1", "rpm_2", "rpm_3"],
+    "imu_data": ["timestamp", "roll", "pitch", "yaw", "quat_w", "quat_x", "quat_y", "quat_z"],
+    "trajectory_data": ["timestamp", "segment_id", "x", "y", "theta"],
+}
+
+FORMATS = {"parquet": "data.parquet", "arrow": "data.arrow"}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required for the telemetry archive (pip install pyarrow)")
+
+
+def _schema(table):
+    fields = [pa.field("timestamp", pa.timestamp("us"))]
+    for column in TABLE_COLUMNS[table][1:]:
+        fields.append(pa.field(column, pa.int64() if column == "segment_id" else pa.float64()))
+    return pa.schema(fields)
+
+
+def partition_dir(table, robot_id, day: datetime.date, root=ARCHIVE_DIR):
+    return os.path.join(root, table, f"robot_id={robot_id}", f"date={day.isoformat()}")
+
+
+# === WRITE ===
+
+def write_partition(table, robot_id, day, columns: Dict[str, list], fmt="parquet", root=ARCHIVE_DIR) -> str:
+    """
+    Write the columns of one robot/day to its partition file, merged with the
+    rows already archived there
+
+    The file is written next to its final name, its row count checked and then
+    renamed, so readers never see a partial partition. A file of the other
+    format left in the partition is removed once its rows are merged.
+
+    Returns:
+        Path of the written file
+    """
+    _require_pyarrow()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown archive format: {fmt}")
+
+    schema = _schema(table)
+    data = pa.table({name: pa.array(columns[name], type=schema.field(name).type) for name in schema.names},
+                    schema=schema)
+
+    directory = partition_dir(table, robot_id, day, root)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, FORMATS[fmt])
+    tmp_path = os.path.join(directory, "tmp." + FORMATS[fmt])  # same extension, partition_rows() reads it
+
+    existing = _partition_file(directory)
+    if existing is not None:
+        data = _merge(_read_file(existing, schema.names), data)
+
+    if fmt == "parquet":
+        pq.write_table(data, tmp_path, compression="zstd")
+    else:
+        # Uncompressed so the file can be memory-mapped without decoding
+        with ipc.new_file(tmp_path, schema) as writer:
+            writer.write_table(data)
+    if partition_rows(tmp_path) != data.num_rows:
+        os.remove(tmp_path)
+        raise RuntimeError(f"Row count mismatch in {tmp_path}, partition left unchanged")
+    os.replace(tmp_path, path)
+    for name in FORMATS.values():
+        other = os.path.join(directory, name)
+        if other != path and os.path.exists(other):
+            os.remove(other)
+    return path
+
+
+def _merge(archived, fresh):
+    """Archived rows plus fresh ones; fresh rows replace archived rows with the same timestamp"""
+    keep = pc.invert(pc.is_in(archived.column("timestamp"), value_set=fresh.column("timestamp")))
+    merged = pa.concat_tables([archived.filter(keep), fresh.cast(archived.schema)])
+    # Stable sort, trajectory points of one segment share a timestamp and keep their order
+    return merged.take(pc.sort_indices(merged, sort_keys=[("timestamp", "ascending")]))
+
+
+def _partition_file(directory) -> Optional[str]:
+    """The data file of a partition; the newest one if an older export left both formats"""
+    paths = [os.path.join(directory, name) for name in FORMATS.values()]
+    paths = [path for path in paths if os.path.exists(path)]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def partition_rows(path) -> int:
+    """Row count from the file metadata"""
+    if path.endswith(".parquet"):
+        return pq.ParquetFile(path).metadata.num_rows
+    with pa.memory_map(path) as source:
+        return ipc.open_file(source).read_all().num_rows
+
+
+def _fetch_day(cursor, table, robot_id, start, end) -> Dict[str, list]:
+    """Columns of one table for one robot and time range"""
+    if table == "trajectory_data":
+        return _fetch_trajectory(cursor, robot_id, start, end)
+
+    columns = TABLE_COLUMNS[table]
+    cursor.execute(
+        f"SELECT {', '.join(columns)} FROM {table} "
+        "WHERE robot_id = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp",
+        (robot_id, start, end)
+    )
+    rows = cursor.fetchall()
+    return {name: [r[i] for r in rows] for i, name in enumerate(columns)}
+
+
+def _fetch_trajectory(cursor, robot_id, start, end) -> Dict[str, list]:
+    """trajectory_data rows flattened to one row per point"""
+    cursor.execute(
+        "SELECT id, timestamp, points, current_x, current_y, current_theta FROM trajectory_data "
+        "WHERE robot_id = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp",
+        (robot_id, start, end)
+    )
+    out = {name: [] for name in TABLE_COLUMNS["trajectory_data"]}
+    for row_id, timestamp, points, cx, cy, ctheta in cursor.fetchall():
+        if points and points.get('x'):
+            xs, ys, thetas = points['x'], points['y'], points.get('theta', [0.0] * len(points['x']))
+        else:
+            xs, ys, thetas = [cx], [cy], [ctheta]
+        out["timestamp"].extend([timestamp] * len(xs))
+        out["segment_id"].extend([row_id] * len(xs))
+        out["x"].extend(xs)
+        out["y"].extend(ys)
+        out["theta"].extend(thetas)
+    return out
+
+
+def archive_day(conn, robot_id, day: datetime.date, tables=None, fmt="parquet",
+                delete=False, root=ARCHIVE_DIR) -> Dict[str, int]:
+    """
+    Archive one robot/day of every table
+
+    Args:
+        conn: DB-API connection (robot_database.engine.raw_connection())
+        delete: Delete the archived rows once the file row count matches (only the
+            rows that were read; the day may still be receiving data)
+
+    Returns:
+        Dict table -> archived row count
+    """
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+    counts = {}
+    cursor = conn.cursor()
+    for table in tables or TABLE_COLUMNS:
+        if delete:
+            # SELECT and DELETE see one snapshot: rows inserted meanwhile (archiving
+            # today) are neither archived nor deleted, the next export picks them up
+            conn.commit()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        columns = _fetch_day(cursor, table, robot_id, start, end)
+        rows = len(columns["timestamp"])
+        if not rows:
+            conn.commit()
+            continue
+
+        # Raises before anything is deleted if the written file does not check out
+        path = write_partition(table, robot_id, day, columns, fmt, root)
+        counts[table] = rows
+        logger.info(f"Archived {rows} {table} rows of {robot_id} for {day} to {path}")
+
+        if delete:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE robot_id = %s AND timestamp >= %s AND timestamp < %s",
+                (robot_id, start, end)
+            )
+            conn.commit()
+    conn.commit()
+    return counts
+
+
+def export_range(start_date: datetime.date, end_date: datetime.date, robot_ids=None, tables=None,
+                 fmt="parquet", delete=False, root=ARCHIVE_DIR) -> Dict[str, Dict[str, int]]:
+    """Archive every robot/day in [start_date, end_date]"""
+    _require_pyarrow()
+    from robot_database import engine
+
+    conn = engine.raw_connection()
+    try:
+        if not robot_ids:
+            cursor = conn.cursor()
+            cursor.execute("SELECT robot_id FROM robots ORDER BY robot_id")
+            robot_ids = [r[0] for r in cursor.fetchall()]
+
+        summary = {}
+        day = start_date
+        while day <= end_date:
+            for robot_id in robot_ids:
+                counts = archive_day(conn, robot_id, day, tables, fmt, delete, root)
+                if counts:
+                    summary[f"{robot_id}/{day.isoformat()}"] = counts
+            day += datetime.timedelta(days=1)
+        return summary
+    finally:
+        conn.close()
+
+
+# === READ ===
+
+def list_partitions(table, robot_id=None, root=ARCHIVE_DIR) -> List[dict]:
+    """Archived partitions of a table, sorted by robot and date"""
+    pattern = os.path.join(root, table, f"robot_id={robot_id}" if robot_id else "robot_id=*", "date=*")
+    partitions = []
+    for directory in sorted(glob.glob(pattern)):
+        path = _partition_file(directory)
+        if path is None:
+            continue
+        parts = path.split(os.sep)
+        partitions.append({
+            "robot_id": parts[-3].split("=", 1)[1],
+            "date": datetime.date.fromisoformat(parts[-2].split("=", 1)[1]),
+            "path": path,
+        })
+    return partitions
+
+
+def _read_file(path, columns):
+    if path.endswith(".parquet"):
+        return pq.read_table(path, columns=columns, memory_map=True)
+    # The mapping stays alive as long as the returned buffers reference it
+    return ipc.open_file(pa.memory_map(path)).read_all().select(columns)
+
+
+def load_range(table, robot_id, start: datetime.datetime, end: datetime.datetime,
+               columns: Optional[List[str]] = None, root=ARCHIVE_DIR) -> Dict[str, np.ndarray]:
+    """
+    Load an archived time range as NumPy arrays
+
+    Files are memory-mapped. When the range falls in a single Arrow IPC
+    partition, null-free columns are returned as views of the mapping.
+
+    Returns:
+        Dict column -> array; timestamp is datetime64[us]
+    """
+    _require_pyarrow()
+    columns = columns or TABLE_COLUMNS[table]
+    if "timestamp" not in columns:
+        columns = ["timestamp"] + list(columns)
+
+    tables = []
+    for partition in list_partitions(table, robot_id, root):
+        if start.date() <= partition["date"] <= end.date():
+            tables.append(_read_file(partition["path"], columns))
+
+    if not tables:
+        return {name: np.empty(0, dtype="datetime64[us]" if name == "timestamp" else float) for name in columns}
+
+    data = tables[0] if len(tables) == 1 else pa.concat_tables(tables)
+    arrays = {name: data.column(name).to_numpy() for name in columns}
+
+    # Trim to the requested range, a slice keeps the arrays as views
+    ts = arrays["timestamp"]
+    lo = np.searchsorted(ts, np.datetime64(start, "us"), side="left")
+    hi = np.searchsorted(ts, np.datetime64(end, "us"), side="right")
+    return {name: values[lo:hi] for name, values in arrays.items()}
+
+
+def load_trajectory(robot_id, start: datetime.datetime, end: datetime.datetime,
+                    root=ARCHIVE_DIR) -> Dict[str, np.ndarray]:
+    """Integrate an archived encoder range into a trajectory (same model as calculate_trajectory)"""
+    data = load_range("encoder_data", robot_id, start, end, root=root)
+    if len(data["timestamp"]) < 2:
+        return {'x': np.zeros(len(data["timestamp"])), 'y': np.zeros(len(data["timestamp"])),
+                'theta': np.zeros(len(data["timestamp"]))}
+
+    kin = kinematics.for_robot(robot_id)
+    rpm = np.nan_to_num(np.column_stack([data["rpm_1"][1:], data["rpm_2"][1:], data["rpm_3"][1:]]))
+    dt = np.diff(data["timestamp"]).astype("timedelta64[us]").astype(float) / 1e6
+    dt[dt <= 0] = kin.geometry.dt
+    return kin.integrate(rpm, dt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export telemetry to Parquet/Arrow and read it back')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    export = sub.add_parser('export', help='Archive robot/day partitions')
+    export.add_argument('--start', required=True, help='First day, YYYY-MM-DD')
+    export.add_argument('--end', help='Last day, YYYY-MM-DD (default: same as --start)')
+    export.add_argument('--robot', action='append', help='Robot ID (repeatable, default: all robots)')
+    export.add_argument('--table', action='append', choices=list(TABLE_COLUMNS), help='Tables (default: all)')
+    export.add_argument('--format', choices=list(FORMATS), default='parquet', help='File format (default: parquet)')
+    export.add_argument('--delete', action='store_true', help='Delete archived rows from the database')
+    export.add_argument('--root', default=ARCHIVE_DIR, help=f'Archive directory (default: {ARCHIVE_DIR})')
+
+    listing = sub.add_parser('list', help='List archived partitions')
+    listing.add_argument('--table', choices=list(TABLE_COLUMNS), default='encoder_data')
+    listing.add_argument('--robot', default=None)
+    listing.add_argument('--root', default=ARCHIVE_DIR)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'export':
+        start = datetime.date.fromisoformat(args.start)
+        end = datetime.date.fromisoformat(args.end) if args.end else start
+        summary = export_range(start, end, args.robot, args.table, args.format, args.delete, args.root)
+        for key, counts in summary.items():
+            print(f"{key}: {counts}")
+        print(f"Archived {sum(sum(c.values()) for c in summary.values())} rows in {len(summary)} robot/day partitions")
+    else:
+        for partition in list_partitions(args.table, args.robot, args.root):
+            print(f"{partition['robot_id']:<12}{partition['date']}  {partition_rows(partition['path']):>10} rows  {partition['path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+"""
+Append-only, memory-mapped telemetry journal.
+
+Ingest writes every robot message here first; a background drainer loads the
+journal into the database. Appending is a memcpy into a mapped segment, so the
+ingest path never waits for Postgres, and messages survive a DB outage or a
+process crash (the drainer replays everything after its saved cursor).
+
+Layout (one directory per robot):
+
+    <JOURNAL_DIR>/<robot_id>/000000000001.seg   fixed size, preallocated segments
+    <JOURNAL_DIR>/<robot_id>/cursor              {"segment": n, "offset": o} drained up to here
+    <JOURNAL_DIR>/<robot_id>/quarantine.jsonl    batches the database kept rejecting
+
+Record: <length:uint32><timestamp:float64><crc32:uint32><payload bytes>.
+A zero length marks the end of the written part of a segment; a record with a
+bad CRC (torn write) is treated the same way.
+"""
+import os
+import re
+import json
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+from sample_batch import BATCH_TYPES
+from config import (
+    JOURNAL_DIR, JOURNAL_SEGMENT_SIZE, JOURNAL_RETAIN_SEGMENTS,
+    JOURNAL_DRAIN_BATCH, JOURNAL_DRAIN_INTERVAL, JOURNAL_QUARANTINE_ATTEMPTS
+)
+
+try:
+    from sqlalchemy import exc as sa_exc
+    CONNECTION_ERRORS = (OSError, sa_exc.OperationalError, sa_exc.InterfaceError, sa_exc.DisconnectionError,
+                         sa_exc.TimeoutError)
+except ImportError:  # sinks without SQLAlchemy
+    CONNECTION_ERRORS = (OSError,)
+
+logger = logging.getLogger("telemetry_journal")
+
+JOURNAL_APPENDS = metrics.counter("journal_appended_records_total", "Records appended to the telemetry journal")
+JOURNAL_APPEND_BYTES = metrics.counter("journal_appended_bytes_total", "Payload bytes appended to the telemetry journal")
+JOURNAL_DRAINED = metrics.counter("journal_drained_records_total", "Journal records persisted to the database")
+JOURNAL_DRAIN_FAILURES = metrics.counter("journal_drain_failures_total", "Failed journal drain batches")
+JOURNAL_QUARANTINED = metrics.counter("journal_quarantined_records_total", "Journal records moved to quarantine.jsonl")
+JOURNAL_PERSIST_SECONDS = metrics.histogram("journal_persist_seconds", "Time to persist one drained batch")
+
+HEADER = struct.Struct("<IdI")
+_SAFE_ID = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def _segment_name(seq):
+    return f"{seq:012d}.seg"
+
+
+class Segment:
+    """One preallocated, memory-mapped segment file"""
+
+    def __init__(self, path, size, create=False):
+        self.path = path
+        self.seq = int(os.path.basename(path).split(".")[0])
+        if create:
+            with open(path, "wb") as f:
+                f.truncate(size)
+        self.file = open(path, "r+b")
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.end = 0
+
+    def records(self, offset=0, limit_end=None) -> Iterator[Tuple[int, float, bytes, int]]:
+        """Yield (offset, timestamp, payload, next_offset) from offset until the end marker"""
+        limit = self.size if limit_end is None else limit_end
+        while offset + HEADER.size <= limit:
+            length, timestamp, crc = HEADER.unpack_from(self.map, offset)
+            start = offset + HEADER.size
+            if length == 0 or start + length > limit:
+                return
+            payload = bytes(self.map[start:start + length])
+            if zlib.crc32(payload) != crc:
+                return
+            yield offset, timestamp, payload, start + length
+            offset = start + length
+
+    def recover_end(self):
+        """Find the write position after a restart"""
+        end = 0
+        for _, _, _, next_offset in self.records():
+            end = next_offset
+        self.end = end
+        return end
+
+    def append(self, timestamp, payload) -> bool:
+        """Copy one record into the mapping, False when the segment is full"""
+        needed = HEADER.size + len(payload)
+        if self.end + needed > self.size:
+            return False
+        HEADER.pack_into(self.map, self.end, len(payload), timestamp, zlib.crc32(payload))
+        self.map[self.end + HEADER.size:self.end + needed] = payload
+        self.end += needed
+        # Clear the next length field in case a torn record was left there
+        if self.end + 4 <= self.size:
+            self.map[self.end:self.end + 4] = b"\0\0\0\0"
+        return True
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        try:
+            self.map.flush()
+            self.map.close()
+        finally:
+            self.file.close()
+
+
+class RobotJournal:
+    """Segments and drain cursor of one robot"""
+
+    def __init__(self, directory, robot_id, segment_size=JOURNAL_SEGMENT_SIZE):
+        self.robot_id = robot_id
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        seqs = self.segment_seqs()
+        if seqs:
+            self.active = Segment(self._path(seqs[-1]), segment_size)
+            self.active.recover_end()
+        else:
+            self.active = Segment(self._path(1), segment_size, create=True)
+        self.appended = 0
+
+    def _path(self, seq):
+        return os.path.join(self.directory, _segment_name(seq))
+
+    def segment_seqs(self) -> List[int]:
+        return sorted(int(name.split(".")[0]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    # --- writer side ---
+
+    def append(self, payload: bytes, timestamp: Optional[float] = None):
+        if timestamp is None:
+            timestamp = time.time()
+        if HEADER.size + len(payload) > self.segment_size:
+            raise ValueError(f"Record of {len(payload)} bytes does not fit in a journal segment")
+        with self.lock:
+            if not self.active.append(timestamp, payload):
+                self.active.close()
+                self.active = Segment(self._path(self.active.seq + 1), self.segment_size, create=True)
+                self.active.append(timestamp, payload)
+            self.appended += 1
+
+    def position(self) -> Tuple[int, int]:
+        """(segment, offset) of the end of the journal"""
+        with self.lock:
+            return self.active.seq, self.active.end
+
+    # --- reader side ---
+
+    def load_cursor(self) -> Tuple[int, int]:
+        path = os.path.join(self.directory, "cursor")
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return data["segment"], data["offset"]
+        except (OSError, ValueError, KeyError):
+            seqs = self.segment_seqs()
+            return (seqs[0] if seqs else 1), 0
+
+    def save_cursor(self, segment, offset):
+        path = os.path.join(self.directory, "cursor")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+        os.replace(path + ".tmp", path)
+
+    def read(self, segment, offset, limit) -> Tuple[List[Tuple[float, bytes]], Tuple[int, int]]:
+        """
+        Read up to limit records starting at (segment, offset)
+
+        Returns:
+            (records, next_position) - records are (timestamp, payload)
+        """
+        end_seq, end_offset = self.position()
+        records = []
+        while len(records) < limit and segment <= end_seq:
+            if not os.path.exists(self._path(segment)):
+                segment, offset = segment + 1, 0
+                continue
+            # A separate mapping of the same file: the writer may rotate meanwhile,
+            # and reads of the active segment stop at the published end offset
+            seg = Segment(self._path(segment), self.segment_size)
+            try:
+                for _, timestamp, payload, next_offset in seg.records(offset, end_offset if segment == end_seq else None):
+                    records.append((timestamp, payload))
+                    offset = next_offset
+                    if len(records) >= limit:
+                        break
+            finally:
+                seg.close()
+            if len(records) >= limit or segment == end_seq:
+                break
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    def release(self, segment, retain=JOURNAL_RETAIN_SEGMENTS):
+        """Delete fully drained segments before the given one, the newest `retain` are kept for recent()"""
+        for seq in self.segment_seqs():
+            if seq < segment - retain and seq != self.active.seq:
+                os.remove(self._path(seq))
+
+    def segment_records(self, seq) -> List[Tuple[float, bytes]]:
+        """Records of one segment only, up to the published end if it is the active one"""
+        end_seq, end_offset = self.position()
+        if seq > end_seq:
+            return []
+        try:
+            seg = Segment(self._path(seq), self.segment_size)
+        except FileNotFoundError:  # released meanwhile
+            return []
+        try:
+            return [(timestamp, payload)
+                    for _, timestamp, payload, _ in seg.records(0, end_offset if seq == end_seq else None)]
+        finally:
+            seg.close()
+
+    def recent(self, limit=100) -> List[Tuple[float, bytes]]:
+        """Newest records (drained or not) still on disk, oldest first"""
+        out = []
+        for seq in reversed(self.segment_seqs()):
+            out = self.segment_records(seq) + out
+            if len(out) >= limit:
+                break
+        return out[-limit:]
+
+    def flush(self):
+        with self.lock:
+            self.active.flush()
+
+    def close(self):
+        with self.lock:
+            self.active.close()
+
+
+class TelemetryJournal:
+    """Per-robot journals under one root directory"""
+
+    def __init__(self, root=JOURNAL_DIR, segment_size=JOURNAL_SEGMENT_SIZE):
+        self.root = root
+        self.segment_size = segment_size
+        self.robots: Dict[str, RobotJournal] = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        # Re-open journals left by a previous run so they are replayed
+        for name in os.listdir(root):
+            if os.path.isdir(os.path.join(root, name)):
+                self.robot(name)
+
+    def robot(self, robot_id) -> RobotJournal:
+        robot_id = _SAFE_ID.sub("_", str(robot_id))
+        journal = self.robots.get(robot_id)
+        if journal is None:
+            with self.lock:
+                journal = self.robots.get(robot_id)
+                if journal is None:
+                    journal = RobotJournal(os.path.join(self.root, robot_id), robot_id, self.segment_size)
+                    self.robots[robot_id] = journal
+        return journal
+
+    def append(self, robot_id, payload, timestamp=None):
+        """Record one message (bytes or str) for a robot"""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.robot(robot_id).append(payload, timestamp)
+        JOURNAL_APPENDS.inc()
+        JOURNAL_APPEND_BYTES.inc(len(payload))
+
+    def recent(self, robot_id, limit=100) -> List[Tuple[float, bytes]]:
+        return self.robot(robot_id).recent(limit)
+
+    def backlog(self) -> Dict[str, int]:
+        """Approximate undrained bytes per robot"""
+        out = {}
+        for robot_id, journal in list(self.robots.items()):
+            seg, off = journal.load_cursor()
+            end_seq, end_off = journal.position()
+            out[robot_id] = (end_seq - seg) * self.segment_size + end_off - off
+        return out
+
+    def close(self):
+        for journal in list(self.robots.values()):
+            journal.close()
+
+
+def store_json_batch(robot_id, records: List[Tuple[float, bytes]]):
+    """Default drain sink: JSON messages into robot_database in one transaction"""
+    from robot_database import SessionLocal, DataHandler
+
+    items = []
+    for timestamp, payload in records:
+        try:
+            item = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Skipping non-JSON journal record of {robot_id}: {payload[:80]!r}")
+            continue
+        if isinstance(item, dict):
+            item.setdefault("id", item.get("robot_id", robot_id))
+            if item.get("type") in BATCH_TYPES:
+                item.setdefault("received_at", timestamp)
+            items.append(item)
+
+    session = SessionLocal()
+    try:
+        DataHandler(session).process_json_batch(items)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def is_connection_error(error) -> bool:
+    """Database unreachable (retry everything later) as opposed to a batch it rejects"""
+    return isinstance(error, CONNECTION_ERRORS) or getattr(error, "connection_invalidated", False)
+
+
+class JournalDrainer:
+    """
+    Background thread moving journal records into the database
+
+    The sink receives (robot_id, [(timestamp, payload), ...]) and must raise on
+    failure; the cursor only moves after the sink returned, so a failed batch
+    is retried (with backoff) and nothing is lost while the DB is down.
+
+    A connection error stops the whole pass. Any other error only holds back
+    the robot whose batch failed: the other robots keep draining, and the batch
+    is retried with a per-robot backoff. After quarantine_attempts failures at
+    the same cursor it is appended to the robot's quarantine.jsonl and the
+    cursor moves past it.
+    """
+
+    def __init__(self, journal: TelemetryJournal,
+                 sink: Callable[[str, List[Tuple[float, bytes]]], None] = store_json_batch,
+                 batch_size=JOURNAL_DRAIN_BATCH, interval=JOURNAL_DRAIN_INTERVAL,
+                 quarantine_attempts=JOURNAL_QUARANTINE_ATTEMPTS):
+        self.journal = journal
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.quarantine_attempts = quarantine_attempts
+        self.running = False
+        self.thread = None
+        self.drained = 0
+        self.failures = 0
+        self.quarantined = 0
+        self.retries: Dict[str, list] = {}  # robot_id -> [cursor, failed attempts, next attempt time]
+
+    def drain_robot(self, robot_journal: RobotJournal) -> int:
+        segment, offset = robot_journal.load_cursor()
+        records, (next_segment, next_offset) = robot_journal.read(segment, offset, self.batch_size)
+        if records:
+            with JOURNAL_PERSIST_SECONDS.time():
+                self.sink(robot_journal.robot_id, records)
+            JOURNAL_DRAINED.inc(len(records))
+        if (next_segment, next_offset) != (segment, offset):
+            robot_journal.save_cursor(next_segment, next_offset)
+            robot_journal.release(next_segment)
+        return len(records)
+
+    def drain_once(self) -> int:
+        """Drain one batch of every robot, returns the number of records stored"""
+        total = 0
+        now = time.monotonic()
+        for robot_journal in list(self.journal.robots.values()):
+            retry = self.retries.get(robot_journal.robot_id)
+            if retry is not None and now < retry[2]:
+                continue
+            try:
+                total += self.drain_robot(robot_journal)
+            except Exception as e:
+                if is_connection_error(e):
+                    self.drained += total
+                    raise
+                self._batch_failed(robot_journal, e)
+            else:
+                self.retries.pop(robot_journal.robot_id, None)
+        self.drained += total
+        return total
+
+    def _batch_failed(self, robot_journal: RobotJournal, error):
+        robot_id = robot_journal.robot_id
+        cursor = robot_journal.load_cursor()
+        retry = self.retries.get(robot_id)
+        attempts = retry[1] + 1 if retry is not None and retry[0] == cursor else 1
+        self.failures += 1
+        JOURNAL_DRAIN_FAILURES.inc()
+        if attempts < self.quarantine_attempts:
+            delay = min(self.interval * 2 ** attempts, 30.0)
+            self.retries[robot_id] = [cursor, attempts, time.monotonic() + delay]
+            logger.error(f"Journal drain of {robot_id} failed ({attempts}/{self.quarantine_attempts}), "
+                         f"retrying in {delay:.1f}s: {error}")
+            return
+        self.retries.pop(robot_id, None)
+        self.quarantine(robot_journal, error)
+
+    def quarantine(self, robot_journal: RobotJournal, error) -> int:
+        """Append the batch at the cursor to quarantine.jsonl and move the cursor past it"""
+        segment, offset = robot_journal.load_cursor()
+        records, (next_segment, next_offset) = robot_journal.read(segment, offset, self.batch_size)
+        path = os.path.join(robot_journal.directory, "quarantine.jsonl")
+        with open(path, "a") as f:
+            for timestamp, payload in records:
+                f.write(json.dumps({"timestamp": timestamp, "batch": [segment, offset],
+                                    "payload": payload.decode("utf-8", errors="replace"),
+                                    "error": str(error)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        robot_journal.save_cursor(next_segment, next_offset)
+        robot_journal.release(next_segment)
+        self.quarantined += len(records)
+        JOURNAL_QUARANTINED.inc(len(records))
+        logger.error(f"Quarantined {len(records)} journal records of {robot_journal.robot_id} to {path} "
+                     f"after {self.quarantine_attempts} failed attempts: {error}")
+        return len(records)
+
+    def run(self):
+        backoff = self.interval
+        while self.running:
+            try:
+                if self.drain_once() == 0:
+                    time.sleep(self.interval)
+                backoff = self.interval
+            except Exception as e:
+                self.failures += 1
+                JOURNAL_DRAIN_FAILURES.inc()
+                logger.error(f"Journal drain failed, retrying in {backoff:.1f}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="journal-drainer", daemon=True)
+        self.thread.start()
+        logger.info(f"Journal drainer started ({len(self.journal.robots)} robot journals to replay)")
+
+    def stop(self, timeout=5.0):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout)
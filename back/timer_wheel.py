@@ -0,0 +1,254 @@
+"""
+One hashed timer wheel per process for heartbeats and idle timeouts.
+
+Every WebSocket used to get its own heartbeat task (main.py,
+backend/app/ws_test_handlers.py), ws_tcp_bridge sent heartbeats to its
+clients one await after another, and TCP robots were never reaped at all
+(tcp_server.monitor_connections was unreachable). With thousands of
+connections that is thousands of sleeping tasks, each waking up on its own.
+
+TimerWheel hashes each timer into one of `slots` buckets by the tick it
+expires in; a single task advances one tick at a time and fires the timers
+of that bucket. Timers further away than slots * tick stay in their bucket
+for another turn, so with the default sizes (1 s tick, 1024 slots) heartbeat
+and idle timers are always due on the first visit and each tick costs
+O(timers expiring). Scheduling and cancelling are O(1). Callbacks that return
+an awaitable (WebSocket sends) are awaited together in one task per tick.
+
+Keepalive builds on it: register a connection with its send/close callables,
+call touch() when it receives something, remove() when it ends.
+
+    keepalive = Keepalive("bridge", lambda group: {"type": "ping", "timestamp": time.time()},
+                          interval=30, idle_timeout=600)
+    keepalive.add(client_id, websocket.send, websocket.close)
+
+Heartbeats are serialized once per tick (per group, e.g. per robot_id) and
+the same text is sent to every connection due in that tick. A connection
+whose heartbeat send fails, or that received nothing for idle_timeout
+seconds, is closed and dropped. touch() only stores a timestamp; the idle
+timer checks it when it fires and re-arms itself for the remaining time.
+"""
+import json
+import math
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger("timer_wheel")
+
+KEEPALIVE_CONNECTIONS = metrics.gauge("keepalive_connections", "Connections tracked by the keepalive wheel", ["service"])
+KEEPALIVE_HEARTBEATS = metrics.counter("keepalive_heartbeats_total", "Heartbeats sent", ["service"])
+KEEPALIVE_REAPED = metrics.counter("keepalive_reaped_total", "Connections closed by the keepalive wheel", ["service", "reason"])
+WHEEL_TIMERS = metrics.gauge("timer_wheel_timers", "Timers scheduled on the process timer wheel")
+
+
+class Timer:
+    __slots__ = ("expires", "callback", "args", "wheel")
+
+    def __init__(self, expires, callback, args, wheel):
+        self.expires = expires  # tick number
+        self.callback = callback
+        self.args = args
+        self.wheel = wheel
+
+    def cancel(self):
+        if self.wheel is not None:
+            self.wheel._discard(self)
+            self.wheel = None
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=1024):
+        self.tick = tick
+        self.slots: List[set] = [set() for _ in range(slots)]
+        self.count = 0
+        self.loop = asyncio.get_running_loop()
+        self.current = int(self.loop.time() / tick)  # last tick processed
+        self.task = self.loop.create_task(self._run())
+
+    def schedule(self, delay, callback: Callable[..., Any], *args) -> Timer:
+        """Call callback(*args) after about delay seconds, counted in whole ticks from the current one"""
+        # Re-arming from a callback of tick T with delay = n ticks lands exactly on T + n, without drift
+        expires = max(self.current, int(self.loop.time() / self.tick)) + max(1, math.ceil(delay / self.tick))
+        timer = Timer(expires, callback, args, self)
+        self.slots[expires % len(self.slots)].add(timer)
+        self.count += 1
+        WHEEL_TIMERS.set(self.count)
+        return timer
+
+    def _discard(self, timer):
+        slot = self.slots[timer.expires % len(self.slots)]
+        if timer in slot:
+            slot.remove(timer)
+            self.count -= 1
+            WHEEL_TIMERS.set(self.count)
+
+    async def _run(self):
+        loop = self.loop
+        while True:
+            await asyncio.sleep((self.current + 1) * self.tick - loop.time())
+            target = int(loop.time() / self.tick)
+            # Catch up tick by tick if the loop was blocked
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                if not slot:
+                    continue
+                due = [timer for timer in slot if timer.expires <= self.current]
+                slot.difference_update(due)
+                self.count -= len(due)
+                WHEEL_TIMERS.set(self.count)
+                pending = []
+                for timer in due:
+                    timer.wheel = None
+                    try:
+                        result = timer.callback(*timer.args)
+                    except Exception as e:
+                        logger.error(f"Timer callback failed: {e}")
+                        continue
+                    if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+                        pending.append(result)
+                if pending:
+                    loop.create_task(self._await_all(pending))
+
+    @staticmethod
+    async def _await_all(pending):
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Timer callback failed: {result}")
+
+
+_wheel: Optional[TimerWheel] = None
+
+
+def wheel() -> TimerWheel:
+    """The process timer wheel, started on first use in the running loop"""
+    global _wheel
+    if _wheel is None or _wheel.loop is not asyncio.get_running_loop():
+        _wheel = TimerWheel()
+    return _wheel
+
+
+class Session:
+    __slots__ = ("key", "send", "close", "group", "last_activity", "heartbeat", "idle")
+
+    def __init__(self, key, send, close, group, now):
+        self.key = key
+        self.send = send
+        self.close = close
+        self.group = group
+        self.last_activity = now
+        self.heartbeat = None
+        self.idle = None
+
+
+class Keepalive:
+    def __init__(self, service, payload: Optional[Callable[[Any], dict]] = None, interval: Optional[float] = None,
+                 idle_timeout: Optional[float] = None):
+        """
+        payload(group) -> heartbeat message; interval None = no heartbeats
+        idle_timeout None = connections are only reaped when a heartbeat cannot be sent
+        """
+        self.service = service
+        self.payload = payload
+        self.interval = interval if payload is not None else None
+        self.idle_timeout = idle_timeout
+        self.sessions: Dict[Any, Session] = {}
+        self._text_tick = None
+        self._texts: Dict[Any, str] = {}
+        self._gauge = KEEPALIVE_CONNECTIONS.labels(service)
+        self._beats = KEEPALIVE_HEARTBEATS.labels(service)
+
+    def add(self, key, send: Callable[[str], Any], close: Optional[Callable[[], Any]] = None, group=None) -> Session:
+        """Track a connection; send(text) and close() may be plain functions or coroutine functions"""
+        self.remove(key)
+        w = wheel()
+        session = Session(key, send, close, group, time.monotonic())
+        if self.interval:
+            session.heartbeat = w.schedule(self.interval, self._beat, session)
+        if self.idle_timeout:
+            session.idle = w.schedule(self.idle_timeout, self._check_idle, session)
+        self.sessions[key] = session
+        self._gauge.set(len(self.sessions))
+        return session
+
+    def touch(self, key):
+        session = self.sessions.get(key)
+        if session is not None:
+            session.last_activity = time.monotonic()
+
+    def remove(self, key):
+        session = self.sessions.pop(key, None)
+        if session is not None:
+            for timer in (session.heartbeat, session.idle):
+                if timer is not None:
+                    timer.cancel()
+            self._gauge.set(len(self.sessions))
+
+    def _text(self, group) -> str:
+        # One json.dumps per group per tick, shared by every connection due in it
+        tick = wheel().current
+        if tick != self._text_tick:
+            self._text_tick = tick
+            self._texts = {}
+        text = self._texts.get(group)
+        if text is None:
+            text = self._texts[group] = json.dumps(self.payload(group))
+        return text
+
+    def _beat(self, session):
+        if self.sessions.get(session.key) is not session:
+            return None
+        session.heartbeat = wheel().schedule(self.interval, self._beat, session)
+        try:
+            result = session.send(self._text(session.group))
+        except Exception as e:
+            self._reap(session, "send_failed", e)
+            return None
+        self._beats.inc()
+        if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+            return self._await_send(session, result)
+        return None
+
+    async def _await_send(self, session, result):
+        try:
+            await result
+        except Exception as e:
+            closing = self._reap(session, "send_failed", e)
+            if closing is not None:
+                await closing
+
+    def _check_idle(self, session):
+        if self.sessions.get(session.key) is not session:
+            return None
+        remaining = session.last_activity + self.idle_timeout - time.monotonic()
+        if remaining > 0:
+            session.idle = wheel().schedule(remaining, self._check_idle, session)
+            return None
+        return self._reap(session, "idle", None)
+
+    def _reap(self, session, reason, error):
+        if self.sessions.get(session.key) is not session:
+            return None
+        logger.info(f"[{self.service}] Closing {session.key}: " + (f"heartbeat failed ({error})" if error else "idle"))
+        KEEPALIVE_REAPED.labels(self.service, reason).inc()
+        self.remove(session.key)
+        if session.close is None:
+            return None
+        try:
+            result = session.close()
+        except Exception as e:
+            logger.warning(f"[{self.service}] Error closing {session.key}: {e}")
+            return None
+        if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+            return self._await_close(session, result)
+        return None
+
+    async def _await_close(self, session, result):
+        try:
+            await result
+        except Exception as e:
+            logger.warning(f"[{self.service}] Error closing {session.key}: {e}")
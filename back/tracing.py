@@ -0,0 +1,198 @@
+"""
+Per-message trace ids and span timings.
+
+A dashboard command gets a "trace_id" when it enters the system (the bridge
+stamps it if the frontend did not). Every hop records spans against that id in
+an in-process ring buffer:
+
+    bridge.receive          frontend message parsed -> handed to tcp_server
+    tcp_server.forward      message from the bridge -> written to the robot socket
+    robot.response          command written -> first reply of that robot
+    bridge.fanout           ack/reply from tcp_server -> sent to all frontends
+
+tcp_server returns its spans to the bridge in the "trace_spans" field of the
+command_sent ack and of the robot reply, so the bridge buffer holds the whole
+trace. Span times are wall-clock (time.time()) so spans of processes on the
+same host line up.
+
+GET /traces/slowest?limit=20&window=300 and GET /traces?trace_id=... are served
+on the metrics side port (see metrics.add_endpoint).
+"""
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import metrics
+from config import TRACE_BUFFER_SIZE, TRACE_RESPONSE_TIMEOUT
+
+TRACE_KEY = "trace_id"
+SPANS_KEY = "trace_spans"
+
+# Robot messages that are periodic telemetry, never the reply to a command
+TELEMETRY_TYPES = {"encoder", "encoder_data", "imu", "imu_data", "bno055", "log", "heartbeat", "ping", "pong",
+                   "registration", "encoder_batch", "imu_batch"}
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def ensure_trace_id(message: dict) -> str:
+    """Trace id of a message, stamping a new one on messages that have none"""
+    trace_id = message.get(TRACE_KEY)
+    if not trace_id:
+        trace_id = message[TRACE_KEY] = new_trace_id()
+    return trace_id
+
+
+class Span:
+    __slots__ = ("trace_id", "name", "start", "end", "attrs")
+
+    def __init__(self, trace_id, name, start, end, attrs=None):
+        self.trace_id = trace_id
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attrs = attrs
+
+    def to_dict(self) -> dict:
+        data = {"trace_id": self.trace_id, "name": self.name, "start": self.start, "end": self.end}
+        if self.attrs:
+            data["attrs"] = self.attrs
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Span":
+        return cls(data["trace_id"], data["name"], data["start"], data["end"], data.get("attrs"))
+
+
+class TraceRecorder:
+    """Fixed-size ring buffer of spans; old spans fall out as new ones arrive"""
+
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        # deque.append is atomic, recording needs no lock
+        self.spans: deque = deque(maxlen=size)
+
+    def record(self, trace_id, name, start, end=None, **attrs) -> Span:
+        span = Span(trace_id, name, start, time.time() if end is None else end, attrs or None)
+        self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, trace_id, name, **attrs):
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            self.record(trace_id, name, start, **attrs)
+
+    def add(self, span_dicts: List[dict]):
+        """Merge spans reported by another process"""
+        for data in span_dicts:
+            try:
+                self.spans.append(Span.from_dict(data))
+            except (KeyError, TypeError):
+                continue
+
+    def spans_of(self, trace_id) -> List[Span]:
+        return sorted((s for s in list(self.spans) if s.trace_id == trace_id), key=lambda s: s.start)
+
+    def trace(self, trace_id) -> Optional[dict]:
+        spans = self.spans_of(trace_id)
+        return self._summarize(trace_id, spans) if spans else None
+
+    def slowest(self, limit=20, window=300.0) -> List[dict]:
+        """Traces with spans in the last `window` seconds, longest first"""
+        since = time.time() - window
+        grouped: Dict[str, List[Span]] = {}
+        for span in list(self.spans):
+            if span.end >= since:
+                grouped.setdefault(span.trace_id, []).append(span)
+        traces = [self._summarize(trace_id, sorted(spans, key=lambda s: s.start))
+                  for trace_id, spans in grouped.items()]
+        traces.sort(key=lambda t: t["duration_ms"], reverse=True)
+        return traces[:limit]
+
+    @staticmethod
+    def _summarize(trace_id, spans: List[Span]) -> dict:
+        start = spans[0].start
+        end = max(s.end for s in spans)
+        return {
+            "trace_id": trace_id,
+            "start": start,
+            "duration_ms": round((end - start) * 1000, 3),
+            # offset_ms shows the gaps between hops (network and queueing time)
+            "spans": [{"name": s.name, "offset_ms": round((s.start - start) * 1000, 3),
+                       "duration_ms": round((s.end - s.start) * 1000, 3), **(s.attrs or {})} for s in spans],
+        }
+
+
+RECORDER = TraceRecorder()
+
+
+def span(trace_id, name, **attrs):
+    """Context manager recording one span in the process recorder"""
+    return RECORDER.span(trace_id, name, **attrs)
+
+
+class PendingCommands:
+    """
+    Commands written to a robot and not yet answered
+
+    Robots do not echo the trace id, so the first non-telemetry message of a
+    robot after a command is taken as its reply (a reply that does carry a
+    trace_id is matched exactly).
+    """
+
+    def __init__(self, timeout=TRACE_RESPONSE_TIMEOUT):
+        self.timeout = timeout
+        self.pending: Dict[str, deque] = {}
+        self.lock = threading.Lock()
+
+    def add(self, robot_id, trace_id, sent_at=None):
+        with self.lock:
+            self.pending.setdefault(robot_id, deque()).append((trace_id, sent_at or time.time()))
+
+    def waiting(self, robot_id, message_type) -> bool:
+        """True if a message of this type from the robot may be the reply to a pending command"""
+        return bool(self.pending.get(robot_id)) and message_type not in TELEMETRY_TYPES
+
+    def match(self, robot_id, message: dict) -> Optional[Span]:
+        """robot.response span of the command answered by this robot message, None if not a reply"""
+        queue = self.pending.get(robot_id)
+        if not queue or message.get("type") in TELEMETRY_TYPES:
+            return None
+        now = time.time()
+        with self.lock:
+            while queue and now - queue[0][1] > self.timeout:
+                queue.popleft()
+            if not queue:
+                return None
+            wanted = message.get(TRACE_KEY)
+            for i, (trace_id, sent_at) in enumerate(queue):
+                if wanted is None or trace_id == wanted:
+                    del queue[i]
+                    return RECORDER.record(trace_id, "robot.response", sent_at, now, robot_id=robot_id,
+                                           reply_type=message.get("type"))
+        return None
+
+    def forget(self, robot_id):
+        with self.lock:
+            self.pending.pop(robot_id, None)
+
+
+def _slowest_endpoint(query):
+    traces = RECORDER.slowest(int(query.get("limit", 20)), float(query.get("window", 300)))
+    return "application/json", json.dumps(traces)
+
+
+def _trace_endpoint(query):
+    return "application/json", json.dumps(RECORDER.trace(query.get("trace_id", "")))
+
+
+metrics.add_endpoint("/traces/slowest", _slowest_endpoint)
+metrics.add_endpoint("/traces", _trace_endpoint)
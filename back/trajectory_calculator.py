@@ -1,5 +1,6 @@
 import math
 import numpy as np
+import kinematics
 from typing import Dict, List, Tuple, Optional
 from datetime import datetime
 
@@ -8,22 +9,9 @@ class TrajectoryCalculator:
     Tính toán quỹ đạo dựa trên dữ liệu encoder và IMU
     """
     
-    def __init__(self):
-        # Khoảng cách từ tâm robot đến bánh xe (m)
-        self.R = 0.085
-        
-        # Ma trận chuyển đổi động học thuận
-        self.forward_matrix = np.array([
-            [-math.sin(math.pi/6), -math.sin(5*math.pi/6), -math.sin(3*math.pi/2)],
-            [math.cos(math.pi/6), math.cos(5*math.pi/6), math.cos(3*math.pi/2)],
-            [1/(3*self.R), 1/(3*self.R), 1/(3*self.R)]
-        ])
-        
-        # Ma trận chuyển đổi động học ngược (inverse kinematics)
-        self.inverse_matrix = np.linalg.inv(self.forward_matrix)
-        
-        # Bán kính bánh xe (m)
-        self.wheel_radius = 0.030
+    def __init__(self, robot_id=None):
+        # Động học thuận dùng chung (kinematics.py), thông số hình học theo robot_id
+        self.kinematics = kinematics.for_robot(robot_id)
         
         # Tỷ số truyền encoder-bánh
         self.gear_ratio = 10.0
@@ -40,25 +28,19 @@ class TrajectoryCalculator:
             dt: Thời gian giữa các lần đọc (s)
             
         Returns:
-            Tuple (vx, vy, omega) - vận tốc tuyến tính (m/s) và góc (rad/s)
+            Tuple (vx, vy, omega) - vận tốc tuyến tính (m/s) và góc (rad/s) trong hệ tọa độ robot
         """
         if dt <= 0:
             return 0.0, 0.0, 0.0
             
-        # Chuyển đổi encoder ticks/s sang vận tốc góc của bánh xe (rad/s)
-        wheel_angular_velocity = []
-        for ticks in encoder_values:
-            # Công thức: (ticks/s) * (2π rad/tick_per_rev) / gear_ratio
-            wheel_velocity = (ticks / self.encoder_ticks_per_rev) * (2 * math.pi) / self.gear_ratio
-            wheel_angular_velocity.append(wheel_velocity)
-            
-        # Chuyển đổi vận tốc góc bánh xe sang vận tốc tuyến tính bánh xe
-        wheel_linear_velocity = [w * self.wheel_radius for w in wheel_angular_velocity]
-        
-        # Áp dụng động học thuận để tính vận tốc robot
-        velocity = np.dot(self.forward_matrix, wheel_linear_velocity)
+        # Chuyển đổi encoder ticks/s sang RPM của bánh xe
+        wheel_rpm = [
+            (ticks / self.encoder_ticks_per_rev) * 60.0 / self.gear_ratio
+            for ticks in encoder_values
+        ]
         
-        return velocity[0], velocity[1], velocity[2]
+        # Vận tốc trong hệ tọa độ robot tương ứng với theta = 0
+        return self.kinematics.velocity(0.0, wheel_rpm)
     
     def update_pose(self, current_pose: Dict[str, float], 
                    encoder_values: List[float], 
@@ -0,0 +1,381 @@
+"""
+Batch recomputation of robot trajectories from stored encoder data.
+
+Work is sharded by robot_id and time range and spread over a process pool.
+Every worker opens its own database connection, streams only the timestamp and
+RPM columns of its shard and integrates it relative to the shard start pose.
+The parent process chains the shards of each robot (a trajectory started at
+pose P is the trajectory started at the origin, rotated by P.theta and
+translated to P.x, P.y) and writes every shard back as a TrajectoryData segment.
+
+Usage:
+    python trajectory_recompute.py --robot robot1 --robot robot2 --shard-hours 1 --workers 8
+"""
+import os
+import math
+import time
+import uuid
+import logging
+import argparse
+import threading
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import create_engine, select, func
+
+import kinematics
+from robot_database import DATABASE_URL, SessionLocal, EncoderData, TrajectoryData
+
+logger = logging.getLogger("trajectory_recompute")
+
+# Rows fetched per round trip when streaming a shard
+FETCH_SIZE = 5000
+
+# Finished API jobs are kept this many seconds, and at most this many jobs in total
+JOB_TTL = 3600
+MAX_JOBS = 100
+
+# Per-process engine, created by _init_worker
+_worker_engine = None
+
+
+# === SHARD PLANNING ===
+
+def list_robot_ids(session) -> List[str]:
+    """Robot IDs that have encoder data"""
+    return [r[0] for r in session.query(EncoderData.robot_id).distinct().all()]
+
+
+def plan_shards(session, robot_ids=None, start_time=None, end_time=None, shard_hours=1.0) -> List[dict]:
+    """
+    Split the requested work into (robot_id, time range) shards
+
+    Args:
+        session: SQLAlchemy session used to look up data ranges
+        robot_ids: Robots to process, every robot with encoder data when None
+        start_time, end_time: Optional bounds of the time window
+        shard_hours: Length of one shard
+
+    Returns:
+        List of shard dicts ordered by robot then time
+    """
+    if not shard_hours > 0:
+        raise ValueError(f"shard_hours must be positive, got {shard_hours}")
+    if isinstance(robot_ids, str):
+        raise ValueError(f"robot_ids must be a list of robot IDs, got the string {robot_ids!r}")
+    if not robot_ids:
+        robot_ids = list_robot_ids(session)
+
+    shard_length = datetime.timedelta(hours=shard_hours)
+    shards = []
+    for robot_id in robot_ids:
+        first, last = session.query(
+            func.min(EncoderData.timestamp), func.max(EncoderData.timestamp)
+        ).filter(EncoderData.robot_id == robot_id).one()
+        if first is None:
+            continue
+
+        window_start = max(first, start_time) if start_time else first
+        window_end = min(last, end_time) if end_time else last
+        if window_start > window_end:
+            continue
+
+        index = 0
+        shard_start = window_start
+        while shard_start <= window_end:
+            shard_end = min(shard_start + shard_length, window_end)
+            shards.append({
+                "robot_id": robot_id,
+                "index": index,
+                "start": shard_start,
+                "end": shard_end,
+                # The last shard is closed so the final sample is included
+                "inclusive_end": shard_end == window_end,
+                "window_start": window_start,
+            })
+            index += 1
+            if shard_end == window_end:
+                break
+            shard_start = shard_end
+    return shards
+
+
+# === WORKER SIDE ===
+
+def _init_worker(database_url):
+    """Give every worker process its own engine and connection"""
+    global _worker_engine
+    _worker_engine = create_engine(database_url, pool_size=1, max_overflow=0)
+
+
+def _stream_columns(conn, shard):
+    """Stream (timestamp, rpm) of one shard into numpy arrays"""
+    ts_col = EncoderData.timestamp
+    query = select(ts_col, EncoderData.rpm_1, EncoderData.rpm_2, EncoderData.rpm_3).where(
+        EncoderData.robot_id == shard["robot_id"], ts_col >= shard["start"]
+    )
+    if shard["inclusive_end"]:
+        query = query.where(ts_col <= shard["end"])
+    else:
+        query = query.where(ts_col < shard["end"])
+    query = query.order_by(ts_col)
+
+    times = []
+    rpm_chunks = []
+    result = conn.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(query)
+    for rows in result.partitions(FETCH_SIZE):
+        times.extend(r[0].timestamp() for r in rows)
+        rpm_chunks.append(np.array([(r[1] or 0.0, r[2] or 0.0, r[3] or 0.0) for r in rows], dtype=float))
+
+    rpm = np.concatenate(rpm_chunks) if rpm_chunks else np.empty((0, 3))
+    return np.array(times, dtype=float), rpm
+
+
+def _process_shard(shard) -> dict:
+    """Integrate one shard relative to the pose at its start"""
+    started = time.perf_counter()
+    with _worker_engine.connect() as conn:
+        times, rpm = _stream_columns(conn, shard)
+
+        # Timestamp of the sample just before the shard gives the first time step
+        previous = None
+        if shard["start"] > shard["window_start"]:
+            previous = conn.execute(
+                select(func.max(EncoderData.timestamp)).where(
+                    EncoderData.robot_id == shard["robot_id"],
+                    EncoderData.timestamp < shard["start"],
+                    EncoderData.timestamp >= shard["window_start"],
+                )
+            ).scalar()
+
+    kin = kinematics.for_robot(shard["robot_id"])
+    if len(times) == 0:
+        segment = {'x': np.zeros(0), 'y': np.zeros(0), 'theta': np.zeros(0)}
+    else:
+        if previous is None:
+            # First shard of the window: the first sample is the origin
+            dt = np.diff(times)
+            step_rpm = rpm[1:]
+        else:
+            dt = np.diff(times, prepend=previous.timestamp())
+            step_rpm = rpm
+        dt[dt <= 0] = kin.geometry.dt
+        segment = kin.integrate(step_rpm, dt)
+        if previous is not None:
+            # Drop the start pose, it belongs to the previous shard
+            segment = {k: v[1:] for k, v in segment.items()}
+
+    return {
+        "robot_id": shard["robot_id"],
+        "index": shard["index"],
+        "start": shard["start"],
+        "end": shard["end"],
+        "samples": int(len(times)),
+        "segment": segment,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+# === PARENT SIDE ===
+
+def compose(pose, segment):
+    """Place a segment computed from the origin at the given start pose"""
+    x0, y0, theta0 = pose
+    c = math.cos(theta0)
+    s = math.sin(theta0)
+    x = x0 + c * segment['x'] - s * segment['y']
+    y = y0 + s * segment['x'] + c * segment['y']
+    theta = np.arctan2(np.sin(segment['theta'] + theta0), np.cos(segment['theta'] + theta0))
+    return {'x': x, 'y': y, 'theta': theta}
+
+
+class SegmentWriter:
+    """Chains the shards of one robot in order and writes them as segments"""
+
+    def __init__(self, robot_id, session, write=True):
+        self.robot_id = robot_id
+        self.session = session
+        self.write = write
+        self.pose = (0.0, 0.0, 0.0)
+        self.next_index = 0
+        self.pending: Dict[int, dict] = {}
+        self.points = 0
+
+    def add(self, result):
+        """Accept a finished shard, flush every shard that is now in order"""
+        self.pending[result["index"]] = result
+        while self.next_index in self.pending:
+            self._flush(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def _flush(self, result):
+        segment = compose(self.pose, result["segment"])
+        if len(segment['x']):
+            self.pose = (float(segment['x'][-1]), float(segment['y'][-1]), float(segment['theta'][-1]))
+        self.points += len(segment['x'])
+
+        if self.write and len(segment['x']):
+            self.session.add(TrajectoryData(
+                robot_id=self.robot_id,
+                current_x=self.pose[0],
+                current_y=self.pose[1],
+                current_theta=self.pose[2],
+                status="recomputed",
+                source="batch_recompute",
+                points={k: segment[k].tolist() for k in ('x', 'y', 'theta')},
+                timestamp=result["end"],
+                raw_data={
+                    "segment_index": result["index"],
+                    "start_time": result["start"].isoformat(),
+                    "end_time": result["end"].isoformat(),
+                    "samples": result["samples"],
+                },
+                robot_data=False,
+            ))
+            self.session.commit()
+
+
+def recompute_trajectories(robot_ids=None, start_time=None, end_time=None, shard_hours=1.0,
+                           workers=None, write=True,
+                           progress: Optional[Callable[[int, int, dict], None]] = None,
+                           database_url=DATABASE_URL) -> dict:
+    """
+    Recompute trajectories for many robots in parallel
+
+    Args:
+        robot_ids: Robots to process, every robot with encoder data when None
+        start_time, end_time: Optional time window
+        shard_hours: Length of one unit of work
+        workers: Process count, os.cpu_count() when None
+        write: Write the segments back to trajectory_data
+        progress: Callback (done, total, shard_result) called as shards finish
+
+    Returns:
+        Summary dict with per robot points and overall throughput
+    """
+    if workers is not None and workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+    started = time.perf_counter()
+    session = SessionLocal()
+    try:
+        shards = plan_shards(session, robot_ids, start_time, end_time, shard_hours)
+        writers = {}
+        total_samples = 0
+        done = 0
+        workers = workers or os.cpu_count() or 1
+        logger.info(f"Recomputing {len(shards)} shards with {workers} workers")
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(database_url,)) as pool:
+            futures = [pool.submit(_process_shard, shard) for shard in shards]
+            for future in as_completed(futures):
+                result = future.result()
+                robot_id = result["robot_id"]
+                if robot_id not in writers:
+                    writers[robot_id] = SegmentWriter(robot_id, session, write)
+                writers[robot_id].add(result)
+
+                done += 1
+                total_samples += result["samples"]
+                logger.info(f"Shard {done}/{len(shards)}: robot {robot_id} #{result['index']} "
+                            f"({result['samples']} samples, {result['seconds']:.2f}s)")
+                if progress:
+                    progress(done, len(shards), result)
+
+        elapsed = time.perf_counter() - started
+        return {
+            "shards": len(shards),
+            "samples": total_samples,
+            "seconds": elapsed,
+            "samples_per_second": total_samples / elapsed if elapsed > 0 else 0.0,
+            "workers": workers,
+            "robots": {
+                rid: {"points": w.points, "final_pose": {"x": w.pose[0], "y": w.pose[1], "theta": w.pose[2]}}
+                for rid, w in writers.items()
+            },
+        }
+    finally:
+        session.close()
+
+
+# === BACKGROUND JOBS (used by the API) ===
+
+recompute_jobs: Dict[str, dict] = {}
+
+
+def _evict_jobs(now):
+    """Drop finished jobs older than JOB_TTL, then the oldest finished ones above MAX_JOBS"""
+    finished = [job for job in recompute_jobs.values() if job["finished_at"] is not None]
+    for job in finished:
+        if now - job["finished_at"] > JOB_TTL:
+            del recompute_jobs[job["job_id"]]
+    finished = sorted((job for job in recompute_jobs.values() if job["finished_at"] is not None),
+                      key=lambda job: job["finished_at"])
+    for job in finished[:max(0, len(recompute_jobs) - MAX_JOBS + 1)]:
+        del recompute_jobs[job["job_id"]]
+
+
+def start_recompute_job(**kwargs) -> str:
+    """Run recompute_trajectories in a background thread, returns a job id"""
+    now = time.time()
+    _evict_jobs(now)
+    job_id = uuid.uuid4().hex[:12]
+    job = {"job_id": job_id, "status": "running", "done": 0, "total": 0,
+           "started_at": now, "finished_at": None, "result": None, "error": None}
+    recompute_jobs[job_id] = job
+
+    def on_progress(done, total, _result):
+        job["done"] = done
+        job["total"] = total
+
+    def run():
+        try:
+            job["result"] = recompute_trajectories(progress=on_progress, **kwargs)
+            job["status"] = "completed"
+        except Exception as e:
+            logger.error(f"Recompute job {job_id} failed: {e}")
+            job["error"] = str(e)
+            job["status"] = "error"
+        job["finished_at"] = time.time()
+
+    threading.Thread(target=run, daemon=True).start()
+    return job_id
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute robot trajectories from encoder data in parallel')
+    parser.add_argument('--robot', action='append', help='Robot ID (repeatable, default: all robots)')
+    parser.add_argument('--start', help='Window start, ISO format')
+    parser.add_argument('--end', help='Window end, ISO format')
+    parser.add_argument('--shard-hours', type=float, default=1.0, help='Shard length in hours (default: 1)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--dry-run', action='store_true', help='Compute only, do not write segments')
+    args = parser.parse_args()
+    if not args.shard_hours > 0:
+        parser.error("--shard-hours must be positive")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    summary = recompute_trajectories(
+        robot_ids=args.robot,
+        start_time=_parse_time(args.start),
+        end_time=_parse_time(args.end),
+        shard_hours=args.shard_hours,
+        workers=args.workers,
+        write=not args.dry_run,
+    )
+    print(f"Processed {summary['samples']} samples in {summary['shards']} shards "
+          f"({summary['samples_per_second']:.0f} samples/s, {summary['workers']} workers)")
+    for robot_id, info in summary["robots"].items():
+        print(f"  {robot_id}: {info['points']} points, final pose {info['final_pose']}")
+
+
+if __name__ == "__main__":
+    main()
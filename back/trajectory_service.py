@@ -83,16 +83,16 @@ class TrajectoryService:
             else:
                 theta = position["theta"]
             
-            # Calculate velocities using the new TrajectoryCalculator
-            vx, vy, omega = TrajectoryCalculator.compute_velocity(theta, rpm_values)
+            # World frame velocities from the shared kinematics model
+            vx, vy, omega = TrajectoryCalculator.compute_velocity(theta, rpm_values, robot_id)
             
             # Calculate time since last update
             current_time = datetime.now().timestamp()
             dt = current_time - position["last_update"]
             
             # Update position using velocity and time
-            x = position["x"] + (vx * np.cos(theta) - vy * np.sin(theta)) * dt
-            y = position["y"] + (vx * np.sin(theta) + vy * np.cos(theta)) * dt
+            x = position["x"] + vx * dt
+            y = position["y"] + vy * dt
             new_theta = theta + omega * dt
             
             # Update robot position
@@ -2,6 +2,7 @@ import json
 import math
 import logging
 from datetime import datetime
+import kinematics
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,8 +12,8 @@ class TrajectoryCalculator:
     """Utility class for trajectory calculations"""
     
     @staticmethod
-    def calculate_position(current_position, encoder_values, orientation=None):
-        """Calculate new position based on encoder values and orientation"""
+    def calculate_position(current_position, encoder_values, orientation=None, robot_id=None):
+        """Calculate new position based on encoder values (wheel RPM) and orientation"""
         try:
             # Extract current position
             x = current_position.get("x", 0)
@@ -23,25 +24,21 @@ class TrajectoryCalculator:
             if orientation and "yaw" in orientation:
                 theta = orientation["yaw"]  # Use IMU yaw if available
             
-            # Get encoder values
-            # Assuming we have 3 motors in a holonomic configuration
-            e1 = encoder_values[0] if len(encoder_values) > 0 else 0
-            e2 = encoder_values[1] if len(encoder_values) > 1 else 0
-            e3 = encoder_values[2] if len(encoder_values) > 2 else 0
+            # Encoder values are wheel RPM of the 3-wheel omni base
+            rpm = [encoder_values[i] if len(encoder_values) > i else 0 for i in range(3)]
             
-            # Simplified model for demonstration - real robots would need more complex mapping
-            # This is just a placeholder implementation
-            velocity_x = (2*e1 - e2 - e3) / 3 * 0.01  # Scale factor for demo
-            velocity_y = (e2 - e3) * 0.01  # Scale factor
-            velocity_theta = (e1 + e2 + e3) * 0.001  # Scale factor
+            # World frame velocities from the shared kinematics model
+            kin = kinematics.for_robot(robot_id)
+            velocity_x, velocity_y, velocity_theta = kin.velocity(theta, rpm)
+            dt = kin.geometry.dt
             
             # Update position
-            x += velocity_x * math.cos(theta) - velocity_y * math.sin(theta)
-            y += velocity_x * math.sin(theta) + velocity_y * math.cos(theta)
+            x += velocity_x * dt
+            y += velocity_y * dt
             
             # Update orientation if no IMU data
             if not orientation:
-                theta += velocity_theta
+                theta += velocity_theta * dt
                 # Normalize theta to [-π, π]
                 theta = ((theta + math.pi) % (2 * math.pi)) - math.pi
             
@@ -0,0 +1,231 @@
+"""
+UDP channel for robot telemetry, next to the TCP connection.
+
+Encoder/IMU readings are loss tolerant. Sent over the robot's TCP stream they
+wait behind each other (head-of-line blocking) and each one costs an ack.
+With UDP_TELEMETRY_PORT set, the registration_confirmation sent over TCP
+carries {"udp": {"port": ..., "token": ...}}, and the robot may then send
+telemetry as datagrams to that port:
+
+    0      2        3        4            8                  24
+    | "RT" | ver=1  | flags  | seq uint32 | token (16 bytes) | one JSON line
+
+seq counts datagrams of the robot (+1 each, wraps at 2^32). The token is
+issued per TCP registration, bound to the robot and the host of its TCP
+connection, and revoked when that connection closes, so a datagram is only
+accepted while its robot is registered. A payload naming another robot
+("robot_id" or "id") is dropped. A 64-datagram sliding window per robot
+drops duplicates/replays and counts lost and reordered datagrams; /udp on the
+metrics port shows them per robot.
+
+Accepted payloads go to the same pipeline as TCP data (journal, frontend)
+through tcp_server.ingest_udp_message; there is no ack. Registration and
+commands stay on TCP.
+"""
+import json
+import time
+import socket
+import struct
+import asyncio
+import logging
+import secrets
+from typing import Awaitable, Callable, Dict, Optional
+
+import metrics
+import tracing
+from message_peek import peek
+from config import UDP_QUEUE_SIZE, UDP_RCVBUF, UDP_CHECK_SOURCE
+
+logger = logging.getLogger("udp_telemetry")
+
+HEADER = struct.Struct("!2sBBI16s")
+MAGIC = b"RT"
+VERSION = 1
+WINDOW = 64
+_SEQ_MOD = 1 << 32
+_WINDOW_MASK = (1 << WINDOW) - 1
+# Registration, keepalives and command replies need the TCP connection
+UDP_TYPES = tracing.TELEMETRY_TYPES - {"registration", "heartbeat", "ping", "pong"}
+
+UDP_DATAGRAMS = metrics.counter("udp_datagrams_total", "Telemetry datagrams by outcome", ["result"])
+UDP_LOST = metrics.counter("udp_lost_total", "Datagrams missing from the robot sequence")
+UDP_REORDERED = metrics.counter("udp_reordered_total", "Datagrams that arrived after a later one")
+UDP_SESSIONS = metrics.gauge("udp_sessions", "Robots holding a UDP token")
+
+
+class SequenceWindow:
+    """Sliding window over the robot's sequence numbers (like IPsec anti-replay)"""
+    __slots__ = ("highest", "mask", "received", "lost", "reordered", "duplicates", "too_old")
+
+    def __init__(self):
+        self.highest = None
+        self.mask = 0  # bit i: highest - i was received
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.too_old = 0
+
+    def accept(self, seq) -> Optional[str]:
+        """None if the datagram is new, otherwise why it is dropped ("duplicate", "too_old")"""
+        if self.highest is None:
+            self.highest = seq
+            self.mask = 1
+        else:
+            ahead = (seq - self.highest) % _SEQ_MOD
+            if 0 < ahead < _SEQ_MOD // 2:
+                # Newer than anything seen: the skipped numbers are lost until they show up
+                self.lost += ahead - 1
+                UDP_LOST.inc(ahead - 1)
+                self.mask = ((self.mask << ahead) | 1) & _WINDOW_MASK if ahead < WINDOW else 1
+                self.highest = seq
+            else:
+                behind = (self.highest - seq) % _SEQ_MOD
+                if behind >= WINDOW:
+                    self.too_old += 1
+                    return "too_old"
+                bit = 1 << behind
+                if self.mask & bit:
+                    self.duplicates += 1
+                    return "duplicate"
+                # A gap that was counted as lost arrived late after all
+                # (udp_lost_total only grows: net loss = lost - reordered)
+                self.mask |= bit
+                self.lost -= 1
+                self.reordered += 1
+                UDP_REORDERED.inc()
+        self.received += 1
+        return None
+
+    def to_dict(self) -> dict:
+        return {"received": self.received, "lost": self.lost, "reordered": self.reordered,
+                "duplicates": self.duplicates, "too_old": self.too_old, "highest_seq": self.highest}
+
+
+class Session:
+    __slots__ = ("robot_id", "host", "token", "window", "issued")
+
+    def __init__(self, robot_id, host, token):
+        self.robot_id = robot_id
+        self.host = host
+        self.token = token
+        self.window = SequenceWindow()
+        self.issued = time.time()
+
+
+class UDPTelemetry(asyncio.DatagramProtocol):
+    def __init__(self, handler: Callable[[str, str, str, float], Awaitable[None]], queue_size=UDP_QUEUE_SIZE,
+                 check_source=UDP_CHECK_SOURCE):
+        self.handler = handler
+        self.check_source = check_source
+        self.sessions: Dict[bytes, Session] = {}  # token -> session
+        self.by_robot: Dict[str, Session] = {}
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.transport = None
+        self.port = None
+        self.consumer = None
+
+    async def start(self, host, port):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+        sock.bind((host, port))
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        self.port = sock.getsockname()[1]
+        self.consumer = asyncio.create_task(self._consume())
+        metrics.add_endpoint("/udp", self._stats_endpoint)
+        logger.info(f"UDP telemetry listening on {host}:{self.port}")
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.consumer is not None:
+            self.consumer.cancel()
+
+    # === Tokens, issued and revoked by the TCP side ===
+
+    def issue(self, robot_id, host) -> str:
+        """New token for a robot that just registered over TCP from `host` (replaces its previous one)"""
+        self.revoke(robot_id)
+        session = Session(robot_id, host, secrets.token_bytes(16))
+        self.sessions[session.token] = session
+        self.by_robot[robot_id] = session
+        UDP_SESSIONS.set(len(self.by_robot))
+        return session.token.hex()
+
+    def revoke(self, robot_id):
+        session = self.by_robot.pop(robot_id, None)
+        if session is not None:
+            self.sessions.pop(session.token, None)
+            UDP_SESSIONS.set(len(self.by_robot))
+
+    # === Datagrams ===
+
+    def datagram_received(self, data, addr):
+        received_at = time.time()
+        if len(data) <= HEADER.size:
+            UDP_DATAGRAMS.labels("bad_header").inc()
+            return
+        magic, version, _, seq, token = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            UDP_DATAGRAMS.labels("bad_header").inc()
+            return
+        session = self.sessions.get(token)
+        if session is None:
+            UDP_DATAGRAMS.labels("bad_token").inc()
+            return
+        if self.check_source and addr[0] != session.host:
+            UDP_DATAGRAMS.labels("wrong_source").inc()
+            return
+        rejected = session.window.accept(seq)
+        if rejected is not None:
+            UDP_DATAGRAMS.labels(rejected).inc()
+            return
+        if self.queue.full():
+            # Telemetry is loss tolerant: shed rather than queue without bound
+            UDP_DATAGRAMS.labels("queue_full").inc()
+            return
+        UDP_DATAGRAMS.labels("accepted").inc()
+        self.queue.put_nowait((session.robot_id, data[HEADER.size:], received_at))
+
+    def error_received(self, exc):
+        logger.warning(f"UDP telemetry socket error: {exc}")
+
+    async def _consume(self):
+        while True:
+            robot_id, payload, received_at = await self.queue.get()
+            try:
+                message = payload.decode("utf-8", "replace").rstrip("\n")
+                header = peek(message)
+                if header is not None and '"id"' not in message:
+                    msg_type, claimed = header[0], header[1]
+                    claimed = {claimed} if claimed is not None else set()
+                else:
+                    # "id" is what the drainer stores the row under, peek() does not read it
+                    data = json.loads(message)
+                    msg_type = data.get("type")
+                    claimed = {str(data[key]) for key in ("robot_id", "id") if key in data}
+                if msg_type not in UDP_TYPES:
+                    UDP_DATAGRAMS.labels("bad_type").inc()
+                    continue
+                if claimed - {robot_id}:
+                    # The token only vouches for its own robot
+                    UDP_DATAGRAMS.labels("wrong_robot").inc()
+                    continue
+                await self.handler(robot_id, message, msg_type, received_at)
+            except json.JSONDecodeError:
+                UDP_DATAGRAMS.labels("bad_payload").inc()
+            except Exception as e:
+                logger.error(f"Error handling UDP telemetry of {robot_id}: {e}")
+
+    def stats(self) -> dict:
+        return {"port": self.port, "queued": self.queue.qsize(),
+                "robots": {robot_id: session.window.to_dict() for robot_id, session in self.by_robot.items()}}
+
+    def _stats_endpoint(self, query):
+        return "application/json", json.dumps(self.stats())
+
+
+def pack(seq, token: str, payload: bytes) -> bytes:
+    """Datagram as a robot sends it (token as received in registration_confirmation)"""
+    return HEADER.pack(MAGIC, VERSION, 0, seq % _SEQ_MOD, bytes.fromhex(token)) + payload
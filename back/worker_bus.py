@@ -0,0 +1,378 @@
+"""
+Inter-worker bus for multi-process TCP ingest (ingest_workers.py).
+
+The supervisor runs a BusHub on a Unix domain socket; every tcp_server worker
+connects a WorkerBus to it. The hub keeps the node's robot registry
+(robot_id -> owning worker + registration data) and replicates it to all of
+its workers, so each worker knows every robot of the node without asking.
+Commands for a robot connected to another worker are sent through the hub to
+the owner.
+
+With peers configured the hub is also one node of a cluster (ownership.py):
+it holds the leases of the robots that hash to it, renews the leases of its
+own robots on their directory nodes, and forwards commands for robots it does
+not hold: origin node -> directory node -> owning node.
+
+Protocol: newline-delimited JSON objects with an "op" field.
+    worker -> hub   hello {worker}, register {robot_id, info}, unregister {robot_id},
+                    command {robot_id, data}
+    hub -> worker   snapshot {robots, cluster}, registered {robot_id, worker, info},
+                    unregistered {robot_id, worker}, command {robot_id, data, origin},
+                    command_failed {robot_id, data, reason}, revoke {robot_id}
+    node -> node    hello {node}, acquire {robot_id, node}, renew {node, robots},
+                    release {robot_id, node}, revoke {robot_id}, route/deliver {robot_id,
+                    data, origin_node, origin_worker}, command_failed {robot_id, data,
+                    reason, origin_worker}
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+import metrics
+from config import NODE_ID, LEASE_TTL
+from ownership import HashRing, RoutingTable
+
+logger = logging.getLogger("worker_bus")
+
+BUS_MESSAGES = metrics.counter("worker_bus_messages_total", "Messages sent over the inter-worker bus", ["op"])
+BUS_ROUTED = metrics.counter("worker_bus_routed_commands_total", "Commands routed to the worker owning the robot")
+NODE_PEERS = metrics.gauge("cluster_peer_nodes", "Peer nodes this node is connected to")
+NODE_LEASES = metrics.gauge("cluster_directory_leases", "Robot leases held in this node's directory shard")
+NODE_FORWARDED = metrics.counter("cluster_forwarded_total", "Messages forwarded to other nodes", ["op"])
+
+RECONNECT_DELAY = 1.0  # giây giữa hai lần thử kết nối lại node khác
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+async def open_link(address):
+    """Connect to "unix:/path" or "host:port" """
+    if address.startswith("unix:"):
+        return await asyncio.open_unix_connection(address[5:])
+    host, _, port = address.rpartition(":")
+    return await asyncio.open_connection(host, int(port))
+
+
+async def start_listener(address, handler):
+    if address.startswith("unix:"):
+        path = address[5:]
+        if os.path.exists(path):
+            os.remove(path)
+        return await asyncio.start_unix_server(handler, path=path)
+    host, _, port = address.rpartition(":")
+    return await asyncio.start_server(handler, host, int(port))
+
+
+class BusHub:
+    """Registry and router of one node, runs in the supervisor process"""
+
+    def __init__(self, path, node_id=NODE_ID, listen=None, peers: Optional[Dict[str, str]] = None,
+                 lease_ttl=LEASE_TTL):
+        self.path = path
+        self.node_id = node_id
+        self.listen = listen
+        self.peer_addresses = peers or {}
+        self.workers: Dict[int, asyncio.StreamWriter] = {}
+        self.robots: Dict[str, dict] = {}  # robots of this node: robot_id -> {"worker": id, "info": registration}
+        self.peers: Dict[str, asyncio.StreamWriter] = {}  # reachable nodes -> outgoing link
+        self.incoming = set()  # links opened by other nodes
+        self.ring = HashRing([node_id])
+        self.table = RoutingTable(lease_ttl)
+        self.lease_ttl = lease_ttl
+        self.server = None
+        self.peer_server = None
+        self.tasks = []
+
+    @property
+    def cluster(self) -> bool:
+        return bool(self.peer_addresses)
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self._handle_worker, path=self.path)
+        logger.info(f"Worker bus listening on {self.path}")
+        if self.listen:
+            self.peer_server = await start_listener(self.listen, self._handle_peer)
+            logger.info(f"Node {self.node_id} listening for peers on {self.listen}")
+        for node, address in self.peer_addresses.items():
+            self.tasks.append(asyncio.create_task(self._connect_peer(node, address)))
+        self.tasks.append(asyncio.create_task(self._heartbeat()))
+
+    # --- workers of this node ---
+
+    def _send(self, worker_id, message):
+        writer = self.workers.get(worker_id)
+        if writer is not None:
+            writer.write(_encode(message))
+
+    def _broadcast(self, message):
+        data = _encode(message)
+        for writer in list(self.workers.values()):
+            writer.write(data)
+
+    async def _handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "hello":
+                    worker_id = message["worker"]
+                    self.workers[worker_id] = writer
+                    writer.write(_encode({"op": "snapshot", "robots": self.robots, "cluster": self.cluster}))
+                    logger.info(f"Worker {worker_id} joined the bus")
+                elif op == "register":
+                    robot_id = message["robot_id"]
+                    entry = {"worker": worker_id, "info": message.get("info")}
+                    self.robots[robot_id] = entry
+                    self._broadcast({"op": "registered", "robot_id": robot_id, **entry})
+                    self._to_directory(robot_id, {"op": "acquire", "robot_id": robot_id, "node": self.node_id})
+                elif op == "unregister":
+                    self._unregister(message["robot_id"], worker_id)
+                elif op == "command":
+                    robot_id = message["robot_id"]
+                    owner = self.robots.get(robot_id, {}).get("worker")
+                    if owner is not None and owner in self.workers:
+                        self._send(owner, {"op": "command", "robot_id": robot_id,
+                                           "data": message.get("data"), "origin": worker_id})
+                    else:
+                        self._to_directory(robot_id, {"op": "route", "robot_id": robot_id, "data": message.get("data"),
+                                                      "origin_node": self.node_id, "origin_worker": worker_id})
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Worker {worker_id} bus connection error: {e}")
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                # Robots of a dead worker are gone until they reconnect
+                for robot_id in [r for r, e in self.robots.items() if e["worker"] == worker_id]:
+                    self._unregister(robot_id, worker_id)
+                logger.info(f"Worker {worker_id} left the bus")
+            writer.close()
+
+    def _unregister(self, robot_id, worker_id):
+        # A robot that already reconnected to another worker stays registered there
+        if self.robots.get(robot_id, {}).get("worker") != worker_id:
+            return
+        del self.robots[robot_id]
+        self._broadcast({"op": "unregistered", "robot_id": robot_id, "worker": worker_id})
+        self._to_directory(robot_id, {"op": "release", "robot_id": robot_id, "node": self.node_id})
+
+    # --- other nodes ---
+
+    def _to_node(self, node, message) -> bool:
+        if node == self.node_id:
+            self._on_node_message(message)
+            return True
+        writer = self.peers.get(node)
+        if writer is None:
+            return False
+        NODE_FORWARDED.labels(message["op"]).inc()
+        writer.write(_encode(message))
+        return True
+
+    def _to_directory(self, robot_id, message):
+        if not self._to_node(self.ring.node_for(robot_id), message) and message["op"] == "route":
+            self._command_failed(message, "directory_unreachable")
+
+    def _command_failed(self, message, reason):
+        failure = {"op": "command_failed", "robot_id": message["robot_id"], "data": message.get("data"),
+                   "reason": reason, "origin_worker": message.get("origin_worker")}
+        self._to_node(message.get("origin_node", self.node_id), failure)
+
+    def _on_node_message(self, message):
+        op = message.get("op")
+        robot_id = message.get("robot_id")
+        if op == "acquire":
+            _, previous = self.table.acquire(robot_id, message["node"])
+            if previous:
+                logger.info(f"Robot {robot_id} moved from node {previous} to {message['node']}")
+                self._to_node(previous, {"op": "revoke", "robot_id": robot_id})
+        elif op == "renew":
+            for lost in self.table.renew(message["node"], message["robots"]):
+                self._to_node(message["node"], {"op": "revoke", "robot_id": lost})
+        elif op == "release":
+            self.table.release(robot_id, message["node"])
+        elif op == "revoke":
+            # Another node holds the robot's newer connection: drop ours
+            entry = self.robots.pop(robot_id, None)
+            if entry is not None:
+                self._send(entry["worker"], {"op": "revoke", "robot_id": robot_id})
+                self._broadcast({"op": "unregistered", "robot_id": robot_id, "worker": entry["worker"]})
+        elif op == "route":
+            # Directory node: look up the lease and pass the command to its owner
+            owner = self.table.owner(robot_id)
+            if owner is None or not self._to_node(owner, {**message, "op": "deliver"}):
+                self._command_failed(message, "not_connected")
+        elif op == "deliver":
+            owner = self.robots.get(robot_id, {}).get("worker")
+            if owner is None or owner not in self.workers:
+                self._command_failed(message, "not_connected")
+            else:
+                self._send(owner, {"op": "command", "robot_id": robot_id, "data": message.get("data"),
+                                   "origin": f"{message.get('origin_node')}/{message.get('origin_worker')}"})
+        elif op == "command_failed":
+            self._send(message.get("origin_worker"), {"op": "command_failed", "robot_id": robot_id,
+                                                      "data": message.get("data"), "reason": message.get("reason")})
+        NODE_LEASES.set(len(self.table.leases))
+
+    async def _connect_peer(self, node, address):
+        """Outgoing link to a peer node; the node is on the ring while the link is up"""
+        while True:
+            try:
+                reader, writer = await open_link(address)
+                writer.write(_encode({"op": "hello", "node": self.node_id}))
+                self.peers[node] = writer
+                self.ring.add(node)
+                NODE_PEERS.set(len(self.peers))
+                logger.info(f"Connected to node {node} at {address}")
+                # Leases of our robots may now hash to the new node
+                self._renew_all()
+                await reader.read()  # the peer never writes on this link, wait for it to close
+            except (ConnectionError, OSError) as e:
+                logger.debug(f"Node {node} at {address} unreachable: {e}")
+            finally:
+                if node in self.peers:
+                    del self.peers[node]
+                    self.ring.remove(node)
+                    NODE_PEERS.set(len(self.peers))
+                    logger.warning(f"Lost node {node}")
+                    self._renew_all()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _handle_peer(self, reader, writer):
+        node = None
+        self.incoming.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message.get("op") == "hello":
+                    node = message["node"]
+                    continue
+                self._on_node_message(message)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Node {node} link error: {e}")
+        finally:
+            self.incoming.discard(writer)
+            writer.close()
+
+    def _renew_all(self):
+        """Heartbeat: renew every robot of this node on its directory node"""
+        by_directory: Dict[str, list] = {}
+        for robot_id in self.robots:
+            by_directory.setdefault(self.ring.node_for(robot_id), []).append(robot_id)
+        for node, robot_ids in by_directory.items():
+            self._to_node(node, {"op": "renew", "node": self.node_id, "robots": robot_ids})
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            self._renew_all()
+            for lease in self.table.expire():
+                logger.info(f"Lease of robot {lease.robot_id} on node {lease.node} expired")
+            NODE_LEASES.set(len(self.table.leases))
+
+    def stats(self) -> dict:
+        return {"node": self.node_id, "peers": sorted(self.peers), "ring": sorted(self.ring.nodes),
+                "workers": sorted(self.workers), "robots": {r: e["worker"] for r, e in self.robots.items()},
+                "leases": self.table.snapshot()}
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for server in (self.server, self.peer_server):
+            if server:
+                server.close()
+                await server.wait_closed()
+        for writer in list(self.workers.values()) + list(self.peers.values()) + list(self.incoming):
+            writer.close()
+        # Let the connection handlers see the EOF and finish before the loop stops
+        await asyncio.sleep(0.1)
+
+
+class WorkerBus:
+    """Bus client of one tcp_server worker"""
+
+    def __init__(self, path, worker_id,
+                 on_command: Callable[[str, dict], Awaitable[None]],
+                 on_command_failed: Optional[Callable[[str, dict, str], Awaitable[None]]] = None,
+                 on_revoke: Optional[Callable[[str], Awaitable[None]]] = None):
+        self.path = path
+        self.worker_id = worker_id
+        self.on_command = on_command
+        self.on_command_failed = on_command_failed
+        self.on_revoke = on_revoke
+        self.robots: Dict[str, dict] = {}  # replica of the node registry
+        self.cluster = False  # other nodes may hold robots this node does not know
+        self.writer = None
+        self.task = None
+
+    async def connect(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self._send({"op": "hello", "worker": self.worker_id})
+        self.task = asyncio.create_task(self._read(reader))
+
+    def _send(self, message):
+        BUS_MESSAGES.labels(message["op"]).inc()
+        self.writer.write(_encode(message))
+
+    async def _read(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                logger.error("Worker bus closed by the supervisor")
+                return
+            message = json.loads(line)
+            op = message.get("op")
+            if op == "snapshot":
+                self.robots = message["robots"]
+                self.cluster = message.get("cluster", False)
+            elif op == "registered":
+                self.robots[message["robot_id"]] = {"worker": message["worker"], "info": message.get("info")}
+            elif op == "unregistered":
+                if self.robots.get(message["robot_id"], {}).get("worker") == message["worker"]:
+                    del self.robots[message["robot_id"]]
+            elif op == "command":
+                try:
+                    await self.on_command(message["robot_id"], message["data"])
+                except Exception as e:
+                    logger.error(f"Routed command for {message['robot_id']} failed: {e}")
+            elif op == "command_failed" and self.on_command_failed:
+                await self.on_command_failed(message["robot_id"], message.get("data"), message.get("reason"))
+            elif op == "revoke" and self.on_revoke:
+                await self.on_revoke(message["robot_id"])
+
+    def owner(self, robot_id) -> Optional[int]:
+        """Worker of this node holding robot_id, None if unknown or on another node"""
+        entry = self.robots.get(robot_id)
+        return entry["worker"] if entry else None
+
+    def register(self, robot_id, info):
+        self._send({"op": "register", "robot_id": robot_id, "info": info})
+
+    def unregister(self, robot_id):
+        self._send({"op": "unregister", "robot_id": robot_id})
+
+    def send_command(self, robot_id, data) -> bool:
+        """
+        Route a command to the worker owning robot_id
+
+        False if no worker of this node has it and there are no other nodes; in
+        a cluster the command is sent anyway and a failure comes back as
+        command_failed.
+        """
+        if self.owner(robot_id) is None and not self.cluster:
+            return False
+        BUS_ROUTED.inc()
+        self._send({"op": "command", "robot_id": robot_id, "data": data})
+        return True
@@ -9,6 +9,26 @@ import os
 from datetime import datetime
 import traceback
 
+import metrics
+import tracing
+import loop_monitor
+import profiler
+from message_peek import peek
+from line_framer import LineFramer
+from command_lanes import CommandLanes
+from timer_wheel import Keepalive
+from config import WS_BRIDGE_METRICS_PORT, TCP_PASSTHROUGH
+
+# Metrics (GET /metrics trên WS_BRIDGE_METRICS_PORT)
+BRIDGE_CLIENTS = metrics.gauge("bridge_clients", "Connected frontend WebSocket clients")
+BRIDGE_TCP_SERVER_CONNECTED = metrics.gauge("bridge_tcp_server_connected", "1 while tcp_server is connected on /tcp_server")
+BRIDGE_RECEIVED = metrics.counter("bridge_messages_received_total", "Messages received by the bridge", ["source"])
+BRIDGE_PARSE_ERRORS = metrics.counter("bridge_parse_errors_total", "Invalid JSON messages", ["source"])
+BRIDGE_FORWARDED = metrics.counter("bridge_forwarded_total", "Messages forwarded by the bridge", ["direction"])
+BRIDGE_FORWARD_ERRORS = metrics.counter("bridge_forward_errors_total", "Failed forwards", ["direction"])
+BRIDGE_FANOUT_SECONDS = metrics.histogram("bridge_fanout_seconds", "Time to send one tcp_server message to all clients")
+BRIDGE_COMMAND_SECONDS = metrics.histogram("bridge_command_seconds", "Time to forward one frontend command to tcp_server", ["path"])
+
 # Cấu hình logging
 logging.basicConfig(
     level=logging.INFO,
@@ -89,7 +109,7 @@ class TCPClient:
         self.port = port
         self.socket = None
         self.connected = False
-        self.buffer = ""  # Add buffer for partial messages
+        self.framer = LineFramer()  # Dòng chưa nhận đủ từ TCP server
         self.lock = asyncio.Lock()  # Thêm lock để tránh nhiều thread gửi cùng lúc
         self.timeout = 3.0  # Timeout 3 giây cho các thao tác socket
     
@@ -105,7 +125,7 @@ class TCPClient:
             self.socket.settimeout(self.timeout)  # Timeout 3 giây
             self.socket.connect((self.host, self.port))
             self.connected = True
-            self.buffer = ''
+            self.framer.reset()
             
             # Đọc thông điệp chào mừng
             try:
@@ -238,12 +258,8 @@ async def listen_to_tcp_messages():
                     tcp_client.connected = False
                     continue
                 
-                # Thêm dữ liệu vào buffer
-                tcp_client.buffer += data.decode('utf-8')
-                
                 # Xử lý các dòng hoàn chỉnh
-                while '\n' in tcp_client.buffer:
-                    line, tcp_client.buffer = tcp_client.buffer.split('\n', 1)
+                for line in tcp_client.framer.lines(data):
                     if not line.strip():
                         continue
                     
@@ -319,34 +335,70 @@ async def broadcast_to_clients(message):
 # Cải thiện xử lý thông điệp từ WebSocket
 clients = {}
 tcp_server = None  # TCP server connection
+tcp_server_lanes = None  # CommandLanes của kết nối tới tcp_server: lệnh khẩn cấp không chờ sau lệnh điều khiển
 
 # Sửa hàm xử lý WebSocket để đảm bảo các lệnh từ frontend được chuyển tiếp đúng cách
-async def handle_websocket(websocket, path):
+async def handle_websocket(websocket, path=None):
     """
     Xử lý kết nối WebSocket từ frontend
     """
+    # websockets >= 14 không truyền path vào handler
+    if path is None:
+        path = getattr(websocket, "path", None) or websocket.request.path
     client_id = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
     logger.info(f"[WS] Kết nối mới từ {client_id} trên path {path}")
     
     # Special handling for TCP server connection
     if path == "/tcp_server":
         logger.info(f"[WS] TCP Server connected via WebSocket")
-        global tcp_server
+        global tcp_server, tcp_server_lanes
         tcp_server = websocket
+        if tcp_server_lanes is not None:
+            tcp_server_lanes.close()  # kết nối cũ chưa kịp đóng
+        tcp_server_lanes = CommandLanes("tcp_server", websocket.send)
+        BRIDGE_TCP_SERVER_CONNECTED.set(1)
         
         try:
             # Handle messages from TCP server
             async for message in websocket:
+                BRIDGE_RECEIVED.labels("tcp_server").inc()
                 try:
-                    data = json.loads(message)
+                    # Tin không có "ts" hay span đi nguyên văn tới frontend, chỉ peek type/trace_id
+                    header = None
+                    if TCP_PASSTHROUGH and '"ts"' not in message and tracing.SPANS_KEY not in message:
+                        header = peek(message)
+                    if header is not None:
+                        data = {"type": header[0], tracing.TRACE_KEY: header[2]}
+                    else:
+                        data = json.loads(message)
                     logger.info(f"[WS] Received from TCP server: {data.get('type')}")
                     
+                    # Đóng dấu thời gian chặng bridge nếu tin nhắn mang "ts" (benchmark)
+                    if isinstance(data.get("ts"), dict):
+                        data["ts"]["bridge"] = time.time()
+                        message = json.dumps(data)
+                    
+                    # Span của tcp_server đi kèm ack/phản hồi robot: gộp vào trace, không gửi cho frontend
+                    if tracing.SPANS_KEY in data:
+                        tracing.RECORDER.add(data.pop(tracing.SPANS_KEY))
+                        message = json.dumps(data)
+                    
                     # Forward messages to all connected clients
-                    for client_ws in clients.values():
+                    started = time.perf_counter()
+                    fanout_start = time.time()
+                    for client_ws in list(clients.values()):
                         try:
                             await client_ws.send(message)
+                            BRIDGE_FORWARDED.labels("to_client").inc()
                         except:
-                            pass
+                            BRIDGE_FORWARD_ERRORS.labels("to_client").inc()
+                    BRIDGE_FANOUT_SECONDS.observe(time.perf_counter() - started)
+                    if data.get(tracing.TRACE_KEY):
+                        tracing.RECORDER.record(data[tracing.TRACE_KEY], "bridge.fanout", fanout_start,
+                                                type=data.get("type"), clients=len(clients))
+                except json.JSONDecodeError as e:
+                    BRIDGE_PARSE_ERRORS.labels("tcp_server").inc()
+                    logger.error(f"[WS] Error processing TCP server message: {e}")
                 except Exception as e:
                     logger.error(f"[WS] Error processing TCP server message: {e}")
         except websockets.exceptions.ConnectionClosed:
@@ -355,11 +407,16 @@ async def handle_websocket(websocket, path):
             # Reset TCP server connection
             if tcp_server == websocket:
                 tcp_server = None
+                tcp_server_lanes.close()
+                tcp_server_lanes = None
+                BRIDGE_TCP_SERVER_CONNECTED.set(0)
         
         return
     
     # Regular client connection
     clients[client_id] = websocket
+    BRIDGE_CLIENTS.set(len(clients))
+    client_keepalive.add(client_id, websocket.send, websocket.close)
     
     # Đảm bảo có kết nối TCP
     ensure_tcp_connection()
@@ -377,10 +434,16 @@ async def handle_websocket(websocket, path):
         
         # Xử lý tin nhắn từ client
         async for message_text in websocket:
+            BRIDGE_RECEIVED.labels("frontend").inc()
+            started = time.perf_counter()
+            received_at = time.time()
             try:
                 # Parse tin nhắn JSON
                 message = json.loads(message_text)
                 
+                # Trace id cho lệnh từ dashboard (giữ nguyên nếu frontend đã gửi)
+                trace_id = tracing.ensure_trace_id(message)
+                
                 # Thêm timestamp nếu chưa có
                 if "timestamp" not in message:
                     message["timestamp"] = time.time()
@@ -404,9 +467,16 @@ async def handle_websocket(websocket, path):
                 if tcp_server:
                     # 1. Forward via WebSocket connection
                     try:
-                        await tcp_server.send(json.dumps(message))
+                        # Setpoint chưa gửi của cùng robot bị thay bằng lệnh mới (không giới hạn tốc độ ở đây, tcp_server giới hạn theo robot)
+                        if not tcp_server_lanes.put_command(json.dumps(message), message.get("type"), message.get("robot_id")):
+                            raise ConnectionError("TCP server WebSocket closed")
+                        BRIDGE_FORWARDED.labels("to_tcp_server").inc()
+                        BRIDGE_COMMAND_SECONDS.labels("websocket").observe(time.perf_counter() - started)
+                        tracing.RECORDER.record(trace_id, "bridge.receive", received_at, type=message.get("type"),
+                                                robot_id=message.get("robot_id"), path="websocket")
                         logger.info(f"[WS] Forwarded message to TCP server via WebSocket")
                     except Exception as e:
+                        BRIDGE_FORWARD_ERRORS.labels("to_tcp_server").inc()
                         logger.error(f"[WS] Error forwarding to TCP server via WebSocket: {e}")
                         # Fall back to TCP socket
                         if ensure_tcp_connection():
@@ -424,6 +494,10 @@ async def handle_websocket(websocket, path):
                     if ensure_tcp_connection():
                         try:
                             tcp_client.socket.sendall((json.dumps(message) + "\n").encode("utf-8"))
+                            BRIDGE_FORWARDED.labels("to_tcp_server").inc()
+                            BRIDGE_COMMAND_SECONDS.labels("socket").observe(time.perf_counter() - started)
+                            tracing.RECORDER.record(trace_id, "bridge.receive", received_at, type=message.get("type"),
+                                                    robot_id=message.get("robot_id"), path="socket")
                             logger.info(f"[WS] Forwarded message to TCP server via socket")
                             
                             # Read response from TCP server
@@ -431,18 +505,16 @@ async def handle_websocket(websocket, path):
                                 tcp_client.socket.settimeout(3)
                                 response_data = tcp_client.socket.recv(4096)
                                 if response_data:
-                                    response_text = response_data.decode("utf-8")
-                                    tcp_client.buffer += response_text
-                                    
                                     # Process complete messages
-                                    while "\n" in tcp_client.buffer:
-                                        line, tcp_client.buffer = tcp_client.buffer.split("\n", 1)
+                                    for line in tcp_client.framer.lines(response_data):
                                         if not line.strip():
                                             continue
                                             
                                         try:
                                             response = json.loads(line)
                                             logger.info(f"[WS] Response from TCP server: {response}")
+                                            if tracing.SPANS_KEY in response:
+                                                tracing.RECORDER.add(response.pop(tracing.SPANS_KEY))
                                             
                                             # Forward to client
                                             await websocket.send(json.dumps(response))
@@ -454,6 +526,7 @@ async def handle_websocket(websocket, path):
                             except Exception as e:
                                 logger.error(f"[WS] Error receiving TCP response: {e}")
                         except Exception as e:
+                            BRIDGE_FORWARD_ERRORS.labels("to_tcp_server").inc()
                             logger.error(f"[WS] Error sending to TCP server: {e}")
                             await websocket.send(json.dumps({
                                 "type": "error",
@@ -470,6 +543,7 @@ async def handle_websocket(websocket, path):
                         }))
                 
             except json.JSONDecodeError:
+                BRIDGE_PARSE_ERRORS.labels("frontend").inc()
                 logger.error(f"[WS] Dữ liệu không hợp lệ từ client {client_id}: {message_text}")
                 await websocket.send(json.dumps({
                     "type": "error",
@@ -494,8 +568,10 @@ async def handle_websocket(websocket, path):
     except Exception as e:
         logger.error(f"[WS] Lỗi xử lý WebSocket connection: {e}")
     finally:
+        client_keepalive.remove(client_id)
         if client_id in clients:
             del clients[client_id]
+        BRIDGE_CLIENTS.set(len(clients))
 
 # Cải tiến hàm send_tcp_command_async
 async def send_tcp_command_async(message):
@@ -520,32 +596,30 @@ async def send_tcp_command_async(message):
         logger.error(f"Lỗi gửi tin nhắn đến TCP server sau {elapsed:.4f} giây: {e}")
         raise e
 
+def bridge_heartbeat(group=None):
+    """Tin nhắn heartbeat với robot_id mặc định"""
+    return {
+        "type": "heartbeat",
+        "robot_id": "websocket_bridge",  # Thêm robot_id
+        "source": "ws_bridge",           # Thêm source để dễ phân biệt
+        "timestamp": time.time()
+    }
+
+# Heartbeat đến các clients qua timer wheel chung: mỗi client đến hạn theo thời điểm kết nối của nó,
+# không còn gửi lần lượt cho tất cả trong một vòng lặp; client gửi lỗi bị đóng và bỏ khỏi wheel
+client_keepalive = Keepalive("ws_bridge", bridge_heartbeat, interval=30)
+
 async def send_heartbeat():
     """
     Gửi tin nhắn heartbeat định kỳ đến TCP server để duy trì kết nối
     """
+    loop = asyncio.get_running_loop()
     while True:
         try:
             if ensure_tcp_connection():
-                # Tạo tin nhắn heartbeat với robot_id mặc định
-                heartbeat = {
-                    "type": "heartbeat",
-                    "robot_id": "websocket_bridge",  # Thêm robot_id
-                    "source": "ws_bridge",           # Thêm source để dễ phân biệt
-                    "timestamp": time.time()
-                }
-                
-                # Gửi đến TCP server
-                tcp_client.send_command(heartbeat)
-                
-                # Gửi đến tất cả các clients đang kết nối
-                for client_id, websocket in clients.items():
-                    try:
-                        await websocket.send(json.dumps(heartbeat))
-                    except Exception as e:
-                        logger.error(f"Lỗi gửi heartbeat đến client {client_id}: {e}")
-                
-                logger.debug(f"Đã gửi heartbeat đến TCP server và clients")
+                # Gửi đến TCP server (socket đồng bộ, chạy trong executor để không chặn event loop)
+                await loop.run_in_executor(None, tcp_client.send_command, bridge_heartbeat())
+                logger.debug(f"Đã gửi heartbeat đến TCP server")
             
             # Đợi cho đến lần gửi tiếp theo
             await asyncio.sleep(30)  # Gửi heartbeat mỗi 30 giây
@@ -668,12 +742,8 @@ async def handle_tcp_messages():
                     await asyncio.sleep(1)
                     continue
                     
-                # Add to buffer and process
-                tcp_client.buffer += data.decode('utf-8')
-                
                 # Process complete messages
-                while '\n' in tcp_client.buffer:
-                    message, tcp_client.buffer = tcp_client.buffer.split('\n', 1)
+                for message in tcp_client.framer.lines(data):
                     if not message.strip():
                         continue
                         
@@ -731,27 +801,29 @@ async def tcp_listener():
                 tcp_client.socket.settimeout(0.1)
                 data = tcp_client.socket.recv(4096)
                 if data:
-                    # Add to buffer
-                    tcp_client.buffer += data.decode("utf-8")
-                    
                     # Process complete messages
-                    while "\n" in tcp_client.buffer:
-                        message, tcp_client.buffer = tcp_client.buffer.split("\n", 1)
+                    for message in tcp_client.framer.lines(data):
                         if not message.strip():
                             continue
                             
+                        BRIDGE_RECEIVED.labels("tcp_socket").inc()
                         try:
                             data = json.loads(message)
                             logger.info(f"[TCP] Received: {data.get('type')}")
+                            if tracing.SPANS_KEY in data:
+                                tracing.RECORDER.add(data.pop(tracing.SPANS_KEY))
                             
                             # Forward to all clients
-                            for client_id, client in clients.items():
+                            for client_id, client in list(clients.items()):
                                 try:
                                     await client.send(json.dumps(data))
+                                    BRIDGE_FORWARDED.labels("to_client").inc()
                                     logger.info(f"[TCP] Forwarded to client {client_id}")
                                 except Exception as e:
+                                    BRIDGE_FORWARD_ERRORS.labels("to_client").inc()
                                     logger.error(f"[TCP] Error forwarding to client {client_id}: {e}")
                         except json.JSONDecodeError:
+                            BRIDGE_PARSE_ERRORS.labels("tcp_socket").inc()
                             logger.error(f"[TCP] Invalid JSON: {message}")
                         except Exception as e:
                             logger.error(f"[TCP] Processing error: {e}")
@@ -776,6 +848,11 @@ async def tcp_listener():
 # Main function
 async def main():
     """Start WebSocket Bridge and TCP listener"""
+    # Endpoint /metrics (và /traces, /stats/loop)
+    await metrics.serve_metrics(port=WS_BRIDGE_METRICS_PORT)
+    loop_monitor.start_monitor()
+    profiler.install_signal_handler("ws_tcp_bridge")
+    
     # Start TCP listener
     asyncio.create_task(tcp_listener())
     
@@ -1,11 +1,16 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, APIRouter
 from typing import Dict, List, Any
+import os
+import sys
 import json
 import asyncio
 import time
 from pydantic import BaseModel
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "back"))
+from timer_wheel import Keepalive
+
 # Thiết lập logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -277,8 +282,8 @@ async def handle_websocket(websocket: WebSocket, endpoint_name: str):
     
     logger.info(f"New connection on /ws/{endpoint_name}: {connection.client_id}")
     
-    # Bắt đầu task heartbeat
-    heartbeat_task = asyncio.create_task(send_heartbeat(websocket, connection))
+    # Heartbeat qua timer wheel chung thay vì một task mỗi kết nối
+    keepalive.add(connection.client_id, lambda text: send_counted(websocket, text))
     
     try:
         # Vòng lặp xử lý tin nhắn chính
@@ -306,32 +311,22 @@ async def handle_websocket(websocket: WebSocket, endpoint_name: str):
                 conn for conn in ws_connections[endpoint_name] 
                 if conn.client_id != connection.client_id
             ]
-        
-        # Huỷ task heartbeat
-        heartbeat_task.cancel()
     
     except Exception as e:
         logger.error(f"WebSocket error on /ws/{endpoint_name}: {str(e)}")
-        heartbeat_task.cancel()
+    
+    finally:
+        # Ngừng heartbeat
+        keepalive.remove(connection.client_id)
 
 
-# Heartbeat để giữ kết nối
-async def send_heartbeat(ws: WebSocket, connection: WebSocketConnection, interval: int = 30):
-    """Gửi tin nhắn heartbeat định kỳ để giữ kết nối"""
-    try:
-        while True:
-            await asyncio.sleep(interval)
-            await ws.send_text(json.dumps({
-                "type": "ping",
-                "timestamp": time.time()
-            }))
-            connection_stats["messages_sent"] += 1
-            
-            # Kiểm tra kết nối không hoạt động
-            if time.time() - connection.last_activity > interval * 2:
-                logger.warning(f"Connection {connection.client_id} inactive for too long")
-    
-    except asyncio.CancelledError:
-        logger.debug(f"Heartbeat task cancelled for {connection.client_id}")
-    except Exception as e:
-        logger.error(f"Error in heartbeat: {str(e)}")
\ No newline at end of file
+# Heartbeat để giữ kết nối: ping mỗi 30 giây, kết nối gửi ping lỗi bị bỏ khỏi wheel
+keepalive = Keepalive("ws_test", lambda group: {
+    "type": "ping",
+    "timestamp": time.time()
+}, interval=30)
+
+
+async def send_counted(ws: WebSocket, text: str):
+    await ws.send_text(text)
+    connection_stats["messages_sent"] += 1
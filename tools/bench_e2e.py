@@ -0,0 +1,383 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import datetime
+import tempfile
+import subprocess
+import urllib.request
+
+import numpy as np
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACK = os.path.join(ROOT, "back")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+
+TCP_PORT = 9000
+BRIDGE_PORT = 9003
+API_PORT = 8000
+
+# Hops measured from the "ts" stamps added by tcp_server and ws_tcp_bridge
+HOPS = ["robot->tcp_server", "tcp_server->bridge", "bridge->frontend", "end_to_end"]
+
+
+# === PROCESS MANAGEMENT ===
+
+def port_open(port, host="localhost"):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(0.2)
+        return s.connect_ex((host, port)) == 0
+
+
+def wait_for_port(port, timeout, proc=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if port_open(port):
+            return True
+        if proc is not None and proc.poll() is not None:
+            return False
+        time.sleep(0.1)
+    return False
+
+
+def start_services(workdir, with_api, mode="split"):
+    """Start ws_tcp_bridge + tcp_server (split) or gateway.py (gateway), and optionally the FastAPI app"""
+    env = dict(os.environ, LOG_LEVEL="WARNING", LOG_HEARTBEATS="0", LOG_DETAILED_MESSAGES="0",
+               PYTHONPATH=BACK, JOURNAL_DIR=os.path.join(workdir, "journal"))
+    log = open(os.path.join(workdir, "services.log"), "w")
+    procs = {}
+
+    for port in [BRIDGE_PORT, TCP_PORT] + ([API_PORT] if with_api else []):
+        if port_open(port):
+            raise RuntimeError(f"Port {port} is already in use, stop the running services first")
+
+    if mode == "gateway":
+        # Robot listener and frontend WebSocket in one process
+        procs["gateway"] = subprocess.Popen([sys.executable, os.path.join(BACK, "gateway.py")],
+                                            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if not (wait_for_port(BRIDGE_PORT, 15, procs["gateway"]) and wait_for_port(TCP_PORT, 15, procs["gateway"])):
+            raise RuntimeError("gateway did not start, see services.log")
+    else:
+        # The bridge must be up before tcp_server, which connects to it once at start
+        procs["bridge"] = subprocess.Popen([sys.executable, os.path.join(BACK, "ws_tcp_bridge.py")],
+                                           cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if not wait_for_port(BRIDGE_PORT, 15, procs["bridge"]):
+            raise RuntimeError("ws_tcp_bridge did not start, see services.log")
+
+        # Import the module and run its asyncio server (handle_tcp_client)
+        procs["tcp_server"] = subprocess.Popen(
+            [sys.executable, "-c", "import asyncio, tcp_server; asyncio.run(tcp_server.start_server())"],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if not wait_for_port(TCP_PORT, 15, procs["tcp_server"]):
+            raise RuntimeError("tcp_server did not start, see services.log")
+
+    api_error = None
+    if with_api:
+        procs["api"] = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACK, "--port", str(API_PORT),
+             "--log-level", "warning"],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if not wait_for_port(API_PORT, 20, procs["api"]):
+            api_error = "FastAPI app did not start (it needs the Postgres database), see services.log"
+            procs.pop("api").kill()
+
+    # Let tcp_server connect to the bridge
+    time.sleep(1.0)
+    return procs, api_error
+
+
+def cpu_seconds(procs):
+    """User + system CPU seconds of each service process (Linux /proc), None elsewhere"""
+    if not os.path.isdir("/proc"):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    usage = {}
+    for name, proc in procs.items():
+        try:
+            with open(f"/proc/{proc.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of stat, 12 and 13 after the ")"
+        usage[name] = (int(fields[11]) + int(fields[12])) / ticks
+    return usage
+
+
+def stop_services(procs):
+    for proc in procs.values():
+        proc.terminate()
+    for proc in procs.values():
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+# === SIMULATED FRONTENDS AND ROBOTS ===
+
+class LevelStats:
+    def __init__(self):
+        self.hops = {hop: [] for hop in HOPS}
+        self.ack_rtt = []
+        self.api_ws = []
+        self.api_http = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+
+async def frontend(uri, run_id, stats, stop):
+    """Browser stand-in connected to the bridge, records hop latencies of stamped messages"""
+    async with websockets.connect(uri, max_size=None) as ws:
+        while not stop.is_set():
+            try:
+                raw = await asyncio.wait_for(ws.recv(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            now = time.time()
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                continue
+            ts = data.get("ts")
+            if not isinstance(ts, dict) or ts.get("run") != run_id:
+                continue
+            stats.received += 1
+            if "tcp_server" in ts and "bridge" in ts:
+                stats.hops["robot->tcp_server"].append(ts["tcp_server"] - ts["origin"])
+                stats.hops["tcp_server->bridge"].append(ts["bridge"] - ts["tcp_server"])
+                stats.hops["bridge->frontend"].append(now - ts["bridge"])
+            stats.hops["end_to_end"].append(now - ts["origin"])
+
+
+async def robot(index, run_id, rate, duration, stats):
+    robot_id = f"bench{index}"
+    reader, writer = await asyncio.open_connection("localhost", TCP_PORT)
+    await reader.readline()  # welcome
+    writer.write((json.dumps({"type": "registration", "robot_id": robot_id}) + "\n").encode())
+    await writer.drain()
+    await reader.readline()
+
+    pending = []
+
+    async def read_acks():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if pending:
+                stats.ack_rtt.append(time.perf_counter() - pending.pop(0))
+            if b'"error"' in line:
+                stats.errors += 1
+
+    acks = asyncio.create_task(read_acks())
+    interval = 1.0 / rate
+    next_send = time.perf_counter() + (index % 10) * interval / 10
+    stop_at = time.perf_counter() + duration
+    seq = 0
+    while next_send < stop_at:
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = {"type": "encoder", "robot_id": robot_id, "id": robot_id, "data": [10.0, -10.0, 0.0],
+                   "seq": seq, "ts": {"run": run_id, "origin": time.time()}}
+        pending.append(time.perf_counter())
+        writer.write((json.dumps(message) + "\n").encode())
+        await writer.drain()
+        stats.sent += 1
+        seq += 1
+        next_send += interval
+    await asyncio.sleep(0.5)
+    acks.cancel()
+    writer.close()
+
+
+async def api_client(index, rate, duration, stats):
+    """FastAPI hop: WebSocket ping/pong (one way = RTT / 2) and HTTP health check"""
+    interval = 1.0 / rate
+    stop_at = time.perf_counter() + duration
+    async with websockets.connect(f"ws://localhost:{API_PORT}/ws/robot{index % 4 + 1}", max_size=None) as ws:
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            await ws.send(json.dumps({"type": "ping", "timestamp": time.time()}))
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply.get("type") == "pong":
+                    break
+            stats.api_ws.append((time.perf_counter() - start) / 2)
+
+            start = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: urllib.request.urlopen(f"http://localhost:{API_PORT}/api/health-check", timeout=5).read())
+            stats.api_http.append(time.perf_counter() - start)
+            await asyncio.sleep(max(0.0, interval - (time.perf_counter() - start)))
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ms = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3),
+            "count": len(values)}
+
+
+async def run_level(robots, rate, duration, frontends, api_clients, procs=None, mode="split"):
+    run_id = f"{time.time():.6f}"
+    stats = LevelStats()
+    stop = asyncio.Event()
+    fronts = [asyncio.create_task(frontend(f"ws://localhost:{BRIDGE_PORT}/", run_id, stats, stop))
+              for _ in range(frontends)]
+    await asyncio.sleep(0.5)
+
+    tasks = [robot(i, run_id, rate, duration, stats) for i in range(robots)]
+    tasks += [api_client(i, rate, duration, stats) for i in range(api_clients)]
+    cpu_before = cpu_seconds(procs or {})
+    start = time.perf_counter()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    stats.errors += sum(1 for r in results if isinstance(r, Exception))
+
+    await asyncio.sleep(1.0)
+    stop.set()
+    await asyncio.gather(*fronts, return_exceptions=True)
+    cpu_after = cpu_seconds(procs or {})
+
+    expected = stats.sent * frontends
+    level = {
+        "mode": mode,
+        "robots": robots, "rate_per_robot": rate, "frontends": frontends,
+        "sent": stats.sent, "delivered": stats.received,
+        "delivery_ratio": round(stats.received / expected, 4) if expected else 0.0,
+        "sent_per_second": round(stats.sent / elapsed, 1),
+        "delivered_per_second": round(stats.received / elapsed, 1),
+        "errors": stats.errors,
+        "latency_ms": {hop: percentiles(values) for hop, values in stats.hops.items()},
+        "robot_ack_rtt_ms": percentiles(stats.ack_rtt),
+    }
+    if cpu_before is not None and cpu_after is not None:
+        # CPU of the robot -> frontend path only (the FastAPI app is measured separately)
+        cpu = {name: round(cpu_after[name] - cpu_before[name], 3) for name in cpu_after if name in cpu_before}
+        level["cpu_seconds"] = cpu
+        path_cpu = sum(v for name, v in cpu.items() if name != "api")
+        level["cpu_ms_per_1k_messages"] = round(path_cpu / stats.sent * 1e6, 2) if stats.sent else None
+    if api_clients:
+        level["latency_ms"]["frontend->fastapi (ws, rtt/2)"] = percentiles(stats.api_ws)
+        level["latency_ms"]["frontend->fastapi (http)"] = percentiles(stats.api_http)
+    return level
+
+
+# === REPORTING ===
+
+def latest_result(exclude=None):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(f for f in os.listdir(RESULTS_DIR) if f.startswith("e2e_") and f.endswith(".json"))
+    files = [f for f in files if os.path.join(RESULTS_DIR, f) != exclude]
+    return os.path.join(RESULTS_DIR, files[-1]) if files else None
+
+
+def print_report(report, previous=None):
+    prev_levels = {}
+    if previous:
+        prev_levels = {(l.get("mode", "split"), l["robots"], l["rate_per_robot"]): l for l in previous["levels"]}
+        print(f"Compared with {previous['timestamp']}")
+
+    for level in report["levels"]:
+        mode = level.get("mode", "split")
+        print(f"\n[{mode}] {level['robots']} robots x {level['rate_per_robot']} msg/s: "
+              f"{level['delivered_per_second']} delivered/s, ratio {level['delivery_ratio']}, errors {level['errors']}")
+        if level.get("cpu_seconds"):
+            print(f"  cpu {level['cpu_seconds']} -> {level['cpu_ms_per_1k_messages']} ms per 1000 messages")
+        print(f"  {'hop':<32}{'p50':>9}{'p95':>9}{'p99':>9}{'Δp99':>10}")
+        prev = prev_levels.get((mode, level["robots"], level["rate_per_robot"]))
+        for hop, values in level["latency_ms"].items():
+            if not values:
+                print(f"  {hop:<32}{'-':>9}{'-':>9}{'-':>9}")
+                continue
+            delta = ""
+            if prev and prev["latency_ms"].get(hop):
+                delta = f"{values['p99'] - prev['latency_ms'][hop]['p99']:+.2f}"
+            print(f"  {hop:<32}{values['p50']:>9.2f}{values['p95']:>9.2f}{values['p99']:>9.2f}{delta:>10}")
+
+
+def print_mode_comparison(levels):
+    """split vs gateway side by side: what the bridge hop costs"""
+    by_key = {(l["mode"], l["robots"]): l for l in levels}
+    print(f"\n{'robots':>7}{'end_to_end p50':>26}{'end_to_end p99':>26}{'cpu ms / 1k msgs':>26}")
+    print(f"{'':>7}" + f"{'split':>13}{'gateway':>13}" * 3)
+    for robots in sorted({l["robots"] for l in levels}):
+        split, gateway = by_key.get(("split", robots)), by_key.get(("gateway", robots))
+        if not split or not gateway:
+            continue
+        row = f"{robots:>7}"
+        for pct in ("p50", "p99"):
+            a, b = split["latency_ms"]["end_to_end"], gateway["latency_ms"]["end_to_end"]
+            row += f"{a[pct] if a else float('nan'):>13.2f}{b[pct] if b else float('nan'):>13.2f}"
+        row += f"{split.get('cpu_ms_per_1k_messages') or float('nan'):>13.2f}"
+        row += f"{gateway.get('cpu_ms_per_1k_messages') or float('nan'):>13.2f}"
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end latency benchmark: robot -> tcp_server -> ws_tcp_bridge -> frontend')
+    parser.add_argument('--levels', default='10,50,200', help='Robot counts to run, comma separated (default: 10,50,200)')
+    parser.add_argument('--rate', type=float, default=20.0, help='Messages per second per robot (default: 20)')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per level (default: 10)')
+    parser.add_argument('--frontends', type=int, default=2, help='Simulated browser connections (default: 2)')
+    parser.add_argument('--api-clients', type=int, default=4, help='FastAPI ping clients, 0 to skip FastAPI (default: 4)')
+    parser.add_argument('--compare', help='Result file to compare with (default: latest in tools/bench_results)')
+    parser.add_argument('--no-save', action='store_true', help='Do not store the result')
+    parser.add_argument('--mode', choices=['split', 'gateway', 'both'], default='split',
+                        help='tcp_server + ws_tcp_bridge, the single-process gateway, or both in turn (default: split)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    levels = []
+    api_clients = 0
+    api_error = None
+    for mode in (["split", "gateway"] if args.mode == "both" else [args.mode]):
+        procs, api_error = start_services(workdir, args.api_clients > 0, mode)
+        try:
+            api_clients = args.api_clients if "api" in procs else 0
+            for robots in [int(n) for n in args.levels.split(",")]:
+                print(f"Running [{mode}] {robots} robots x {args.rate} msg/s for {args.duration}s ...")
+                levels.append(asyncio.run(run_level(robots, args.rate, args.duration, args.frontends, api_clients,
+                                                    procs, mode)))
+        finally:
+            stop_services(procs)
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "host": socket.gethostname(),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "fastapi": "ok" if api_clients else (api_error or "skipped"),
+        "levels": levels,
+    }
+
+    previous_path = args.compare or latest_result()
+    previous = None
+    if previous_path and os.path.exists(previous_path):
+        with open(previous_path) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.mode == "both":
+        print_mode_comparison(levels)
+    if api_error:
+        print(f"\n⚠️  {api_error}")
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"e2e_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to {path} (services log: {workdir}/services.log)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import json
+import time
+import asyncio
+import argparse
+import urllib.request
+from collections import deque
+
+import numpy as np
+
+# What a flooding robot does to everyone else (back/ingest_guard.py).
+# Needs tcp_server (9000) running.
+#
+# --robots well-behaved robots send encoder messages at --rate per second and
+# measure the latency of their acks; --flooders robots write encoder and
+# heartbeat lines as fast as the socket takes them. The report shows the ack
+# latency of the well-behaved robots, how much each flooder got through, and
+# the shed/pause counts from /ingest. Run once with the default
+# INGEST_MAX_RATE and once with INGEST_MAX_RATE=0 (no limit) to compare.
+
+
+async def connect(args, robot_id):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    await reader.readline()  # welcome
+    writer.write((json.dumps({"type": "registration", "robot_id": robot_id}) + "\n").encode())
+    await writer.drain()
+    await reader.readline()  # registration_confirmation
+    return reader, writer
+
+
+async def well_behaved(args, index, latencies, stop_at):
+    reader, writer = await connect(args, f"calm{index}")
+    sent = deque()
+
+    async def read_acks():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if sent:
+                latencies.append(time.perf_counter() - sent.popleft())
+
+    acks = asyncio.create_task(read_acks())
+    line = (json.dumps({"type": "encoder", "robot_id": f"calm{index}", "data": [1.0, 2.0, 3.0]}) + "\n").encode()
+    interval = 1.0 / args.rate
+    next_at = time.perf_counter() + interval * index / args.robots
+    while time.perf_counter() < stop_at:
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        next_at += interval
+        sent.append(time.perf_counter())
+        writer.write(line)
+        await writer.drain()
+    await asyncio.sleep(1.0)
+    acks.cancel()
+    writer.close()
+
+
+async def flooder(args, index, counts, stop_at):
+    robot_id = f"flood{index}"
+    reader, writer = await connect(args, robot_id)
+    encoder = (json.dumps({"type": "encoder", "robot_id": robot_id, "data": [1.0, 2.0, 3.0]}) + "\n").encode()
+    heartbeat = (json.dumps({"type": "heartbeat", "robot_id": robot_id}) + "\n").encode()
+    chunk = (encoder * 9 + heartbeat) * 20
+    counts[robot_id] = {"sent": 0, "acked": 0, "shed": 0}
+
+    async def read_acks():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            counts[robot_id]["acked"] += 1
+            if b'"shed"' in line:
+                counts[robot_id]["shed"] += 1
+
+    acks = asyncio.create_task(read_acks())
+    while time.perf_counter() < stop_at:
+        writer.write(chunk)
+        counts[robot_id]["sent"] += 200
+        await writer.drain()
+    await asyncio.sleep(1.0)
+    acks.cancel()
+    writer.close()
+
+
+def ingest_stats(url):
+    try:
+        return json.loads(urllib.request.urlopen(url, timeout=2).read())
+    except OSError:
+        return {}
+
+
+async def run(args):
+    stop_at = time.perf_counter() + args.duration
+    latencies, counts = [], {}
+    tasks = [asyncio.create_task(well_behaved(args, i, latencies, stop_at)) for i in range(args.robots)]
+    tasks += [asyncio.create_task(flooder(args, i, counts, stop_at)) for i in range(args.flooders)]
+    await asyncio.gather(*tasks)
+
+    expected = args.robots * args.rate * args.duration
+    print(f"well-behaved robots:  {args.robots} x {args.rate}/s, acks {len(latencies)}/{expected:.0f}")
+    if latencies:
+        p50, p99, p999 = np.percentile(np.asarray(latencies) * 1000, [50, 99, 99.9])
+        print(f"  ack latency ms:     p50 {p50:.1f}  p99 {p99:.1f}  p99.9 {p999:.1f}  max {max(latencies) * 1000:.1f}")
+    for robot_id, count in counts.items():
+        print(f"{robot_id}: sent {count['sent'] / args.duration:.0f}/s, acked {count['acked'] / args.duration:.0f}/s"
+              f" (shed {count['shed']})")
+    stats = ingest_stats(f"http://{args.host}:{args.metrics_port}/ingest")
+    if stats:
+        print(f"\n/ingest: overload episodes {stats['episodes']}")
+        for robot in list(stats["robots"].values()) + stats["closed"]:
+            print(f"  {robot['robot_id'] or robot['connection']:<10} shed {robot['shed']}  paused {robot['paused_seconds']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ack latency of well-behaved robots next to flooding robots')
+    parser.add_argument('--host', default='localhost', help='Server host (default: localhost)')
+    parser.add_argument('--port', type=int, default=9000, help='TCP server port (default: 9000)')
+    parser.add_argument('--metrics-port', type=int, default=9100, help='tcp_server metrics port (default: 9100)')
+    parser.add_argument('--robots', type=int, default=50, help='Well-behaved robots (default: 50)')
+    parser.add_argument('--rate', type=float, default=20, help='Messages per second per well-behaved robot (default: 20)')
+    parser.add_argument('--flooders', type=int, default=2, help='Robots sending as fast as they can (default: 2)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds (default: 10)')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
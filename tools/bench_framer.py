@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+# Add back/ to path to import the line framer
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "back"))
+from line_framer import LineFramer
+
+
+# --- Legacy reference implementation (str buffer + split per line) ---
+
+def legacy_frames(chunks):
+    """What every reader did before line_framer: decode each read, split one line at a time"""
+    lines = []
+    buffer = ""
+    for data in chunks:
+        buffer += data.decode("utf-8")
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            lines.append(line)
+    return lines
+
+
+def framer_lines(chunks):
+    """LineFramer.lines(): complete lines of each read decoded in one call"""
+    lines = []
+    framer = LineFramer(max_frame=1 << 30)
+    for data in chunks:
+        lines.extend(framer.lines(data))
+    return lines
+
+
+def framer_frames(chunks):
+    """LineFramer.feed(): memoryview frames, each decoded by the caller"""
+    lines = []
+    framer = LineFramer(max_frame=1 << 30)
+    for data in chunks:
+        for frame in framer.feed(data):
+            lines.append(str(frame, "utf-8"))
+    return lines
+
+
+# --- Workloads ---
+
+def split(stream, size):
+    """Reads of `size` bytes; size 0 = one read per line"""
+    if not size:
+        return stream.splitlines(keepends=True)
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def telemetry_stream(messages):
+    """Encoder lines as robots send them, many per 4096-byte read"""
+    lines = [json.dumps({"type": "encoder", "robot_id": f"robot{i % 50}", "timestamp": 1.7e9 + i,
+                         "data": {"rpm": [i % 120, -(i % 90), i % 60]}}) for i in range(messages)]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def large_stream(size):
+    """One large message (trajectory dump) followed by a short one"""
+    points = [[round(i * 0.001, 3), round(-i * 0.002, 3), round(i * 0.0005, 4)] for i in range(size // 24)]
+    return (json.dumps({"type": "trajectory", "points": points}) + "\n" + '{"type":"ping"}\n').encode("utf-8")
+
+
+def timeit(fn, chunks, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(name, stream, chunk, repeat):
+    chunks = split(stream, chunk)
+    expected = legacy_frames(chunks)
+    assert framer_lines(chunks) == expected and framer_frames(chunks) == expected
+    legacy = timeit(legacy_frames, chunks, repeat)
+    lines = timeit(framer_lines, chunks, repeat)
+    frames = timeit(framer_frames, chunks, repeat)
+    print(f"{name:<34} {len(stream) / 1024:>9.0f} KiB {chunk:>6} B {len(expected):>7} "
+          f"{legacy * 1000:>10.2f} {lines * 1000:>10.2f} {frames * 1000:>10.2f} {legacy / lines:>7.1f}x")
+
+
+def check_multibyte():
+    """A UTF-8 character cut between two reads breaks the legacy reader"""
+    line = json.dumps({"type": "log", "message": "Động cơ quá nhiệt"}, ensure_ascii=False) + "\n"
+    chunks = split(line.encode("utf-8"), 1)
+    try:
+        legacy = "ok" if legacy_frames(chunks) == [line[:-1]] else "wrong frames"
+    except UnicodeDecodeError:
+        legacy = "UnicodeDecodeError"
+    framer = "ok" if framer_lines(chunks) == framer_frames(chunks) == [line[:-1]] else "wrong frames"
+    print(f"\nMultibyte character split across reads: legacy {legacy}, LineFramer {framer}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Line framing: str split per line vs back/line_framer.LineFramer')
+    parser.add_argument('--messages', type=int, default=20000, help='Telemetry lines (default: 20000)')
+    parser.add_argument('--large-kib', type=int, default=1024, help='Size of the large message in KiB (default: 1024)')
+    parser.add_argument('--repeat', type=int, default=5, help='Best of N runs (default: 5)')
+    args = parser.parse_args()
+
+    print(f"{'workload':<34} {'stream':>13} {'read':>8} {'lines':>7} {'legacy ms':>10} {'lines() ms':>10} {'feed() ms':>10} {'speedup':>8}")
+    telemetry = telemetry_stream(args.messages)
+    run("telemetry, batched reads", telemetry, 4096, args.repeat)
+    run("telemetry, one read per line", telemetry, 0, args.repeat)
+    run("telemetry, 64-byte reads", telemetry, 64, args.repeat)
+    large = large_stream(args.large_kib * 1024)
+    run("large message, 4096-byte reads", large, 4096, max(1, args.repeat // 2))
+    run("large message, 1024-byte reads", large, 1024, max(1, args.repeat // 2))
+    check_multibyte()
+
+
+if __name__ == "__main__":
+    main()
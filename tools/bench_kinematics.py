@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import argparse
+import math
+import numpy as np
+
+# Add back/ to path to import the kinematics module
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "back"))
+import kinematics
+
+WHEEL_RADIUS = 0.03
+ROBOT_RADIUS = 0.153
+DT = 0.05
+
+# --- Legacy reference implementations (per-sample H(theta) + inversion) ---
+
+def legacy_matrix(theta):
+    return np.array([
+        [-np.sin(theta), np.cos(theta), ROBOT_RADIUS],
+        [-np.sin(np.pi/3 - theta), -np.cos(np.pi/3 - theta), ROBOT_RADIUS],
+        [np.sin(np.pi/3 + theta), -np.cos(np.pi/3 + theta), ROBOT_RADIUS]
+    ])
+
+def legacy_velocity_pinv(theta, rpm_values):
+    """robot_database.TrajectoryCalculator.compute_velocity before unification"""
+    omega_wheel = [rpm * (2 * np.pi / 60) for rpm in rpm_values]
+    omega_scaled = np.array(omega_wheel) * WHEEL_RADIUS
+    return tuple(np.linalg.pinv(legacy_matrix(theta)).dot(omega_scaled))
+
+def legacy_velocity_solve(theta, rpm_values):
+    """database.TrajectoryCalculator.compute_velocity before unification"""
+    omega_wheel = [rpm * (2 * np.pi / 60) for rpm in rpm_values]
+    omega_scaled = np.array(omega_wheel) * WHEEL_RADIUS
+    v = np.linalg.solve(legacy_matrix(theta), omega_scaled)
+    return v[0], v[1], v[2]
+
+def legacy_trajectory(rpm_data, velocity_fn=legacy_velocity_solve, initial_position=(0, 0, 0)):
+    """database.TrajectoryCalculator.rpm_to_trajectory before unification"""
+    x, y, theta = initial_position
+    x_hist, y_hist, theta_hist = [x], [y], [theta]
+    for rpm in rpm_data:
+        v_x, v_y, omega = velocity_fn(theta, rpm)
+        x += v_x * DT
+        y += v_y * DT
+        theta += omega * DT
+        theta = math.atan2(math.sin(theta), math.cos(theta))
+        x_hist.append(x)
+        y_hist.append(y)
+        theta_hist.append(theta)
+    return {'x': x_hist, 'y': y_hist, 'theta': theta_hist}
+
+# --- Benchmark ---
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def stream(kin, rpm):
+    integrator = kin.integrator()
+    for r in rpm:
+        integrator.update(r, DT)
+
+def cached_inverse_matvec(kin, theta, rpm):
+    """Cached H0^-1 applied with a numpy mat-vec (array allocated per sample)"""
+    u = kin.inv_rpm.dot(np.asarray(rpm, dtype=float))
+    c = math.cos(theta)
+    s = math.sin(theta)
+    return (c * u[0] - s * u[1], s * u[0] + c * u[1], u[2])
+
+def run_micro(samples, repeat):
+    """Per-sample cost of the velocity computation alone"""
+    rng = np.random.default_rng(7)
+    rpm = rng.uniform(-120, 120, size=(samples, 3))
+    thetas = rng.uniform(-np.pi, np.pi, size=samples)
+    rpm_rows = rpm.tolist()
+    theta_list = thetas.tolist()
+    kin = kinematics.for_robot()
+    out = np.empty_like(rpm)
+
+    results = [
+        ("before: pinv(H(theta))", timeit(lambda: [legacy_velocity_pinv(t, r) for t, r in zip(theta_list, rpm_rows)], repeat)),
+        ("before: solve(H(theta))", timeit(lambda: [legacy_velocity_solve(t, r) for t, r in zip(theta_list, rpm_rows)], repeat)),
+        ("cached H0^-1, numpy matvec", timeit(lambda: [cached_inverse_matvec(kin, t, r) for t, r in zip(theta_list, rpm_rows)], repeat)),
+        ("after: closed form scalar", timeit(lambda: [kin.velocity(t, r) for t, r in zip(theta_list, rpm_rows)], repeat)),
+        ("after: batched (N,3)", timeit(lambda: kin.velocities(thetas, rpm, out=out), repeat)),
+    ]
+
+    print(f"Velocity from RPM, {samples} samples (best of {repeat})")
+    print(f"{'implementation':<28}{'total (ms)':>12}{'per sample (us)':>18}{'speedup':>10}")
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print(f"{name:<28}{elapsed * 1e3:>12.2f}{elapsed / samples * 1e6:>18.3f}{baseline / elapsed:>9.1f}x")
+    print()
+
+def run_benchmark(samples, repeat):
+    rng = np.random.default_rng(42)
+    rpm = rng.uniform(-120, 120, size=(samples, 3))
+    kin = kinematics.for_robot()
+
+    results = [
+        ("legacy pinv loop", timeit(lambda: legacy_trajectory(rpm, legacy_velocity_pinv), repeat)),
+        ("legacy solve loop", timeit(lambda: legacy_trajectory(rpm, legacy_velocity_solve), repeat)),
+        ("streaming PoseIntegrator", timeit(lambda: stream(kin, rpm), repeat)),
+        ("batched integrate", timeit(lambda: kin.integrate(rpm, DT), repeat)),
+    ]
+
+    print(f"Trajectory integration, {samples} samples (best of {repeat})")
+    print(f"{'implementation':<28}{'total (ms)':>12}{'per sample (us)':>18}{'speedup':>10}")
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print(f"{name:<28}{elapsed * 1e3:>12.2f}{elapsed / samples * 1e6:>18.3f}{baseline / elapsed:>9.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark omni robot kinematics implementations')
+    parser.add_argument('--samples', type=int, default=20000, help='Number of RPM samples (default: 20000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions, best time is reported (default: 3)')
+    parser.add_argument('--micro', action='store_true', help='Only run the per-sample velocity microbenchmark')
+    args = parser.parse_args()
+    run_micro(args.samples, args.repeat)
+    if not args.micro:
+        run_benchmark(args.samples, args.repeat)
+
+if __name__ == "__main__":
+    main()
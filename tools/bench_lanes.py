@@ -0,0 +1,121 @@
+import json
+import time
+import asyncio
+import argparse
+import urllib.request
+
+import websockets
+
+# How long an emergency_stop waits behind other traffic to the same robot
+# (back/command_lanes.py). Needs tcp_server (9000) and ws_tcp_bridge (9003) running.
+#
+# A simulated robot registers, floods telemetry (one data_ack each) and stops
+# reading for --pause seconds, so everything sent to it piles up in the
+# server. The frontend then sends --commands motor_control commands followed
+# by one emergency_stop. When the robot reads again, the report shows how
+# many queued motor_control commands arrived before the stop and when.
+# motor_control is a setpoint, so most of them are coalesced by the server
+# (SETPOINT_MAX_RATE); --type sends a command that is never coalesced.
+
+
+async def robot(args, registered, received):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    await reader.readline()  # welcome
+    writer.write((json.dumps({"type": "registration", "robot_id": args.robot_id}) + "\n").encode())
+    await writer.drain()
+    await reader.readline()  # registration_confirmation
+    registered.set()
+
+    # Telemetry the server acks while the robot is not reading
+    line = (json.dumps({"type": "encoder", "robot_id": args.robot_id, "data": [1.0, 2.0, 3.0]}) + "\n").encode()
+    writer.write(line * args.telemetry)
+    await writer.drain()
+    await asyncio.sleep(args.pause)
+
+    resumed = time.perf_counter()
+    timeout = args.pause + 30
+    while True:
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if not line:
+            break
+        msg_type = json.loads(line).get("type")
+        if msg_type in ("emergency_stop", args.type):
+            received.append((msg_type, time.perf_counter() - resumed))
+            if msg_type == "emergency_stop" or len(received) == args.commands + 1:
+                timeout = 0.5  # whatever was queued before the stop has had time to arrive
+    writer.close()
+
+
+def lane_metrics(url):
+    """outbound_queue_seconds{lane} as {lane: (count, sum)}"""
+    try:
+        text = urllib.request.urlopen(url, timeout=2).read().decode()
+    except OSError:
+        return {}
+    lanes = {}
+    for line in text.splitlines():
+        if line.startswith("outbound_queue_seconds_count") or line.startswith("outbound_queue_seconds_sum"):
+            name, value = line.rsplit(" ", 1)
+            lane = name.split('lane="')[1].split('"')[0]
+            count, total = lanes.get(lane, (0, 0.0))
+            if name.startswith("outbound_queue_seconds_count"):
+                count = int(float(value))
+            else:
+                total = float(value)
+            lanes[lane] = (count, total)
+    return lanes
+
+
+async def run(args):
+    registered = asyncio.Event()
+    received = []
+    task = asyncio.create_task(robot(args, registered, received))
+    await registered.wait()
+
+    async with websockets.connect(f"ws://{args.host}:{args.bridge_port}") as ws:
+        await asyncio.sleep(0.2)  # telemetry reaches the server first
+        for i in range(args.commands):
+            await ws.send(json.dumps({"type": args.type, "robot_id": args.robot_id,
+                                      "speeds": [i % 100, 0, 0], "padding": "x" * args.padding}))
+        await ws.send(json.dumps({"type": "emergency_stop", "robot_id": args.robot_id}))
+        await task
+
+    stop = next((i for i, (msg_type, _) in enumerate(received) if msg_type == "emergency_stop"), None)
+    print(f"{args.type} sent before the stop:        {args.commands}")
+    print(f"{args.type} received in total:           {len(received) - (stop is not None)}")
+    if stop is None:
+        print("emergency_stop was not received")
+        return
+    print(f"{args.type} received before the stop:    {stop}")
+    print(f"stop received after resuming reads:       {received[stop][1] * 1000:.1f} ms")
+    print(f"last message received after:              {received[-1][1] * 1000:.1f} ms")
+    lanes = lane_metrics(f"http://{args.host}:{args.metrics_port}/metrics")
+    if lanes:
+        print("\ntcp_server outbound_queue_seconds (mean, includes the robot's pause):")
+        for lane, (count, total) in sorted(lanes.items()):
+            if count:
+                print(f"  {lane:<8} {count:>7} messages {total / count * 1000:>9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Delay of an emergency_stop queued behind control commands and acks')
+    parser.add_argument('--host', default='localhost', help='Server host (default: localhost)')
+    parser.add_argument('--port', type=int, default=9000, help='TCP server port (default: 9000)')
+    parser.add_argument('--bridge-port', type=int, default=9003, help='WebSocket bridge port (default: 9003)')
+    parser.add_argument('--metrics-port', type=int, default=9100, help='tcp_server metrics port (default: 9100)')
+    parser.add_argument('--robot-id', default='lanes1', help='Simulated robot ID (default: lanes1)')
+    parser.add_argument('--commands', type=int, default=2000, help='Commands before the stop (default: 2000)')
+    parser.add_argument('--type', default='motor_control',
+                        help='Type of those commands, e.g. update_pid for one that is never coalesced (default: motor_control)')
+    parser.add_argument('--telemetry', type=int, default=5000, help='Telemetry lines to be acked (default: 5000)')
+    parser.add_argument('--padding', type=int, default=200, help='Extra bytes per motor_control (default: 200)')
+    parser.add_argument('--pause', type=float, default=1.0, help='Seconds the robot stops reading (default: 1)')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import argparse
+from unittest import mock
+
+# Checks the COPY path of DataHandler.process_json_batch (back/sample_batch.py)
+# against the real database in robot_database.DATABASE_URL.
+#
+# The journal sink (telemetry_journal.store_json_batch) stores batches that mix
+# ORM rows (encoder, bno055, log, a robot created on first sight) with
+# encoder_batch / imu_batch frames loaded by COPY on the session's connection
+# after session.flush(). All of it must commit together, and nothing of a batch
+# may stay when it fails, whether Postgres rejects the COPY or the batch fails
+# after a COPY went through. Rows are written for robots named <prefix>-* and
+# deleted afterwards.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "back"))
+
+import bulk_import  # noqa: E402
+import sample_batch  # noqa: E402
+from telemetry_journal import store_json_batch  # noqa: E402
+from robot_database import engine, DATABASE_URL  # noqa: E402
+
+TABLES = ("encoder_data", "imu_data", "log_data")
+
+
+def query(sql, *params):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(sql, params).fetchall()
+
+
+def counts(robot_id):
+    out = {"robots": query("SELECT count(*) FROM robots WHERE robot_id = %s", robot_id)[0][0]}
+    for table in TABLES:
+        out[table] = query(f"SELECT count(*) FROM {table} WHERE robot_id = %s", robot_id)[0][0]
+    return out
+
+
+def cleanup(prefix):
+    with engine.begin() as conn:
+        for table in TABLES:
+            conn.exec_driver_sql(f"DELETE FROM {table} WHERE robot_id LIKE %s", (prefix + "-%",))
+        conn.exec_driver_sql("DELETE FROM robots WHERE robot_id LIKE %s", (prefix + "-%",))
+
+
+def store(robot_id, now):
+    messages = [
+        {"type": "encoder", "id": robot_id, "data": [1, 2, 3]},
+        {"type": "encoder_batch", "id": robot_id, "t0": now,
+         "samples": [[0.0, 1, 2, 3], [0.02, 4, 5, 6], "bad", [0.04, 7, 8, 9]]},
+        {"type": "imu_batch", "id": robot_id, "received_at": now,
+         "samples": [[0.0, 0.1, 0.2, 0.3], [0.01, 0.1, 0.2, 0.3, 1, 0, 0, 0]]},
+        {"type": "log", "id": robot_id, "message": "check_batch_copy"},
+    ]
+    store_json_batch(robot_id, [(now, json.dumps(m).encode()) for m in messages])
+
+
+def expect_failure(robot_id, now):
+    try:
+        store(robot_id, now)
+    except Exception as e:
+        return f"{type(e).__name__}: {str(e).splitlines()[0]}"
+    return None
+
+
+def run(prefix):
+    now = time.time()
+    committed = {"robots": 1, "encoder_data": 4, "imu_data": 2, "log_data": 1}
+    empty = dict.fromkeys(committed, 0)
+    results = []
+
+    store(f"{prefix}-commit", now)
+    results.append(("commit: new robot, ORM rows and COPY rows", counts(f"{prefix}-commit"), committed, None))
+
+    # Postgres rejects the COPY (raw_data is not valid JSON) after the ORM rows were flushed
+    with mock.patch.object(sample_batch, "header", lambda frame: "{not json"):
+        error = expect_failure(f"{prefix}-copyerror", now)
+    results.append(("rollback: COPY rejected", counts(f"{prefix}-copyerror"), empty, error))
+
+    # The first table's COPY succeeds, the batch fails before commit
+    flush = bulk_import.ColumnBatch.flush
+    copied = []
+
+    def flush_then_fail(self, cursor):
+        if self.rows and copied:
+            raise RuntimeError("failure after a successful COPY")
+        flush(self, cursor)
+        if self.copied:
+            copied.append(self.table)
+
+    with mock.patch.object(bulk_import.ColumnBatch, "flush", flush_then_fail):
+        error = expect_failure(f"{prefix}-aftercopy", now)
+    results.append(("rollback: failure after COPY", counts(f"{prefix}-aftercopy"), empty, error))
+
+    # A failed batch leaves no broken transaction behind
+    store(f"{prefix}-next", now)
+    results.append(("commit after the failures", counts(f"{prefix}-next"), committed, None))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check commit and rollback of COPY-loaded batch frames on Postgres')
+    parser.add_argument('--prefix', default='copycheck', help='Robot ID prefix of the test rows (default: copycheck)')
+    parser.add_argument('--keep', action='store_true', help='Keep the test rows')
+    args = parser.parse_args()
+
+    print(f"Database: {DATABASE_URL.rsplit('@', 1)[-1]}")
+    cleanup(args.prefix)
+    try:
+        results = run(args.prefix)
+    finally:
+        if not args.keep:
+            cleanup(args.prefix)
+
+    failed = 0
+    for name, got, expected, error in results:
+        ok = got == expected
+        failed += not ok
+        print(f"{'✅' if ok else '❌'} {name}: {got}" + (f"  ({error})" if error else ""))
+        if not ok:
+            print(f"   expected {expected}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
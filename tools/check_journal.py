@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+# Checks the on-disk telemetry journal (back/telemetry_journal.py) across
+# segment rotations, without a database.
+#
+# --records small records are appended for one robot into --segment-size byte
+# segments so that they span several segments. recent() must return every
+# record once, oldest first, and its limit must keep the newest ones; read()
+# from the start must return the same sequence batch by batch, and release()
+# must leave the newest segments readable.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "back"))
+
+from telemetry_journal import TelemetryJournal  # noqa: E402
+
+
+def indexes(records):
+    return [json.loads(payload)["i"] for _, payload in records]
+
+
+def run(directory, records, segment_size, batch):
+    journal = TelemetryJournal(directory, segment_size=segment_size)
+    for i in range(records):
+        journal.append("check", json.dumps({"i": i}).encode(), timestamp=float(i))
+    robot = journal.robot("check")
+    segments = robot.segment_seqs()
+    everything = list(range(records))
+    results = [("records span several segments", len(segments) > 1, f"{len(segments)} segments")]
+
+    got = indexes(journal.recent("check", records * 2))
+    results.append(("recent(): each record once, oldest first", got == everything, got))
+    got = indexes(journal.recent("check", 5))
+    results.append(("recent(5): the newest five", got == everything[-5:], got))
+
+    got, position = [], robot.load_cursor()
+    while True:
+        chunk, position = robot.read(*position, batch)
+        if not chunk:
+            break
+        got += indexes(chunk)
+    results.append((f"read() in batches of {batch}", got == everything, got))
+
+    robot.release(segments[-1], retain=0)
+    got = indexes(journal.recent("check", records * 2))
+    newest = indexes(robot.segment_records(segments[-1]))
+    results.append(("recent() after release(): the active segment only", got == newest and got == everything[-len(got):], got))
+    journal.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check journal reads across segment rotations')
+    parser.add_argument('--records', type=int, default=20, help='Records to append (default: 20)')
+    parser.add_argument('--segment-size', type=int, default=256, help='Segment size in bytes (default: 256)')
+    parser.add_argument('--batch', type=int, default=3, help='Records per read() (default: 3)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="journal_check_")
+    try:
+        results = run(directory, args.records, args.segment_size, args.batch)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    failed = 0
+    for name, ok, detail in results:
+        failed += not ok
+        print(f"{'✅' if ok else '❌'} {name}: {detail}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACK = os.path.join(ROOT, "back")
+
+BRIDGE_PORT = 9003
+# node -> (robot port, worker metrics base port, node metrics port)
+NODES = {"a": (9000, 9110, 9109), "b": (9010, 9120, 9119)}
+
+
+def port_open(port, host="localhost"):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(0.2)
+        return s.connect_ex((host, port)) == 0
+
+
+def wait_for_port(port, timeout, proc=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if port_open(port):
+            return True
+        if proc is not None and proc.poll() is not None:
+            return False
+        time.sleep(0.1)
+    return False
+
+
+def start_cluster(workdir, workers, lease_ttl):
+    """ws_tcp_bridge plus two ingest nodes linked over Unix domain sockets"""
+    for port in [BRIDGE_PORT] + [p for node in NODES.values() for p in node]:
+        if port_open(port):
+            raise RuntimeError(f"Port {port} is already in use, stop the running services first")
+    env = dict(os.environ, LOG_LEVEL="WARNING", PYTHONPATH=BACK, LEASE_TTL=str(lease_ttl))
+    log = open(os.path.join(workdir, "cluster.log"), "w")
+    procs = {"bridge": subprocess.Popen([sys.executable, os.path.join(BACK, "ws_tcp_bridge.py")],
+                                        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)}
+    if not wait_for_port(BRIDGE_PORT, 15, procs["bridge"]):
+        raise RuntimeError("ws_tcp_bridge did not start, see cluster.log")
+    for node, (port, worker_metrics, node_metrics) in NODES.items():
+        peers = ",".join(f"{other}=unix:{os.path.join(workdir, other + '.node')}" for other in NODES if other != node)
+        node_env = dict(env, JOURNAL_DIR=os.path.join(workdir, f"journal-{node}"),
+                        TCP_WORKER_METRICS_BASE_PORT=str(worker_metrics))
+        procs[node] = subprocess.Popen(
+            [sys.executable, os.path.join(BACK, "ingest_workers.py"), "--workers", str(workers), "--port", str(port),
+             "--node-id", node, "--bus", os.path.join(workdir, f"{node}.bus"),
+             "--listen", f"unix:{os.path.join(workdir, node + '.node')}", "--peers", peers,
+             "--metrics-port", str(node_metrics)],
+            cwd=workdir, env=node_env, stdout=log, stderr=subprocess.STDOUT)
+    for node, (port, _, _) in NODES.items():
+        if not wait_for_port(port, 20, procs[node]):
+            raise RuntimeError(f"Node {node} did not start, see cluster.log")
+    # Peer links and worker -> bridge connections
+    time.sleep(2.0)
+    return procs
+
+
+def stop(procs):
+    for proc in procs.values():
+        proc.terminate()
+    for proc in procs.values():
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def cluster_state(node):
+    with urllib.request.urlopen(f"http://localhost:{NODES[node][2]}/cluster", timeout=2) as response:
+        return json.loads(response.read())
+
+
+class Robot:
+    """Fake robot keeping the commands it receives"""
+
+    def __init__(self, robot_id, port):
+        self.robot_id = robot_id
+        self.port = port
+        self.commands = []
+        self.closed = asyncio.Event()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection("localhost", self.port)
+        await self.reader.readline()
+        self.writer.write((json.dumps({"type": "registration", "robot_id": self.robot_id}) + "\n").encode())
+        await self.writer.drain()
+        self.task = asyncio.create_task(self._read())
+        return self
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message.get("type") == "motor_control":
+                    self.commands.append(message)
+        except ConnectionError:
+            pass
+        self.closed.set()
+
+    def close(self):
+        self.writer.close()
+
+
+async def send_commands(robot_ids, settle=2.0):
+    """Send one motor_control per robot through the bridge; returns {robot_id: ack or error type}"""
+    replies = {}
+    async with websockets.connect(f"ws://localhost:{BRIDGE_PORT}") as ws:
+        for robot_id in robot_ids:
+            await ws.send(json.dumps({"type": "motor_control", "robot_id": robot_id, "speeds": [10, 10, 10]}))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settle
+        while loop.time() < deadline:
+            try:
+                message = json.loads(await asyncio.wait_for(ws.recv(), deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+            if message.get("robot_id") in robot_ids and message.get("type") in ("command_sent", "error"):
+                replies.setdefault(message["robot_id"], []).append(message.get("status") or message["type"])
+    return replies
+
+
+def check(ok, text):
+    print(("✅ " if ok else "❌ ") + text)
+    return ok
+
+
+async def scenario(robots_per_node, procs, lease_ttl):
+    results = []
+    robots = {}
+    for i in range(robots_per_node * len(NODES)):
+        node = list(NODES)[i % len(NODES)]
+        robots[f"robot{i}"] = await Robot(f"robot{i}", NODES[node][0]).connect()
+    await asyncio.sleep(1.0)
+
+    # 1. Every robot is reachable from the bridge, whichever node holds it
+    await send_commands(list(robots))
+    await asyncio.sleep(0.5)
+    missing = [r for r, robot in robots.items() if not robot.commands]
+    results.append(check(not missing, f"commands delivered to {len(robots) - len(missing)}/{len(robots)} robots on 2 nodes"
+                                      + (f", missing {missing}" if missing else "")))
+
+    # 2. The directory is sharded: both nodes hold leases and together hold every robot
+    states = {node: cluster_state(node) for node in NODES}
+    leases = {node: len(state["leases"]) for node, state in states.items()}
+    results.append(check(sum(leases.values()) == len(robots) and all(leases.values()),
+                         f"leases per directory shard {leases} for {len(robots)} robots"))
+
+    # 3. Takeover: robot1 (node b) reconnects to node a, the stale connection on b is closed
+    stale = robots["robot1"]
+    robots["robot1"] = await Robot("robot1", NODES["a"][0]).connect()
+    try:
+        await asyncio.wait_for(stale.closed.wait(), 5)
+        closed = True
+    except asyncio.TimeoutError:
+        closed = False
+    results.append(check(closed, "stale connection of a robot that moved to another node is revoked"))
+    await send_commands(["robot1"])
+    await asyncio.sleep(0.5)
+    results.append(check(bool(robots["robot1"].commands) and len(stale.commands) == 1,
+                         "command after the move goes to the new connection"))
+
+    # 4. Failover: node b dies, its robots are unreachable until they reconnect to node a
+    procs["b"].terminate()
+    procs["b"].wait(10)
+    orphaned = [r for r, robot in robots.items() if robot.port == NODES["b"][0]]
+    await asyncio.sleep(lease_ttl / 3 + 1.5)
+    state = cluster_state("a")
+    results.append(check(state["ring"] == ["a"], f"node a drops node b from the ring ({state['ring']})"))
+    for robot_id in orphaned:
+        robots[robot_id] = await Robot(robot_id, NODES["a"][0]).connect()
+    await asyncio.sleep(1.0)
+    for robot in robots.values():
+        robot.commands.clear()
+    await send_commands(list(robots))
+    await asyncio.sleep(0.5)
+    missing = [r for r, robot in robots.items() if not robot.commands]
+    results.append(check(not missing, f"after failover {len(robots) - len(missing)}/{len(robots)} robots reachable"))
+    for robot in robots.values():
+        robot.close()
+    return all(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check robot ownership across two local ingest nodes')
+    parser.add_argument('--robots', type=int, default=10, help='Robots per node (default: 10)')
+    parser.add_argument('--workers', type=int, default=2, help='Workers per node (default: 2)')
+    parser.add_argument('--lease-ttl', type=float, default=3.0, help='Lease TTL in seconds (default: 3)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="cluster_check_")
+    procs = start_cluster(workdir, args.workers, args.lease_ttl)
+    try:
+        ok = asyncio.run(scenario(args.robots, procs, args.lease_ttl))
+    finally:
+        stop(procs)
+    print(f"Logs in {workdir}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import sys
+import json
+import time
+import socket
+import struct
+import random
+import asyncio
+import argparse
+import datetime
+from collections import deque
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MESSAGE_TYPES = ("encoder", "imu", "log")
+# Datagram header of the UDP telemetry channel (back/udp_telemetry.py): magic, version, flags, seq, token
+UDP_HEADER = struct.Struct("!2sBBI16s")
+
+
+def parse_mix(text):
+    """'encoder=0.7,imu=0.25,log=0.05' -> ([types], [weights])"""
+    types, weights = [], []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in MESSAGE_TYPES:
+            raise argparse.ArgumentTypeError(f"Unknown message type '{name}' (choose from {', '.join(MESSAGE_TYPES)})")
+        types.append(name)
+        weights.append(float(weight or 1))
+    total = sum(weights)
+    return types, [w / total for w in weights]
+
+
+def make_batch(msg_type, robot_id, samples):
+    """encoder_batch / imu_batch frame (back/sample_batch.py) carrying `samples` readings 50 ms apart"""
+    if msg_type == "encoder":
+        rows = [[round(i * 0.05, 3)] + [round(random.uniform(-60, 60), 2) for _ in range(3)] for i in range(samples)]
+        data = {"type": "encoder_batch", "robot_id": robot_id, "id": robot_id, "samples": rows}
+    else:
+        rows = [[round(i * 0.05, 3), round(random.uniform(-180, 180), 2), round(random.uniform(-3, 3), 2),
+                 round(random.uniform(-3, 3), 2), 1.0, 0.0, 0.0, 0.0] for i in range(samples)]
+        data = {"type": "imu_batch", "robot_id": robot_id, "id": robot_id, "samples": rows}
+    data["t0"] = time.time() - rows[-1][0]
+    return (json.dumps(data) + "\n").encode()
+
+
+def make_message(msg_type, robot_id, seq, batch=1):
+    """Messages in the format sent by the ESP32 firmware"""
+    if batch > 1 and msg_type in ("encoder", "imu"):
+        return make_batch(msg_type, robot_id, batch)
+    if msg_type == "encoder":
+        data = {"type": "encoder", "robot_id": robot_id, "id": robot_id,
+                "data": [round(random.uniform(-60, 60), 2) for _ in range(3)]}
+    elif msg_type == "imu":
+        data = {"type": "bno055", "robot_id": robot_id, "id": robot_id,
+                "data": {"time": time.time(),
+                         "euler": [round(random.uniform(-180, 180), 2), round(random.uniform(-3, 3), 2),
+                                   round(random.uniform(-3, 3), 2)],
+                         "quaternion": [1.0, 0.0, 0.0, 0.0]}}
+    else:
+        data = {"type": "log", "robot_id": robot_id, "id": robot_id,
+                "message": f"I ({seq}) load: simulated log line"}
+    return (json.dumps(data) + "\n").encode()
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.connect_failures = 0
+        self.registered = 0
+        self.sent = {t: 0 for t in MESSAGE_TYPES}
+        self.samples = 0
+        self.acks = 0
+        self.udp_sent = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.latencies = []
+        self.max_lag = 0.0
+
+
+async def read_responses(reader, pending, stats):
+    """One response line per message; latency is measured against the send time FIFO"""
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        now = time.perf_counter()
+        if pending:
+            stats.latencies.append(now - pending.popleft())
+        stats.acks += 1
+        if b'"type": "error"' in line or b'"type":"error"' in line:
+            stats.errors += 1
+
+
+async def run_robot(index, args, types, weights, start_at, stop_at, stats, connect_limit):
+    robot_id = f"{args.prefix}{index}"
+    async with connect_limit:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), args.timeout)
+            await asyncio.wait_for(reader.readline(), args.timeout)  # welcome
+        except (OSError, asyncio.TimeoutError):
+            stats.connect_failures += 1
+            return
+    stats.connected += 1
+
+    # Registration is closed loop: wait for the confirmation before streaming
+    try:
+        writer.write((json.dumps({"type": "registration", "robot_id": robot_id,
+                                  "timestamp": time.time()}) + "\n").encode())
+        await writer.drain()
+        confirmation = json.loads(await asyncio.wait_for(reader.readline(), args.timeout))
+        stats.registered += 1
+    except (OSError, asyncio.TimeoutError):
+        stats.connect_failures += 1
+        writer.close()
+        return
+
+    # --udp: encoder/IMU as datagrams with the token of the confirmation (no ack), logs stay on TCP
+    udp = None
+    if args.udp:
+        if "udp" not in confirmation:
+            stats.errors += 1  # server without UDP_TELEMETRY_PORT
+        else:
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.setblocking(False)
+            udp.connect((args.host, confirmation["udp"]["port"]))
+            token = bytes.fromhex(confirmation["udp"]["token"])
+    udp_seq = 0
+
+    pending = deque()
+    responses = asyncio.create_task(read_responses(reader, pending, stats))
+    # With --batch the same readings per second travel in 1/batch as many frames
+    interval = args.batch / args.rate
+    rng = random.Random(index)
+    # Spread the robots over one interval so they do not send in lockstep
+    next_send = max(start_at, time.perf_counter()) + rng.random() * interval
+    seq = 0
+    try:
+        while next_send < stop_at:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                stats.max_lag = max(stats.max_lag, -delay)
+
+            msg_type = rng.choices(types, weights)[0]
+            if udp is not None and msg_type != "log":
+                try:
+                    udp.send(UDP_HEADER.pack(b"RT", 1, 0, udp_seq & 0xFFFFFFFF, token)
+                             + make_message(msg_type, robot_id, seq, args.batch))
+                    stats.udp_sent += 1
+                except BlockingIOError:
+                    pass  # socket buffer full: the datagram is lost, as on a real network
+                udp_seq += 1
+            else:
+                pending.append(time.perf_counter())
+                writer.write(make_message(msg_type, robot_id, seq, args.batch))
+            stats.sent[msg_type] += 1
+            stats.samples += args.batch if msg_type != "log" else 1
+            seq += 1
+            # Open loop: the schedule does not depend on responses
+            next_send += interval
+            if writer.transport.get_write_buffer_size() > 64 * 1024:
+                await writer.drain()
+    except (ConnectionError, OSError):
+        stats.disconnects += 1
+    finally:
+        # Wait briefly for outstanding acks
+        deadline = time.perf_counter() + args.drain_timeout
+        while pending and time.perf_counter() < deadline and not responses.done():
+            await asyncio.sleep(0.05)
+        responses.cancel()
+        writer.close()
+        if udp is not None:
+            udp.close()
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "p999": None, "max": None}
+    ms = np.asarray(values) * 1000
+    p50, p90, p99, p999 = np.percentile(ms, [50, 90, 99, 99.9])
+    return {"p50": round(float(p50), 3), "p90": round(float(p90), 3), "p99": round(float(p99), 3),
+            "p999": round(float(p999), 3), "max": round(float(ms.max()), 3)}
+
+
+async def run(args):
+    types, weights = args.mix
+    stats = Stats()
+    connect_limit = asyncio.Semaphore(args.connect_concurrency)
+
+    start_at = time.perf_counter() + args.ramp
+    stop_at = start_at + args.duration
+    robots = [asyncio.create_task(run_robot(i + 1, args, types, weights, start_at, stop_at, stats, connect_limit))
+              for i in range(args.robots)]
+    await asyncio.gather(*robots)
+    elapsed = time.perf_counter() - start_at
+
+    sent = sum(stats.sent.values())
+    return {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "config": {"host": args.host, "port": args.port, "robots": args.robots, "rate_per_robot": args.rate,
+                   "mix": dict(zip(types, [round(w, 4) for w in weights])), "duration": args.duration,
+                   "batch": args.batch, "udp": args.udp},
+        "connections": {"connected": stats.connected, "registered": stats.registered,
+                        "connect_failures": stats.connect_failures, "disconnects": stats.disconnects},
+        "messages": {"sent": sent, "by_type": stats.sent, "samples": stats.samples, "acked": stats.acks,
+                     "udp_sent": stats.udp_sent, "errors": stats.errors,
+                     "unacked": max(0, sent - stats.udp_sent - stats.acks)},
+        "throughput": {"target_per_second": args.robots * args.rate,
+                       "sent_per_second": round(sent / elapsed, 1) if elapsed > 0 else 0.0,
+                       "acked_per_second": round(stats.acks / elapsed, 1) if elapsed > 0 else 0.0},
+        "error_rate": round((stats.errors + max(0, sent - stats.udp_sent - stats.acks)) / sent, 6) if sent else 0.0,
+        "ack_latency_ms": percentiles(stats.latencies),
+        # How far the generator fell behind its own schedule (generator saturation)
+        "max_send_lag_ms": round(stats.max_lag * 1000, 3),
+    }
+
+
+def raise_fd_limit():
+    """Thousands of sockets need more than the default 1024 descriptors"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate many robots against the TCP server (asyncio, open loop)')
+    parser.add_argument('--host', default='localhost', help='Server host (default: localhost)')
+    parser.add_argument('--port', type=int, default=9000, help='Server port (default: 9000)')
+    parser.add_argument('--robots', type=int, default=100, help='Number of simulated robots (default: 100)')
+    parser.add_argument('--rate', type=float, default=20.0, help='Messages per second per robot (default: 20)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("encoder=0.7,imu=0.25,log=0.05"),
+                        help='Message mix (default: encoder=0.7,imu=0.25,log=0.05)')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Encoder/IMU readings per frame (encoder_batch/imu_batch), same readings per second (default: 1)')
+    parser.add_argument('--udp', action='store_true',
+                        help='Send encoder/IMU over the UDP telemetry channel (server needs UDP_TELEMETRY_PORT)')
+    parser.add_argument('--duration', type=float, default=30.0, help='Sending time in seconds (default: 30)')
+    parser.add_argument('--ramp', type=float, default=2.0, help='Time to open connections before sending (default: 2)')
+    parser.add_argument('--prefix', default='load', help='Robot ID prefix (default: load)')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Connect/registration timeout (default: 10)')
+    parser.add_argument('--drain-timeout', type=float, default=2.0, help='Wait for outstanding acks (default: 2)')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='Parallel connection attempts (default: 200)')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    try:
+        report = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("Interrupted by user")
+        sys.exit(1)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
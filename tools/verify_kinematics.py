@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+# Add back/ to path to import the kinematics module
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "back"))
+import kinematics
+from bench_kinematics import legacy_velocity_pinv, legacy_trajectory
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kinematics_golden.json")
+TOLERANCE = 1e-9
+
+def generate_golden():
+    """Build the golden set from the legacy per-sample pinv implementation"""
+    rng = np.random.default_rng(2025)
+    velocity_cases = []
+    for theta in [0.0, np.pi / 6, -np.pi / 2, 2.5, -3.1]:
+        for rpm in [[0, 0, 0], [60, 60, 60], [50, -50, 0]] + rng.uniform(-150, 150, size=(3, 3)).round(2).tolist():
+            velocity_cases.append({
+                "theta": float(theta),
+                "rpm": [float(r) for r in rpm],
+                "expected": [float(v) for v in legacy_velocity_pinv(theta, rpm)]
+            })
+
+    rpm_series = rng.uniform(-100, 100, size=(200, 3)).round(2).tolist()
+    trajectory = legacy_trajectory(rpm_series, legacy_velocity_pinv)
+    return {
+        "geometry": {"wheel_radius": 0.03, "robot_radius": 0.153, "dt": 0.05},
+        "velocity": velocity_cases,
+        "trajectory": {
+            "rpm": rpm_series,
+            "expected": {k: [float(v) for v in trajectory[k]] for k in ("x", "y", "theta")}
+        }
+    }
+
+def verify(golden):
+    kin = kinematics.for_geometry(kinematics.RobotGeometry.from_dict(golden["geometry"]))
+    failures = 0
+
+    # Closed form H0^-1 must match the numeric inverse
+    if not np.allclose(kinematics.closed_form_inverse(kin.geometry.robot_radius), np.linalg.inv(kin.H0), atol=1e-12):
+        failures += 1
+        print("❌ closed form H0^-1 differs from np.linalg.inv(H0)")
+
+    # Scalar API
+    for case in golden["velocity"]:
+        got = kin.velocity(case["theta"], case["rpm"])
+        if not np.allclose(got, case["expected"], atol=TOLERANCE):
+            failures += 1
+            print(f"❌ velocity theta={case['theta']} rpm={case['rpm']}: {got} != {case['expected']}")
+
+    # Batched API
+    thetas = np.array([c["theta"] for c in golden["velocity"]])
+    rpm = np.array([c["rpm"] for c in golden["velocity"]])
+    expected = np.array([c["expected"] for c in golden["velocity"]])
+    if not np.allclose(kin.velocities(thetas, rpm), expected, atol=TOLERANCE):
+        failures += 1
+        print("❌ batched velocities differ from golden values")
+
+    # Batched trajectory and streaming integrator
+    traj = golden["trajectory"]
+    dt = golden["geometry"]["dt"]
+    batched = kin.integrate(traj["rpm"], dt)
+    integrator = kin.integrator()
+    streamed = [integrator.pose()] + [integrator.update(r, dt) for r in traj["rpm"]]
+    for key in ("x", "y", "theta"):
+        exp = np.array(traj["expected"][key])
+        if key == "theta":
+            # Compare angles modulo 2π
+            diff = lambda a: np.abs(np.angle(np.exp(1j * (np.asarray(a) - exp))))
+        else:
+            diff = lambda a: np.abs(np.asarray(a) - exp)
+        if diff(batched[key]).max() > 1e-7:
+            failures += 1
+            print(f"❌ batched trajectory '{key}' differs from golden values")
+        if diff([p[key] for p in streamed]).max() > 1e-7:
+            failures += 1
+            print(f"❌ streaming trajectory '{key}' differs from golden values")
+
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Check kinematics module against the golden set')
+    parser.add_argument('--regenerate', action='store_true', help='Rebuild the golden file from the legacy implementation')
+    args = parser.parse_args()
+
+    if args.regenerate:
+        with open(GOLDEN_FILE, "w") as f:
+            json.dump(generate_golden(), f, indent=1)
+        print(f"Golden set written to {GOLDEN_FILE}")
+        return
+
+    with open(GOLDEN_FILE) as f:
+        golden = json.load(f)
+
+    failures = verify(golden)
+    if failures:
+        print(f"\n❌ {failures} kinematics checks failed")
+        sys.exit(1)
+    print(f"✅ {len(golden['velocity'])} velocity cases and {len(golden['trajectory']['rpm'])}-sample trajectory match the golden set")
+
+if __name__ == "__main__":
+    main()